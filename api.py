@@ -1,17 +1,22 @@
 """
 FastAPI application for serving inventory state, event logs, and annotated images.
 """
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
-from typing import Optional
-import cv2
+from typing import Literal, Optional
+import asyncio
+import dataclasses
+import json
 import numpy as np
-import io
-from PIL import Image
-import base64
 
 from tool_state import InventoryStateManager
+from event_index import EventQuery
+from change_feed import ChangeFeedEntry
+from frame_exchange import FrameExchange
+from frame_cache import EncodedFrameCache, stream_encoded_frames
+import metrics
 
 # Create shared state manager instance
 # This will be imported and used by main.py
@@ -26,11 +31,14 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Let the frontend read the frame cache and change feed headers
+    expose_headers=["ETag", "X-Change-Seq", "X-Next-Cursor"],
 )
 
-# Global variable to store the latest annotated frame
-# This will be updated by main.py
-latest_annotated_frame: Optional[np.ndarray] = None
+# Latest annotated frame, written in place by main.py and read here without copying
+frame_exchange = FrameExchange()
+# Encodes each published frame at most once per format, shared by every client
+encoded_frame_cache = EncodedFrameCache(frame_exchange)
 
 
 @app.get("/")
@@ -39,43 +47,85 @@ async def root():
     return {"message": "Tool Inventory API", "version": "1.0.0"}
 
 
+CHANGE_SEQ_HEADER = "X-Change-Seq"
+
+
 @app.get("/api/inventory")
-async def get_inventory():
+async def get_inventory(response: Response):
     """
     Get current inventory state.
     Returns a dict where keys are tool classes and values are dicts
     mapping drawer identifiers to counts.
+    The X-Change-Seq header is the change feed position this snapshot includes; resume /api/changes/stream from it.
     """
+    # Read the position first: anything published while we serialize is re-sent by the feed (at least once)
+    response.headers[CHANGE_SEQ_HEADER] = str(state_manager.change_feed.latest_seq)
     return {
         "inventory": state_manager.current_inventory,
         "current_user": state_manager.currently_detected_user,
-        "state": state_manager.tool_detection_state
+        "state": _serialize_tool_detection_state(state_manager.tool_detection_state)
+    }
+
+
+def _serialize_tool_detection_state(state) -> dict:
+    # The snapshot history holds raw camera frames, which are internal and not JSON serializable
+    return {
+        state_field.name: getattr(state, state_field.name)
+        for state_field in dataclasses.fields(state)
+        if state_field.name != "tool_detection_state_history"
     }
 
 
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
 @app.get("/api/audit-logs/events")
-async def get_events():
+async def get_events(
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1, le=1000),
+    cursor: Optional[str] = None,
+    user_id: Optional[str] = None,
+    tool: Optional[str] = None,
+    type: Optional[Literal["tool_checkin", "tool_checkout"]] = None,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    order: Literal["asc", "desc"] = "asc",
+):
     """
     Get event log entries matching the frontend schema.
     Returns array of events with tool checkin/checkout information.
     Matches the frontend Event type from dummy.auditlogs.ts
+    Optional filters by user id, tool id, event type and timestamp range (inclusive, unix seconds).
+    With `limit`, returns one page and sets X-Next-Cursor when there are more; pass it back as `cursor`.
+    The X-Change-Seq header is the change feed position this list includes; resume /api/changes/stream from it.
     """
-    events = state_manager.event_log
+    response.headers[CHANGE_SEQ_HEADER] = str(state_manager.change_feed.latest_seq)
+    query = EventQuery(
+        user_id=user_id, tool=tool, event_type=type, since=since, until=until,
+        cursor=cursor, limit=limit, order=order,
+    )
+    try:
+        # Pages reaching past the in-memory log read events.jsonl, so keep them off the event loop
+        page = await asyncio.to_thread(state_manager.query_events, query)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if page.next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = page.next_cursor
     
     # Convert to format matching frontend schema
     # Frontend expects: Event[] (array directly, not wrapped)
     formatted_events = []
-    for event in events:
+    for event in page.events:
         # For now, we need to extract tool info from the tool string format
         # Tool format in state is: f"{class_name} {tracker_id}"
         
         formatted_event = {
-            "id": event["id"],
-            "timestamp": event["timestamp"],
-            "type": event["type"],
-            "user": event["user"],
-            "tool": event["tool"],
-            "eventImageUrl": event["eventImageUrl"]
+            "id": event.id,
+            "timestamp": event.timestamp,
+            "type": event.type,
+            "user": event.user,
+            "tool": event.tool,
+            "eventImageUrl": event.eventImageUrl
         }
         formatted_events.append(formatted_event)
     
@@ -83,125 +133,253 @@ async def get_events():
     return formatted_events
 
 
+# Comment line sent when nothing changed for this long, so proxies don't close idle streams
+CHANGE_STREAM_HEARTBEAT_S = 15.0
+
+
+def _format_sse(entry: ChangeFeedEntry) -> str:
+    data = json.dumps(jsonable_encoder({"seq": entry.seq, "timestamp": entry.timestamp, "payload": entry.payload}))
+    return f"id: {entry.seq}\nevent: {entry.kind}\ndata: {data}\n\n"
+
+
+@app.get("/api/changes/stream")
+async def stream_changes(request: Request, since: Optional[int] = Query(None, ge=0)):
+    """
+    Server-sent event stream of changes: `event` (new audit log entry), `inventory` (count delta)
+    and `state` (drawer state transition). Each message's id is its change sequence number.
+    Resume with `?since=<seq>` or the standard Last-Event-ID header. If the requested position is
+    too old to replay, a `reset` message is sent and the client should reload the full lists.
+    """
+    last_seq = since
+    if last_seq is None:
+        last_event_id = request.headers.get("last-event-id")
+        last_seq = int(last_event_id) if last_event_id and last_event_id.isdigit() else state_manager.change_feed.latest_seq
+
+    async def sse_messages():
+        nonlocal last_seq
+        feed = state_manager.change_feed
+        while not await request.is_disconnected():
+            entries = feed.since(last_seq)
+            if entries is None:
+                last_seq = feed.latest_seq
+                yield f"id: {last_seq}\nevent: reset\ndata: {json.dumps({'seq': last_seq})}\n\n"
+                continue
+            for entry in entries:
+                yield _format_sse(entry)
+                last_seq = entry.seq
+            if not await feed.wait_for_change(last_seq, timeout=CHANGE_STREAM_HEARTBEAT_S):
+                yield ": heartbeat\n\n"
+
+    return StreamingResponse(
+        sse_messages(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.get("/api/audit-logs/overview")
 async def get_overview():
     """
     Get system overview statistics.
     Returns counts for tools, users with checked out tools, etc.
+    Served from counters the state manager maintains incrementally, so this never rescans the event log.
     """
-    # Calculate total tools count from inventory
-    total_tools = 0
-    for tool_class, drawer_counts in state_manager.current_inventory.items():
-        total_tools += sum(drawer_counts.values())
-    
-    # Count users with checked out tools
-    # Tools that are checked out are those in events with type "tool_checkout"
-    # that don't have a corresponding "tool_checkin"
-    checked_out_tools = {}
-    for event in state_manager.event_log:
-        if event["user"] is None:
-            continue
-        if event["type"] == "tool_checkout":
-            # For now, we'll use a simple count
-            # TODO: Track specific tools when tool information is added
-            user_id = event["user"].id
-            checked_out_tools[user_id] = checked_out_tools.get(user_id, 0) + 1
-        elif event["type"] == "tool_checkin":
-            user_id = event["user"].id
-            if user_id in checked_out_tools:
-                checked_out_tools[user_id] = max(0, checked_out_tools[user_id] - 1)
-    
-    users_with_checked_out_tools = sum(1 for count in checked_out_tools.values() if count > 0)
+    aggregates = state_manager.aggregates
     
     # For now, we'll return 0 for tools unseen in last 7 days
     # TODO: Implement this when we have tool tracking
     tools_unseen_in_last_7_days = 0
     
     return {
-        "toolsCount": total_tools,
-        "usersWithCheckedOutToolsCount": users_with_checked_out_tools,
+        "toolsCount": aggregates.total_tools,
+        "usersWithCheckedOutToolsCount": aggregates.users_with_checked_out_tools,
         "toolsUnseenInLast7DaysCount": tools_unseen_in_last_7_days
     }
 
 
+@app.get("/api/images/{image_id}")
+async def get_event_image(image_id: str):
+    """
+    Serve an event snapshot image by id (the eventImageUrl of events points here).
+    Images are content-addressed, so they never change and can be cached forever.
+    """
+    image_store = state_manager.image_store
+    path = image_store.path_for(image_id) if image_store is not None else None
+    if path is None or not path.exists():
+        raise HTTPException(status_code=404, detail="Image not found")
+    return FileResponse(
+        path,
+        media_type="image/jpeg",
+        headers={"Cache-Control": "public, max-age=31536000, immutable"},
+    )
+
+
+def _if_none_match(request: Request, etag: str) -> bool:
+    """True if the client already has this exact frame (If-None-Match may list several ETags)."""
+    header = request.headers.get("if-none-match")
+    if header is None:
+        return False
+    return header.strip() == "*" or etag in [tag.strip() for tag in header.split(",")]
+
+
+# Clients may keep a frame but must revalidate it with If-None-Match before reusing it
+FRAME_CACHE_HEADERS = {"Cache-Control": "no-cache"}
+
+
 @app.get("/api/get-annotated-live-frame")
-async def get_annotated_image():
+async def get_annotated_image(request: Request):
     """
     Serve the latest annotated image with tool detections.
     Returns a PNG image with bounding boxes and labels.
     Matches the frontend route /api/get-annotated-live-frame
+    Each frame is PNG-encoded once, no matter how many clients poll; send If-None-Match to get a 304 for an unchanged frame.
     """
-    global latest_annotated_frame
-    
-    if latest_annotated_frame is None:
-        raise HTTPException(status_code=404, detail="No annotated frame available")
-    
     try:
-        # Convert BGR to RGB for PIL
-        rgb_frame = cv2.cvtColor(latest_annotated_frame, cv2.COLOR_BGR2RGB)
-        
-        # Convert to PIL Image
-        pil_image = Image.fromarray(rgb_frame)
-        
-        # Convert to PNG bytes (matching frontend expectation)
-        img_bytes = io.BytesIO()
-        pil_image.save(img_bytes, format="PNG")
-        img_bytes.seek(0)
-        
-        return StreamingResponse(
-            img_bytes,
-            media_type="image/png",
-            headers={
-                "Cache-Control": "no-cache, no-store, must-revalidate",
-                "Pragma": "no-cache",
-                "Expires": "0"
-            }
-        )
+        encoded = await encoded_frame_cache.get("png")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+    if encoded is None:
+        raise HTTPException(status_code=404, detail="No annotated frame available")
+
+    headers = {**FRAME_CACHE_HEADERS, "ETag": encoded.etag}
+    if _if_none_match(request, encoded.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=encoded.data, media_type=encoded.media_type, headers=headers)
 
 
 @app.get("/api/annotated-image-base64")
-async def get_annotated_image_base64():
+async def get_annotated_image_base64(request: Request):
     """
     Serve the latest annotated image as base64 encoded string.
     Useful for embedding in JSON responses.
+    Shares the cached JPEG encoding with other clients and supports If-None-Match like the PNG endpoint.
     """
-    global latest_annotated_frame
-    
-    if latest_annotated_frame is None:
-        raise HTTPException(status_code=404, detail="No annotated frame available")
-    
     try:
-        # Convert BGR to RGB for PIL
-        rgb_frame = cv2.cvtColor(latest_annotated_frame, cv2.COLOR_BGR2RGB)
-        
-        # Convert to PIL Image
-        pil_image = Image.fromarray(rgb_frame)
-        
-        # Convert to JPEG bytes
-        img_bytes = io.BytesIO()
-        pil_image.save(img_bytes, format="JPEG", quality=85)
-        img_bytes.seek(0)
-        
-        # Encode to base64
-        base64_image = base64.b64encode(img_bytes.getvalue()).decode("utf-8")
-        
-        return {
-            "image": f"data:image/jpeg;base64,{base64_image}",
-            "timestamp": state_manager.event_log[-1]["timestamp"] if state_manager.event_log else 0
-        }
+        encoded = await encoded_frame_cache.get("jpeg", quality=85)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing image: {str(e)}")
+    if encoded is None:
+        raise HTTPException(status_code=404, detail="No annotated frame available")
+
+    headers = {**FRAME_CACHE_HEADERS, "ETag": encoded.etag}
+    if _if_none_match(request, encoded.etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(
+        {
+            "image": encoded.data_uri,
+            "timestamp": state_manager.event_log[-1].timestamp if state_manager.event_log else 0
+        },
+        headers=headers,
+    )
+
+
+MJPEG_BOUNDARY = "frame"
+
+
+@app.get("/api/live-stream.mjpeg")
+async def get_live_stream_mjpeg(
+    fps: float = Query(10.0, gt=0, le=30),
+    quality: int = Query(80, ge=10, le=95),
+):
+    """
+    Push the annotated live frames as an MJPEG (multipart/x-mixed-replace) stream.
+    Can be used directly as an <img> src. Slow clients skip frames instead of buffering them.
+    """
+    async def mjpeg_parts():
+        async for encoded in stream_encoded_frames(encoded_frame_cache, "jpeg", quality, fps):
+            yield (
+                f"--{MJPEG_BOUNDARY}\r\n"
+                f"Content-Type: image/jpeg\r\n"
+                f"Content-Length: {len(encoded.data)}\r\n\r\n"
+            ).encode("utf-8") + encoded.data + b"\r\n"
+
+    return StreamingResponse(
+        mjpeg_parts(),
+        media_type=f"multipart/x-mixed-replace; boundary={MJPEG_BOUNDARY}",
+        headers={"Cache-Control": "no-cache, no-store, must-revalidate"},
+    )
+
+
+@app.websocket("/api/live-stream/ws")
+async def live_stream_websocket(
+    websocket: WebSocket,
+    fps: float = Query(10.0, gt=0, le=30),
+    quality: int = Query(80, ge=10, le=95),
+):
+    """
+    Push the annotated live frames over a WebSocket, one binary JPEG message per frame.
+    Slow clients skip frames instead of buffering them.
+    """
+    async def send_frames():
+        async for encoded in stream_encoded_frames(encoded_frame_cache, "jpeg", quality, fps):
+            await websocket.send_bytes(encoded.data)
+
+    async def wait_for_disconnect():
+        # Clients don't send anything, so the next message we get is the disconnect
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    await websocket.accept()
+    tasks = [asyncio.create_task(send_frames()), asyncio.create_task(wait_for_disconnect())]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            # Surface errors from the sender; a disconnect while sending is a normal way to end
+            if not task.cancelled() and not isinstance(task.exception(), (WebSocketDisconnect, type(None))):
+                raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@app.get("/metrics")
+async def get_metrics(format: Literal["prometheus", "json"] = "prometheus"):
+    """
+    Stage timings and frame, model, face and state transition counters of the camera loop.
+    Prometheus text format by default (scrape this URL); format=json adds percentiles over the last minute.
+    """
+    if format == "json":
+        return metrics.registry.to_json()
+    return PlainTextResponse(metrics.registry.prometheus_text(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+@app.post("/api/profile")
+async def capture_profile(
+    seconds: float = Query(5.0, gt=0, le=60),
+    interval_ms: float = Query(10.0, ge=1, le=1000),
+    thread: Optional[str] = Query(None, description="Only sample threads whose name contains this, e.g. inference"),
+    format: Literal["json", "folded"] = "json",
+):
+    """
+    Samples the Python stacks of the running threads for `seconds` and returns where they spent their time.
+    format=folded returns one "thread;caller;...;function count" line per stack, for flame graph tools.
+    Only one capture runs at a time.
+    """
+    if metrics.profiler.busy:
+        raise HTTPException(status_code=409, detail="A profile is already being captured")
+    try:
+        profile = await asyncio.to_thread(metrics.profiler.capture, seconds, interval_ms / 1000, thread)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    if format == "folded":
+        return PlainTextResponse(profile.folded())
+    return {
+        "seconds": profile.seconds,
+        "interval_ms": interval_ms,
+        "samples": profile.samples,
+        "top_functions": profile.top_functions(),
+    }
 
 
 def update_annotated_frame(frame: np.ndarray):
     """
-    Update the latest annotated frame.
-    This function should be called from main.py after processing each frame.
+    Update the latest annotated frame by copying it into the frame exchange.
+    main.py renders straight into frame_exchange instead, this is for callers that already have a frame.
     """
-    global latest_annotated_frame
-    latest_annotated_frame = frame.copy()
+    frame_exchange.write(frame)
 
 
 if __name__ == "__main__":
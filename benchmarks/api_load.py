@@ -0,0 +1,202 @@
+"""
+Load test of the API endpoints the frontend polls, with concurrent keep-alive clients.
+
+Run from the repository root:
+    python -m benchmarks.api_load
+    python -m benchmarks.api_load --clients 64 --duration 20 --events 100000
+    python -m benchmarks.api_load --save-baseline     # or --compare
+
+The API runs in this process on a free port, with an inventory and event log seeded with
+synthetic checkouts and a frame publisher standing in for the camera loop. The clients run in
+separate processes so they don't compete with the server for the GIL, and the peak RSS reported
+is the server's.
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import http.client
+import multiprocessing
+import socket
+import threading
+import time
+
+import numpy as np
+import uvicorn
+
+import clock
+from api import app, frame_exchange, state_manager
+from benchmarks.report import DEFAULT_BASELINE, compare_to_baseline, environment, format_table, peak_rss_mb, save_baseline, summarize
+
+ENDPOINTS = {
+    "inventory": "/api/inventory",
+    "events": "/api/audit-logs/events?limit=100&order=desc",
+    "overview": "/api/audit-logs/overview",
+    "live_frame": "/api/get-annotated-live-frame",
+}
+SEED_TOOLS = ("hammer", "pliers", "screwdriver", "clamp", "wrench", "tape measure", "drill", "sander")
+SEED_DRAWERS = ("hammers", "pliers and cutters", "drivers and bits", "clamps", "measruing", "drill and dremmel")
+
+
+def seed_state(event_count: int, users: int = 40, seed: int = 0):
+    """Fills the shared state manager with an inventory and `event_count` events, one every 10 minutes."""
+    rng = np.random.default_rng(seed)
+    replay_clock = clock.ReplayClock()
+    clock.set_clock(replay_clock)
+    user_list = [state_manager.make_user_from_string(f"User {number} - usr{number:04d}") for number in range(users)]
+    for tool in SEED_TOOLS:
+        for drawer in SEED_DRAWERS:
+            state_manager.current_inventory[tool][drawer] = int(rng.integers(0, 4))
+    for position in range(event_count):
+        replay_clock.advance_to(600.0 * position)
+        tool = SEED_TOOLS[int(rng.integers(len(SEED_TOOLS)))]
+        drawer = SEED_DRAWERS[int(rng.integers(len(SEED_DRAWERS)))]
+        delta = 1 if position % 2 else -1
+        state_manager.current_inventory[tool][drawer] += delta
+        state_manager._record_inventory_change(tool, drawer, delta)
+        state_manager._generate_event_log_entry(
+            event_type="tool_checkout" if delta > 0 else "tool_checkin",
+            user=user_list[int(rng.integers(users))],
+            tool=state_manager._generate_tool_from_class(tool),
+            event_frame=None,
+        )
+    clock.set_clock(clock.SystemClock())
+
+
+def publish_frames(fps: float, stop_event: threading.Event, shape: tuple[int, int, int] = (480, 640, 3)):
+    """Stands in for the camera loop: a new annotated frame every 1/fps seconds."""
+    rng = np.random.default_rng(1)
+    base = rng.integers(0, 256, size=shape, dtype=np.uint8)
+    position = 0
+    while not stop_event.is_set():
+        frame = frame_exchange.begin_write(shape)
+        np.copyto(frame, base)
+        # Move a block around so every frame encodes differently
+        x = (position * 8) % (shape[1] - 80)
+        frame[200:280, x:x + 80] = 255
+        frame_exchange.commit()
+        position += 1
+        stop_event.wait(1 / fps)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="api", daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def client_process(port: int, threads: int, endpoints: list[str], duration_s: float) -> tuple[dict[str, list[float]], dict[str, int]]:
+    """Runs `threads` keep-alive clients, each cycling through the endpoints until the deadline. Returns latencies and errors per endpoint."""
+    deadline = time.perf_counter() + duration_s
+
+    def client(offset: int) -> tuple[dict[str, list[float]], dict[str, int]]:
+        latencies: defaultdict[str, list[float]] = defaultdict(list)
+        errors: defaultdict[str, int] = defaultdict(int)
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        position = offset
+        while time.perf_counter() < deadline:
+            name = endpoints[position % len(endpoints)]
+            position += 1
+            start = time.perf_counter()
+            try:
+                connection.request("GET", ENDPOINTS[name])
+                response = connection.getresponse()
+                response.read()
+                ok = response.status < 400
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+                ok = False
+            if ok:
+                latencies[name].append(time.perf_counter() - start)
+            else:
+                errors[name] += 1
+        connection.close()
+        return latencies, errors
+
+    merged_latencies: defaultdict[str, list[float]] = defaultdict(list)
+    merged_errors: defaultdict[str, int] = defaultdict(int)
+    with ThreadPoolExecutor(threads) as pool:
+        # Stagger the clients so they don't all hit the same endpoint at once
+        for latencies, errors in pool.map(client, range(threads)):
+            for name, samples in latencies.items():
+                merged_latencies[name].extend(samples)
+            for name, count in errors.items():
+                merged_errors[name] += count
+    return dict(merged_latencies), dict(merged_errors)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=16, help="Concurrent clients in total")
+    parser.add_argument("--client-processes", type=int, default=4, help="Processes the clients are spread over")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds of load")
+    parser.add_argument("--endpoints", nargs="+", choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument("--events", type=int, default=10000, help="Synthetic events in the seeded log")
+    parser.add_argument("--publish-fps", type=float, default=15.0, help="Rate at which new live frames are published")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the api_load section of the baseline")
+    parser.add_argument("--compare", action="store_true", help="Compare this run against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Slowdown (fraction) that counts as a regression")
+    args = parser.parse_args()
+
+    seed_state(args.events)
+    stop_event = threading.Event()
+    threading.Thread(target=publish_frames, args=(args.publish_fps, stop_event), name="publisher", daemon=True).start()
+    port = free_port()
+    server = start_server(port)
+    print(f"API on port {port}: {len(state_manager.event_log)} events, {args.clients} clients for {args.duration:g}s")
+
+    processes = max(1, min(args.client_processes, args.clients))
+    threads_per_process = [args.clients // processes + (1 if position < args.clients % processes else 0) for position in range(processes)]
+    # Spawned, not forked: this process is already running the server's threads
+    with multiprocessing.get_context("spawn").Pool(processes) as pool:
+        outcomes = pool.starmap(client_process, [(port, threads, args.endpoints, args.duration) for threads in threads_per_process])
+    stop_event.set()
+    server.should_exit = True
+
+    latencies: defaultdict[str, list[float]] = defaultdict(list)
+    errors: defaultdict[str, int] = defaultdict(int)
+    for process_latencies, process_errors in outcomes:
+        for name, samples in process_latencies.items():
+            latencies[name].extend(samples)
+        for name, count in process_errors.items():
+            errors[name] += count
+
+    endpoints = {}
+    for name in args.endpoints:
+        summary = summarize(latencies[name])
+        # Throughput across all clients, not what a single client saw
+        summary["per_second"] = round(len(latencies[name]) / args.duration, 1)
+        summary["errors"] = errors[name]
+        endpoints[name] = summary
+    total_requests = sum(len(samples) for samples in latencies.values())
+    results = {
+        "environment": environment(),
+        "clients": args.clients,
+        "duration_s": args.duration,
+        "events": args.events,
+        "requests_per_second": round(total_requests / args.duration, 1),
+        "errors": sum(errors.values()),
+        "peak_rss_mb": peak_rss_mb(),
+        "endpoints": endpoints,
+    }
+
+    print(format_table(endpoints, "endpoint"))
+    print(" ".join(f"{name} {summary['per_second']} req/s," for name, summary in endpoints.items()))
+    print(f"{total_requests} requests, {results['requests_per_second']} req/s, {results['errors']} errors, server peak RSS {results['peak_rss_mb']} MB")
+    if args.compare:
+        compare_to_baseline(args.baseline, "api_load", results, "endpoints", args.tolerance)
+    if args.save_baseline:
+        save_baseline(args.baseline, "api_load", results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Recall and per-query latency of the face-matching indexes on synthetic 128-d encodings.
+
+Run from the repository root:
+    python -m benchmarks.face_index
+    python -m benchmarks.face_index --sizes 100 1000 10000 --queries 200 --n-probe 8
+    python -m benchmarks.face_index --photos-per-person 1 --min-recall 0   # unclustered worst case
+
+The synthetic gallery enrolls a few photos per person, so encodings cluster by identity the way a real
+gallery (and the tool segment embeddings) do. Exits with an error if the IVF index's recall@k falls
+below --min-recall at any size.
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from vector_index import ExactIndex, IVFIndex, VectorIndex
+
+ENCODING_SIZE = 128
+# dlib encodings of different people are typically ~0.8-1.0 apart and the same person is < 0.6 apart
+IDENTITY_SPREAD = 0.07
+SAME_PERSON_NOISE = 0.025
+
+
+def make_synthetic_gallery(size: int, queries: int, photos_per_person: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns (gallery, query encodings, person of every gallery row, person each query is a new photo of).
+    """
+    people = rng.normal(0.0, IDENTITY_SPREAD, size=(max(1, size // photos_per_person), ENCODING_SIZE))
+    gallery_people = np.arange(size) % len(people)
+    gallery = people[gallery_people] + rng.normal(0.0, SAME_PERSON_NOISE, size=(size, ENCODING_SIZE))
+    query_people = rng.integers(0, len(people), size=queries)
+    probe_encodings = people[query_people] + rng.normal(0.0, SAME_PERSON_NOISE, size=(queries, ENCODING_SIZE))
+    return gallery, probe_encodings, gallery_people, query_people
+
+
+def time_queries(index: VectorIndex, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray, float]:
+    """Queries one at a time, like the camera loop does, and returns the mean latency in milliseconds."""
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    distances = np.empty((len(queries), k))
+    start = time.perf_counter()
+    for row, query in enumerate(queries):
+        indices[row], distances[row] = index.search(query[None, :], k)
+    elapsed = time.perf_counter() - start
+    return indices, distances, 1000 * elapsed / len(queries)
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    """Fraction of the exact top-k neighbours that the approximate search also returned."""
+    hits = sum(len(set(found_row) & set(truth_row)) for found_row, truth_row in zip(found, truth))
+    return hits / truth.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--photos-per-person", type=int, default=5, help="Enrolled encodings per identity; 1 gives unclustered data")
+    parser.add_argument("--n-probe", type=int, default=None, help="Buckets scanned per query (default: the index's own, scaled with its size)")
+    parser.add_argument("--min-recall", type=float, default=0.95, help="Lowest acceptable IVF recall@k")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'size':>7} {'index':>6} {'build ms':>9} {'query ms':>9} {'recall@1':>9} {'recall@k':>9} {'identity@1':>11}")
+    below_floor = []
+    for size in args.sizes:
+        gallery, queries, gallery_people, query_people = make_synthetic_gallery(size, args.queries, args.photos_per_person, rng)
+
+        results = {}
+        for name, index in (("exact", ExactIndex()), ("ivf", IVFIndex(n_probe=args.n_probe, seed=args.seed))):
+            start = time.perf_counter()
+            index.build(gallery)
+            build_ms = 1000 * (time.perf_counter() - start)
+            indices, _, query_ms = time_queries(index, queries, args.k)
+            results[name] = (indices, build_ms, query_ms)
+
+        exact_indices = results["exact"][0]
+        for name, (indices, build_ms, query_ms) in results.items():
+            recall_1 = recall_at_k(indices[:, :1], exact_indices[:, :1])
+            recall_k = recall_at_k(indices, exact_indices)
+            identity_1 = float(np.mean(gallery_people[indices[:, 0]] == query_people))
+            print(f"{size:>7} {name:>6} {build_ms:>9.1f} {query_ms:>9.3f} {recall_1:>9.3f} {recall_k:>9.3f} {identity_1:>11.3f}")
+            if recall_k < args.min_recall:
+                below_floor.append(f"{name} at {size} vectors: recall@{args.k} {recall_k:.3f}")
+
+    if below_floor:
+        sys.exit(f"recall below {args.min_recall}: " + ", ".join(below_floor))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Per-stage latency of the main.py frame loop, offline, on a recording or on synthetic frames.
+
+Run from the repository root:
+    python -m benchmarks.frame_loop                                   # 900 synthetic frames (30 s at 30 fps)
+    python -m benchmarks.frame_loop --recording recordings/demo --backend onnx
+    python -m benchmarks.frame_loop --every-frame --save-baseline     # model and faces on every frame
+    python -m benchmarks.frame_loop --compare                         # flag regressions against the baseline
+
+Frames go through the same Station as main.py, serially and on a ReplayClock, so drawer
+transitions happen at the recorded (or synthetic) times no matter how slow the machine is.
+Stages timed separately:
+- depth_probes: gathering and median filtering the probe readings
+- model: the tools model on the (cropped) colour frame
+- tracker: ByteTrack and building the detection sets
+- faces: face detection, encoding and gallery matching on new webcam frames
+- annotate: rendering boxes, labels and traces into the API's frame buffer
+- publish: committing the frame plus the one JPEG encode the API does per frame for its clients
+- state_machine: tool detection state, drawer transitions, inventory updates and events
+By default the model and faces only run when their schedulers say so, like the live loop;
+--every-frame runs them on every frame to measure their raw cost.
+"""
+from contextlib import redirect_stdout
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+import argparse
+import io
+import time
+
+import cv2
+import numpy as np
+import supervision as sv
+
+import clock
+from benchmarks.report import DEFAULT_BASELINE, StageTimings, compare_to_baseline, environment, format_table, peak_rss_mb, save_baseline, summarize
+from depth_probes import DepthProbeEngine
+from detection import crop_to_region
+from faces import FaceGallery
+from frame_cache import encode_frame
+from frame_exchange import FrameExchange
+from inference_backends import BACKENDS, load_detector
+from recording import Recording, replay_serial
+from stations import Station, StationConfig
+from tool_state import InventoryStateManager
+
+STAGES = ("depth_probes", "model", "tracker", "faces", "annotate", "publish", "state_machine")
+SYNTHETIC_SHAPE = (480, 640)
+SYNTHETIC_TOOLS = ("hammer", "pliers", "screwdriver", "clamp", "wrench")
+# Beyond every drawer band: all drawers closed
+CLOSED_DEPTH = 1000
+
+
+@dataclass
+class BenchmarkFrame:
+    timestamp: float
+    depth: np.ndarray
+    color: np.ndarray
+    webcam: np.ndarray | None
+    is_new_webcam: bool
+    # Ground-truth tool boxes of a synthetic frame, used as detections when the model is skipped
+    boxes: sv.Detections | None = None
+
+
+def recorded_frames(recording: Recording, limit: int | None) -> Iterator[BenchmarkFrame]:
+    for position, step in enumerate(replay_serial(recording)):
+        if limit is not None and position >= limit:
+            return
+        if step.frames["depth"] is None:
+            continue
+        yield BenchmarkFrame(
+            timestamp=step.timestamp,
+            depth=step.frames["depth"],
+            color=step.frames["kinect_color"],
+            webcam=step.frames.get("webcam"),
+            is_new_webcam=step.is_new.get("webcam", False),
+        )
+
+
+def synthetic_frames(count: int, fps: float, engine: DepthProbeEngine, faces_dir: str, seed: int = 0) -> Iterator[BenchmarkFrame]:
+    """
+    A cabinet where every drawer in depth_probes.json is opened in turn: closed for 2 s, open for 3 s.
+    While a drawer is open a handful of tools jitter in the colour frame and one is taken out halfway.
+    The webcam shows the first enrolled face, so face detection and encoding do real work.
+    """
+    rng = np.random.default_rng(seed)
+    height, width = SYNTHETIC_SHAPE
+    drawers = [(probe, band) for probe in engine.probes for band in probe.bands]
+    webcam = _first_face_image(faces_dir, (width, height))
+    background = rng.integers(90, 110, size=(height, width, 3), dtype=np.uint8)
+    home_boxes = np.array([[60 + 110 * tool, 300, 140 + 110 * tool, 420] for tool in range(len(SYNTHETIC_TOOLS))], dtype=np.float32)
+
+    for position in range(count):
+        timestamp = position / fps
+        cycle, within_cycle = divmod(timestamp, 5.0)
+        depth = np.full(SYNTHETIC_SHAPE, CLOSED_DEPTH, dtype=np.uint16)
+        color = background.copy()
+        boxes = None
+        if within_cycle >= 2.0:
+            probe, band = drawers[int(cycle) % len(drawers)]
+            x1, y1, x2, y2 = _probe_square(probe.x, probe.y, engine.half_size, SYNTHETIC_SHAPE)
+            depth[y1:y2, x1:x2] = (band.min_depth + band.max_depth) // 2 + rng.integers(-2, 3, size=(y2 - y1, x2 - x1))
+            # The last tool is taken out for the second half of the opening
+            tool_count = len(SYNTHETIC_TOOLS) - (1 if within_cycle >= 3.5 else 0)
+            xyxy = home_boxes[:tool_count] + rng.normal(0, 1.5, size=(tool_count, 4)).astype(np.float32)
+            for tool, (bx1, by1, bx2, by2) in enumerate(xyxy.astype(int)):
+                cv2.rectangle(color, (bx1, by1), (bx2, by2), _tool_color(tool), thickness=-1)
+            boxes = sv.Detections(
+                xyxy=xyxy,
+                confidence=np.full(tool_count, 0.9, dtype=np.float32),
+                class_id=np.arange(tool_count),
+                data={"class_name": np.array(SYNTHETIC_TOOLS[:tool_count])},
+            )
+        yield BenchmarkFrame(timestamp=timestamp, depth=depth, color=color, webcam=webcam, is_new_webcam=True, boxes=boxes)
+
+
+def _probe_square(x: int, y: int, half_size: int, shape: tuple[int, int]) -> tuple[int, int, int, int]:
+    return max(0, x - half_size), max(0, y - half_size), min(shape[1], x + half_size), min(shape[0], y + half_size)
+
+
+def _tool_color(tool: int) -> tuple[int, int, int]:
+    return (40 + 50 * tool) % 256, (200 - 35 * tool) % 256, (90 + 70 * tool) % 256
+
+
+def _first_face_image(faces_dir: str, size: tuple[int, int]) -> np.ndarray:
+    for path in sorted(Path(faces_dir).glob("*")):
+        image = cv2.imread(str(path)) if path.suffix.lower() in (".jpg", ".jpeg", ".png") else None
+        if image is not None:
+            return cv2.resize(image, size)
+    return np.zeros((size[1], size[0], 3), dtype=np.uint8)
+
+
+def run(station: Station, frames: Iterator[BenchmarkFrame], replay_clock: clock.ReplayClock, skip: set[str], every_frame: bool) -> tuple[StageTimings, list[float]]:
+    """Processes every frame like Station.process() does, timing each stage. Returns the stage timings and the per-frame totals."""
+    timings = StageTimings()
+    frame_totals = []
+    stage = station.detection_stage
+    exchange = station.frame_exchange
+    # Transition and event logging would drown out the report
+    with redirect_stdout(io.StringIO()):
+        for frame in frames:
+            replay_clock.advance_to(frame.timestamp)
+            start = time.perf_counter()
+
+            run_model, region = station.detection_request()
+            if every_frame:
+                run_model = True
+            if "model" in skip:
+                result = stage.skip()
+                if frame.boxes is not None:
+                    # Synthetic frames know where their tools are; track those instead
+                    with timings.measure("tracker"):
+                        result = stage.track(frame.boxes, None, frame.color)
+            elif run_model:
+                model_input, region = crop_to_region(frame.color, region)
+                with timings.measure("model"):
+                    detections = stage.detector.detect(model_input)
+                with timings.measure("tracker"):
+                    result = stage.track(detections, region, frame.color)
+            else:
+                result = stage.skip()
+
+            with timings.measure("state_machine"):
+                station.update_tool_detection_state(result.tool_detection_set, frame.color)
+
+            if frame.webcam is not None and frame.is_new_webcam and "faces" not in skip:
+                if station.face_scheduler.should_run(frame.webcam, station.state_manager.tool_detection_state) or every_frame:
+                    with timings.measure("faces"):
+                        faces, user = station.find_faces(frame.webcam)
+                    station.face_scheduler.record_result(faces, user)
+                station.state_manager.update_currently_detected_user(station.face_scheduler.last_user)
+
+            with timings.measure("annotate"):
+                annotated = exchange.begin_write(frame.color.shape, frame.color.dtype)
+                station.annotator.annotate(frame.color, result, out=annotated)
+                station.fps_counter.draw(annotated)
+            with timings.measure("publish"):
+                exchange.commit()
+                encode_frame(exchange.read().frame, "jpeg", quality=80)
+
+            with timings.measure("depth_probes"):
+                drawer = station.drawer_state_filter.update(frame.depth)
+            with timings.measure("state_machine"):
+                station.apply_drawer_transition(drawer)
+
+            timings.end_frame()
+            frame_totals.append(time.perf_counter() - start)
+    return timings, frame_totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recording", default=None, help="Recording directory (recording.py); synthetic frames if omitted")
+    parser.add_argument("--frames", type=int, default=900, help="Synthetic frames to generate, or the maximum to replay from a recording")
+    parser.add_argument("--fps", type=float, default=30.0, help="Frame rate of the synthetic frames")
+    parser.add_argument("--backend", choices=BACKENDS, default="ultralytics")
+    parser.add_argument("--weights", default=None)
+    parser.add_argument("--skip", nargs="*", choices=("model", "faces"), default=[],
+                        help="Stages to leave out, e.g. on a machine without the model; synthetic tool boxes are tracked instead of the model's")
+    parser.add_argument("--every-frame", action="store_true", help="Run the model and face recognition on every frame instead of when scheduled")
+    parser.add_argument("--warmup", type=int, default=10, help="Frames processed before timing starts (model and allocator warm-up)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the frame_loop section of the baseline")
+    parser.add_argument("--compare", action="store_true", help="Compare this run against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Slowdown (fraction) that counts as a regression")
+    args = parser.parse_args()
+    skip = set(args.skip)
+
+    detector = None if "model" in skip else load_detector(args.backend, args.weights)
+    face_gallery = FaceGallery("faces")
+    if "faces" not in skip:
+        face_gallery.load()
+
+    def run_fresh(limit: int) -> tuple[Station, StageTimings, list[float]]:
+        """A new station, clock and frame sequence, so the warm-up doesn't leave state behind."""
+        replay_clock = clock.ReplayClock()
+        clock.set_clock(replay_clock)
+        config = StationConfig(name="benchmark")
+        station = Station.from_config(config, InventoryStateManager(), detector, face_gallery, frame_exchange=FrameExchange())
+        if args.recording is not None:
+            frames = recorded_frames(Recording(args.recording), limit)
+        else:
+            frames = synthetic_frames(limit, args.fps, DepthProbeEngine.from_config(config.depth_probes), "faces")
+        return station, *run(station, frames, replay_clock, skip, args.every_frame)
+
+    if args.warmup:
+        run_fresh(args.warmup)
+    station, timings, frame_totals = run_fresh(args.frames)
+
+    summaries = timings.summaries()
+    stages = {name: summaries[name] for name in STAGES if name in summaries}
+    stages["frame"] = summarize(frame_totals)
+    results = {
+        "environment": environment(),
+        "input": args.recording or f"synthetic {SYNTHETIC_SHAPE[1]}x{SYNTHETIC_SHAPE[0]} @ {args.fps:g} fps",
+        "backend": None if "model" in skip else args.backend,
+        "every_frame": args.every_frame,
+        "skipped": sorted(skip),
+        "frames": len(frame_totals),
+        "fps": round(len(frame_totals) / sum(frame_totals), 1) if frame_totals else 0.0,
+        "events": len(station.state_manager.event_log),
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": stages,
+    }
+
+    print(format_table(stages, "stage"))
+    print(f"{results['frames']} frames, {results['fps']} fps, {results['events']} events, peak RSS {results['peak_rss_mb']} MB")
+    if args.compare:
+        compare_to_baseline(args.baseline, "frame_loop", results, "stages", args.tolerance)
+    if args.save_baseline:
+        save_baseline(args.baseline, "frame_loop", results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Latency summaries, peak memory and baseline files shared by the benchmarks.
+
+A baseline is a JSON file with one section per benchmark ("frame_loop", "api_load"). Saving a
+run replaces only its own section, so both benchmarks can share one file. Comparing a run against
+a baseline flags every latency that got more than `tolerance` slower.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Any
+import json
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+
+DEFAULT_BASELINE = "benchmarks/baseline.json"
+# Latency keys compared against the baseline (lower is better)
+COMPARED_KEYS = ("p50_ms", "p95_ms", "p99_ms")
+
+
+def summarize(latencies_s: list[float]) -> dict[str, float]:
+    """Count, mean, p50/p95/p99 and max in milliseconds, plus the rate a single worker could sustain."""
+    if not latencies_s:
+        return {"count": 0}
+    latencies_ms = 1000 * np.asarray(latencies_s)
+    p50, p95, p99 = np.percentile(latencies_ms, [50, 95, 99])
+    mean = float(latencies_ms.mean())
+    return {
+        "count": len(latencies_ms),
+        "mean_ms": round(mean, 3),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "max_ms": round(float(latencies_ms.max()), 3),
+        "per_second": round(1000 / mean, 1) if mean > 0 else None,
+    }
+
+
+class StageTimings:
+    """
+    Per-frame latency of every stage of a loop. A stage measured several times within one frame
+    counts as one sample of the summed time; a stage that didn't run in a frame gets no sample.
+    """
+
+    def __init__(self):
+        self.samples: defaultdict[str, list[float]] = defaultdict(list)
+        self._frame: dict[str, float] = {}
+
+    @contextmanager
+    def measure(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._frame[stage] = self._frame.get(stage, 0.0) + time.perf_counter() - start
+
+    def end_frame(self):
+        for stage, elapsed in self._frame.items():
+            self.samples[stage].append(elapsed)
+        self._frame = {}
+
+    def summaries(self) -> dict[str, dict[str, float]]:
+        return {stage: summarize(samples) for stage, samples in self.samples.items()}
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def environment() -> dict[str, str]:
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "recorded_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def format_table(rows: dict[str, dict[str, float]], first_column: str) -> str:
+    columns = ("count", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms")
+    width = max([len(first_column), *(len(name) for name in rows)])
+    lines = [f"{first_column:<{width}} " + " ".join(f"{column:>9}" for column in columns)]
+    for name, summary in rows.items():
+        lines.append(f"{name:<{width}} " + " ".join(f"{summary.get(column, '-'):>9}" for column in columns))
+    return "\n".join(lines)
+
+
+def save_baseline(path: str, section: str, results: dict[str, Any]):
+    baseline_path = Path(path)
+    baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+    baseline[section] = results
+    baseline_path.parent.mkdir(parents=True, exist_ok=True)
+    baseline_path.write_text(json.dumps(baseline, indent=2) + "\n")
+    print(f"saved {section} baseline to {path}")
+
+
+def compare_to_baseline(path: str, section: str, results: dict[str, Any], group: str, tolerance: float = 0.2) -> list[str]:
+    """
+    Prints and returns the regressions against the baseline: latencies in `results[group]` and the
+    peak RSS that grew by more than `tolerance` (a fraction).
+    """
+    baseline_path = Path(path)
+    if not baseline_path.exists():
+        print(f"no baseline at {path}; run with --save-baseline first")
+        return []
+    previous = json.loads(baseline_path.read_text()).get(section, {})
+    regressions = []
+    for name, summary in results[group].items():
+        for key in COMPARED_KEYS:
+            before, after = previous.get(group, {}).get(name, {}).get(key), summary.get(key)
+            if before and after is not None and (after - before) / before > tolerance:
+                regressions.append(f"{name} {key}: {before:.2f}ms -> {after:.2f}ms (+{100 * (after - before) / before:.0f}%)")
+    before, after = previous.get("peak_rss_mb"), results.get("peak_rss_mb")
+    if before and after and (after - before) / before > tolerance:
+        regressions.append(f"peak_rss_mb: {before:.1f} -> {after:.1f}")
+    if regressions:
+        print(f"{len(regressions)} regressions against {path} (tolerance {100 * tolerance:.0f}%):")
+        for regression in regressions:
+            print(f"  {regression}")
+    else:
+        print(f"no regressions against {path} (tolerance {100 * tolerance:.0f}%)")
+    return regressions
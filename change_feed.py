@@ -0,0 +1,94 @@
+"""
+Sequenced feed of inventory, audit-log and drawer-state changes, pushed to API clients as they happen.
+"""
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Literal
+import asyncio
+import threading
+import time
+
+ChangeKind = Literal["event", "inventory", "state"]
+
+
+@dataclass
+class ChangeFeedEntry:
+    seq: int
+    kind: ChangeKind
+    payload: Any
+    # Unix time in seconds
+    timestamp: float
+
+
+class ChangeFeed:
+    """
+    Append-only feed with a bounded in-memory retention window.
+
+    publish() is called from the camera thread; API handlers read with since() and park on
+    wait_for_change() in their own event loop, which publish() wakes without blocking.
+    Sequence numbers increase by one per change, so a client that remembers the last seq it saw can
+    resume exactly where it left off while that seq is still retained. They continue from the process
+    start time in milliseconds rather than from 0, so a seq handed out before a restart is older than
+    anything this process retains and the client is told to reload instead of silently missing changes.
+    """
+
+    def __init__(self, retention: int = 1000):
+        self._entries: deque[ChangeFeedEntry] = deque(maxlen=retention)
+        self._lock = threading.Lock()
+        self._latest_seq = int(time.time() * 1000)
+        self._waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = set()
+
+    @property
+    def latest_seq(self) -> int:
+        return self._latest_seq
+
+    def publish(self, kind: ChangeKind, payload: Any) -> int:
+        with self._lock:
+            self._latest_seq += 1
+            self._entries.append(ChangeFeedEntry(seq=self._latest_seq, kind=kind, payload=payload, timestamp=time.time()))
+            waiters = list(self._waiters)
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+        return self._latest_seq
+
+    def since(self, seq: int) -> list[ChangeFeedEntry] | None:
+        """
+        Entries with a sequence number greater than `seq`, oldest first.
+        Returns None if some of those entries have already been dropped from the retention window, or if
+        `seq` is from a previous run of the process, in which case the client has to reload the full state.
+        """
+        with self._lock:
+            if seq > self._latest_seq:
+                return None
+            if seq == self._latest_seq:
+                return []
+            oldest_retained = self._entries[0].seq if self._entries else self._latest_seq + 1
+            if seq + 1 < oldest_retained:
+                return None
+            return [entry for entry in self._entries if entry.seq > seq]
+
+    async def wait_for_change(self, seq: int, timeout: float) -> bool:
+        """Waits until something newer than `seq` is published. Returns False on timeout."""
+        if self._latest_seq > seq:
+            return True
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._lock:
+            self._waiters.add(waiter)
+        try:
+            # Re-check now that we're registered, in case a publish slipped in between
+            if self._latest_seq > seq:
+                return True
+            await asyncio.wait_for(future, timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
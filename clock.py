@@ -0,0 +1,52 @@
+"""
+Time source for the state machines.
+
+Everything whose behaviour depends on elapsed time (drawer debouncing, detection and face
+scheduling, the 2-second tool history, drawer-open timing and event timestamps) reads the time
+from here instead of from `time` and `datetime` directly. Live runs use the system clock; a serial
+replay installs a ReplayClock that follows the recording's timestamps, so a replay produces the
+same transitions and events no matter how fast the machine running it is.
+"""
+from datetime import datetime, timedelta
+import time
+
+
+class SystemClock:
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+
+class ReplayClock:
+    """Clock that only moves when advance_to() is called with the timestamp of the frame being replayed."""
+
+    def __init__(self, start: datetime | None = None):
+        self.start = start if start is not None else datetime(2000, 1, 1)
+        self._elapsed_s = 0.0
+
+    def advance_to(self, elapsed_s: float):
+        self._elapsed_s = max(self._elapsed_s, elapsed_s)
+
+    def monotonic(self) -> float:
+        return self._elapsed_s
+
+    def now(self) -> datetime:
+        return self.start + timedelta(seconds=self._elapsed_s)
+
+
+_clock: SystemClock | ReplayClock = SystemClock()
+
+
+def set_clock(clock: SystemClock | ReplayClock):
+    global _clock
+    _clock = clock
+
+
+def monotonic() -> float:
+    return _clock.monotonic()
+
+
+def now() -> datetime:
+    return _clock.now()
@@ -0,0 +1,263 @@
+"""
+Depth probes for drawer detection.
+
+Each probe averages the Kinect depth in a square around one point; a drawer is identified by
+which depth band a probe's reading falls in. Probe points and bands live in depth_probes.json,
+so adding a drawer or a cabinet is a config change. All probes are read in one batched NumPy
+gather and reduction per frame, and bands are looked up with bisect instead of if-chains.
+
+DrawerStateFilter sits between the raw readings and the state machine: a short per-probe median,
+band hysteresis and a minimum dwell time keep single noisy frames from opening or closing drawers.
+"""
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from pathlib import Path
+import json
+
+import numpy as np
+
+import clock
+
+
+@dataclass
+class DepthBand:
+    drawer: str
+    # Exclusive bounds: a reading matches when min_depth < depth < max_depth
+    min_depth: int
+    max_depth: int
+
+
+@dataclass
+class DepthProbe:
+    name: str
+    x: int
+    y: int
+    bands: list[DepthBand] = field(default_factory=list)
+
+
+class BandTable:
+    """Non-overlapping depth bands sorted by lower bound, looked up with bisect."""
+
+    def __init__(self, bands: list[DepthBand]):
+        self.bands = sorted(bands, key=lambda band: band.min_depth)
+        for lower, upper in zip(self.bands, self.bands[1:]):
+            if upper.min_depth < lower.max_depth - 1:
+                raise ValueError(f"depth bands for {lower.drawer!r} and {upper.drawer!r} overlap")
+        self._min_depths = [band.min_depth for band in self.bands]
+        self._by_drawer = {band.drawer: band for band in self.bands}
+
+    def lookup(self, depth: int) -> str | None:
+        # The band with the largest lower bound below `depth` is the only candidate
+        index = bisect_left(self._min_depths, depth) - 1
+        if index < 0 or depth >= self.bands[index].max_depth:
+            return None
+        return self.bands[index].drawer
+
+    def holds(self, drawer: str, depth: int, margin: int) -> bool:
+        """Whether `depth` is within `drawer`'s band widened by `margin` on both sides."""
+        band = self._by_drawer.get(drawer)
+        return band is not None and band.min_depth - margin < depth < band.max_depth + margin
+
+
+class DepthProbeEngine:
+    """
+    Args:
+        probes: Probes in priority order; the first one whose reading falls in a band wins.
+        half_size: Each probe averages a (2 * half_size)px square around its point.
+        max_variance: Readings with a higher depth variance (e.g. a drawer edge mixed with the floor) are discarded.
+        hysteresis: Once a drawer is open, its band is widened by this much depth on both sides before it counts as closed.
+    """
+
+    def __init__(self, probes: list[DepthProbe], half_size: int = 15, max_variance: float = 150, hysteresis: int = 0):
+        self.probes = probes
+        self.half_size = half_size
+        self.max_variance = max_variance
+        self.hysteresis = hysteresis
+        self.band_tables = [BandTable(probe.bands) for probe in probes]
+        # Flat gather indices for every probe's ROI, padded to the same length; rebuilt if the frame shape changes
+        self._gather_shape: tuple[int, ...] | None = None
+        self._gather_indices: np.ndarray | None = None
+        self._gather_mask: np.ndarray | None = None
+
+    @classmethod
+    def from_config(cls, path: str = "depth_probes.json") -> "DepthProbeEngine":
+        config = json.loads(Path(path).read_text())
+        probes = [
+            DepthProbe(
+                name=probe["name"],
+                x=probe["x"],
+                y=probe["y"],
+                bands=[DepthBand(band["drawer"], band["min"], band["max"]) for band in probe["bands"]],
+            )
+            for probe in config["probes"]
+        ]
+        return cls(
+            probes,
+            half_size=config.get("half_size", 15),
+            max_variance=config.get("max_variance", 150),
+            hysteresis=config.get("hysteresis", 0),
+        )
+
+    def measure(self, frame: np.ndarray) -> list[int | None]:
+        """
+        Average depth at every probe, or None where the reading is unreliable
+        (no valid pixels, or variance above max_variance). Zero depth pixels are ignored.
+        """
+        indices, in_bounds = self._gather_for(frame.shape)
+        samples = np.take(frame, indices)
+        valid = (samples > 0) & in_bounds
+        values = np.where(valid, samples, 0).astype(np.int64)
+        counts = valid.sum(axis=1)
+        sums = values.sum(axis=1)
+        sums_of_squares = (values * values).sum(axis=1)
+        return [
+            self._reading(int(count), int(total), int(total_of_squares))
+            for count, total, total_of_squares in zip(counts, sums, sums_of_squares)
+        ]
+
+    def measure_point(self, frame: np.ndarray, x: int, y: int) -> int | None:
+        """Same reading as measure(), for an arbitrary point (used for click-to-inspect)."""
+        y_start, y_end, x_start, x_end = roi_bounds(frame.shape, x, y, self.half_size)
+        roi = frame[y_start:y_end, x_start:x_end]
+        values = roi[roi > 0].astype(np.int64)
+        return self._reading(values.size, int(values.sum()), int((values * values).sum()))
+
+    def identify_drawer(self, readings: list[int | None], current: str | None = None) -> str | None:
+        """
+        The open drawer according to the first probe whose reading matches a band, or None.
+        `current` (the drawer believed open right now) is kept while any probe reads within its widened band.
+        """
+        if current is not None and self.hysteresis > 0:
+            for reading, band_table in zip(readings, self.band_tables):
+                if reading is not None and band_table.holds(current, reading, self.hysteresis):
+                    return current
+        for reading, band_table in zip(readings, self.band_tables):
+            if reading is None:
+                continue
+            drawer = band_table.lookup(reading)
+            if drawer is not None:
+                return drawer
+        return None
+
+    def _reading(self, count: int, total: int, total_of_squares: int) -> int | None:
+        if count == 0:
+            return None
+        mean = total / count
+        variance = total_of_squares / count - mean * mean
+        if variance > self.max_variance:
+            return None
+        return int(mean)
+
+    def _gather_for(self, shape: tuple[int, ...]) -> tuple[np.ndarray, np.ndarray]:
+        if shape != self._gather_shape:
+            side = 2 * self.half_size
+            indices = np.zeros((len(self.probes), side * side), dtype=np.intp)
+            mask = np.zeros((len(self.probes), side * side), dtype=bool)
+            for row, probe in enumerate(self.probes):
+                y_start, y_end, x_start, x_end = roi_bounds(shape, probe.x, probe.y, self.half_size)
+                ys, xs = np.mgrid[y_start:y_end, x_start:x_end]
+                flat = (ys * shape[1] + xs).ravel()
+                indices[row, :flat.size] = flat
+                mask[row, :flat.size] = True
+            self._gather_shape = shape
+            self._gather_indices = indices
+            self._gather_mask = mask
+        return self._gather_indices, self._gather_mask
+
+
+def roi_bounds(shape: tuple[int, ...], x: int, y: int, half_size: int) -> tuple[int, int, int, int]:
+    """(y_start, y_end, x_start, x_end) of the square around (x, y), clipped to the frame."""
+    return (
+        max(0, y - half_size),
+        min(shape[0], y + half_size),
+        max(0, x - half_size),
+        min(shape[1], x + half_size),
+    )
+
+
+class ProbeMedianFilter:
+    """
+    Streaming median of the last `window` readings of every probe.
+    Unreliable (None) readings count as missing; a probe only reads None once most of its window is missing.
+    """
+
+    def __init__(self, probe_count: int, window: int = 5):
+        self.window = window
+        self._history = np.full((window, probe_count), np.nan)
+        self._next = 0
+        self._filled = 0
+
+    def update(self, readings: list[int | None]) -> list[int | None]:
+        self._history[self._next] = [np.nan if reading is None else reading for reading in readings]
+        self._next = (self._next + 1) % self.window
+        self._filled = min(self._filled + 1, self.window)
+
+        history = self._history[:self._filled]
+        reliable = 2 * np.count_nonzero(~np.isnan(history), axis=0) > self._filled
+        filtered: list[int | None] = [None] * len(readings)
+        if reliable.any():
+            for column, median in zip(np.flatnonzero(reliable), np.nanmedian(history[:, reliable], axis=0)):
+                filtered[column] = int(median)
+        return filtered
+
+    def reset(self):
+        self._history.fill(np.nan)
+        self._next = 0
+        self._filled = 0
+
+
+class DrawerStateFilter:
+    """
+    Turns raw depth frames into a debounced open drawer (or None).
+
+    Readings go through a ProbeMedianFilter, then the engine's band lookup with hysteresis, and a
+    changed result is only committed once it has held for `min_dwell_s`.
+
+    Args:
+        engine: Probe engine used to read the depth frames.
+        window: Median window per probe, in frames.
+        min_dwell_s: How long a new drawer state has to hold before it is committed.
+    """
+
+    def __init__(self, engine: DepthProbeEngine, window: int = 5, min_dwell_s: float = 0.3):
+        self.engine = engine
+        self.min_dwell_s = min_dwell_s
+        self.median_filter = ProbeMedianFilter(len(engine.probes), window=window)
+
+        # Committed state, and the change waiting out its dwell time
+        self.drawer: str | None = None
+        self._has_pending = False
+        self._pending_drawer: str | None = None
+        self._pending_since = 0.0
+
+        # Latest readings, kept for debug output
+        self.raw_readings: list[int | None] = []
+        self.readings: list[int | None] = []
+
+    @classmethod
+    def from_config(cls, path: str = "depth_probes.json") -> "DrawerStateFilter":
+        config = json.loads(Path(path).read_text())
+        return cls(
+            DepthProbeEngine.from_config(path),
+            window=config.get("filter_window", 5),
+            min_dwell_s=config.get("min_dwell_s", 0.3),
+        )
+
+    def update(self, depth_frame: np.ndarray, now: float | None = None) -> str | None:
+        """Feeds one depth frame and returns the committed drawer."""
+        now = clock.monotonic() if now is None else now
+        self.raw_readings = self.engine.measure(depth_frame)
+        self.readings = self.median_filter.update(self.raw_readings)
+        candidate = self.engine.identify_drawer(self.readings, current=self.drawer)
+
+        if candidate == self.drawer:
+            self._has_pending = False
+        elif not self._has_pending or candidate != self._pending_drawer:
+            self._has_pending = True
+            self._pending_drawer = candidate
+            self._pending_since = now
+
+        if self._has_pending and now - self._pending_since >= self.min_dwell_s:
+            self.drawer = candidate
+            self._has_pending = False
+        return self.drawer
@@ -0,0 +1,274 @@
+"""
+Single-pass tool detection.
+
+Runs the tools model and ByteTrack exactly once per frame and hands the result to
+everything that needs it (the tool state machine and the annotators), so the tracker
+only advances one step per frame.
+
+DetectionScheduler decides whether a frame needs the model at all, and which part of it:
+tools only matter while a drawer is open, and only inside that drawer's region.
+"""
+from dataclasses import dataclass, field
+from collections import deque
+from pathlib import Path
+import json
+import time
+
+import cv2
+import numpy as np
+import supervision as sv
+
+import clock
+from inference_backends import Detector
+import metrics
+from tool_identification import ToolIdentifier, TrackIdentityCache
+from tool_state import DrawerOpenState, NoDrawerOpenState
+
+# (x1, y1, x2, y2) in full-frame pixel coordinates
+Region = tuple[int, int, int, int]
+
+INFERENCE_CALLS = "cabinet_inference_calls_total"
+INFERENCE_CALLS_HELP = "Calls to the tools model"
+# Batched calls serve several stations, so they are counted and timed under station="batch"
+_batch_model_timer = metrics.stage_timer("batch", "model")
+_batch_inference_calls = metrics.registry.counter(INFERENCE_CALLS, INFERENCE_CALLS_HELP, station="batch")
+
+
+@dataclass
+class DetectionResult:
+    """Tracked detections for one frame, shared by the state machine and the annotators."""
+    detections: sv.Detections
+    # Labels in the format "#{tracker_id} {tool}", one per detection
+    labels: list[str] = field(default_factory=list)
+    # Tool detections in the format "{tool} {tracker_id}", where tool is the identified tool id if
+    # there is a ToolIdentifier and it recognised the tool, otherwise the model's class name
+    tool_detection_set: set[str] = field(default_factory=set)
+
+    @property
+    def has_class_names(self) -> bool:
+        return "class_name" in self.detections.data
+
+
+class ToolDetectionStage:
+    """
+    Runs inference and tracking once per frame, and identifies the tracked tools if there is an identifier.
+    The tracker must not be updated anywhere else, otherwise lost_track_buffer is consumed twice as fast.
+    """
+
+    def __init__(self, detector: Detector, tracker: sv.ByteTrack, identifier: ToolIdentifier | None = None, station: str = "main"):
+        self.detector = detector
+        self.tracker = tracker
+        # Identities are cached per track for as long as ByteTrack keeps a lost track around
+        self.identity_cache = TrackIdentityCache(identifier, max_age_frames=tracker.max_time_lost) if identifier is not None else None
+        self.model_timer = metrics.stage_timer(station, "model")
+        self.tracker_timer = metrics.stage_timer(station, "tracker")
+        self.inference_calls = metrics.registry.counter(INFERENCE_CALLS, INFERENCE_CALLS_HELP, station=station)
+        self.skipped_frames = metrics.registry.counter("cabinet_detection_skipped_total", "Frames the scheduler didn't run the model on", station=station)
+
+    def detect(self, frame: np.ndarray, roi: Region | None = None) -> DetectionResult:
+        """
+        Runs the model on the whole frame, or only on `roi` if given.
+        Boxes from a cropped run are shifted back to full-frame coordinates before tracking.
+        """
+        model_input, region = crop_to_region(frame, roi)
+        self.inference_calls.inc()
+        with self.model_timer.time():
+            detections = self.detector.detect(model_input)
+        return self.track(detections, region, frame)
+
+    def track(self, detections: sv.Detections, region: Region | None, frame: np.ndarray) -> DetectionResult:
+        """Advances the tracker with detections the model produced for `region` (None for the full frame) of `frame`."""
+        with self.tracker_timer.time():
+            if region is not None:
+                detections = _shift_to_frame(detections, region, frame.shape)
+            detections = self.tracker.update_with_detections(detections)
+            if self.identity_cache is not None:
+                # Only the model's boxes are used; which tool it is comes from the catalogue
+                matches = self.identity_cache.identify(frame, detections)
+                if len(detections) > 0:
+                    detections.data["tool_id"] = np.array([match.tool.id if match is not None else None for match in matches], dtype=object)
+            return self._build_result(detections)
+
+    def skip(self) -> DetectionResult:
+        """Empty result for a frame the model wasn't run on. The tracker is left where it was."""
+        self.skipped_frames.inc()
+        return DetectionResult(detections=sv.Detections.empty())
+
+    @staticmethod
+    def _build_result(detections: sv.Detections) -> DetectionResult:
+        result = DetectionResult(detections=detections)
+        if "class_name" not in detections.data or detections.tracker_id is None:
+            return result
+
+        tool_ids = detections.data.get("tool_id", [None] * len(detections))
+        for class_name, tool_id, tracker_id in zip(detections.data["class_name"], tool_ids, detections.tracker_id):
+            tool = tool_id if tool_id is not None else class_name
+            result.labels.append(f"#{tracker_id} {tool}")
+            if tracker_id is not None:
+                result.tool_detection_set.add(f"{tool} {tracker_id}")
+        return result
+
+
+def detect_batch(stages: list[ToolDetectionStage], frames: list[np.ndarray], rois: list[Region | None]) -> list[DetectionResult]:
+    """
+    Runs one model call for several stations' frames and tracks each result with its own station's tracker.
+    All stages must share the same detector.
+    """
+    if not stages:
+        return []
+    detector = stages[0].detector
+    assert all(stage.detector is detector for stage in stages), "batched stages must share one detector"
+    model_inputs, regions = zip(*(crop_to_region(frame, roi) for frame, roi in zip(frames, rois)))
+    _batch_inference_calls.inc()
+    with _batch_model_timer.time():
+        batch = detector.detect_batch(list(model_inputs))
+    return [
+        stage.track(detections, region, frame)
+        for stage, detections, region, frame in zip(stages, batch, regions, frames)
+    ]
+
+
+class DetectionScheduler:
+    """
+    Decides per frame whether to run the tools model and on which region.
+
+    - No drawer open: only a heartbeat run every `idle_heartbeat_s` (never if None), which keeps the
+      tracker and the live view from going completely stale.
+    - A drawer open (both while waiting for the initial detection and while watching for check-ins
+      and check-outs): every frame, cropped to that drawer's region if one is configured.
+
+    Args:
+        idle_heartbeat_s: Seconds between runs while no drawer is open, or None to not run at all.
+        drawer_regions: Region of the colour frame to run the model on, per drawer identifier. Drawers without one use the full frame.
+    """
+
+    def __init__(self, idle_heartbeat_s: float | None = 2.0, drawer_regions: dict[str, Region] | None = None):
+        self.idle_heartbeat_s = idle_heartbeat_s
+        self.drawer_regions = drawer_regions or {}
+        self._last_run = float("-inf")
+        # Times of the frames the model was not run on during the last minute
+        self._skipped: deque[float] = deque()
+
+    @classmethod
+    def from_config(cls, path: str = "detection_regions.json") -> "DetectionScheduler":
+        config = json.loads(Path(path).read_text())
+        return cls(
+            idle_heartbeat_s=config.get("idle_heartbeat_s", 2.0),
+            drawer_regions={drawer: tuple(region) for drawer, region in config.get("drawer_regions", {}).items()},
+        )
+
+    def should_run(self, tool_detection_state: DrawerOpenState | NoDrawerOpenState, now: float | None = None) -> bool:
+        """Whether the model should run on this frame. Call once per frame."""
+        now = clock.monotonic() if now is None else now
+        if isinstance(tool_detection_state, DrawerOpenState):
+            run = True
+        else:
+            run = self.idle_heartbeat_s is not None and now - self._last_run >= self.idle_heartbeat_s
+
+        if run:
+            self._last_run = now
+        else:
+            self._skipped.append(now)
+        self._forget_before(now - 60)
+        return run
+
+    def region_for(self, tool_detection_state: DrawerOpenState | NoDrawerOpenState) -> Region | None:
+        """The region to run the model on, or None for the full frame."""
+        if isinstance(tool_detection_state, DrawerOpenState):
+            return self.drawer_regions.get(tool_detection_state.drawer_identifier)
+        return None
+
+    @property
+    def saved_calls_per_minute(self) -> int:
+        """Model calls skipped during the last 60 seconds."""
+        self._forget_before(clock.monotonic() - 60)
+        return len(self._skipped)
+
+    def _forget_before(self, cutoff: float):
+        while self._skipped and self._skipped[0] < cutoff:
+            self._skipped.popleft()
+
+
+def crop_to_region(frame: np.ndarray, roi: Region | None) -> tuple[np.ndarray, Region | None]:
+    """The part of the frame the model should see, and the clipped region it came from (None for the full frame)."""
+    if roi is None:
+        return frame, None
+    x1, y1, x2, y2 = clip_region(roi, frame.shape)
+    return np.ascontiguousarray(frame[y1:y2, x1:x2]), (x1, y1, x2, y2)
+
+
+def clip_region(region: Region, shape: tuple[int, ...]) -> Region:
+    x1, y1, x2, y2 = region
+    height, width = shape[:2]
+    x1, x2 = max(0, min(x1, width)), max(0, min(x2, width))
+    y1, y2 = max(0, min(y1, height)), max(0, min(y2, height))
+    if x2 <= x1 or y2 <= y1:
+        raise ValueError(f"detection region {region} is empty for a {width}x{height} frame")
+    return x1, y1, x2, y2
+
+
+def _shift_to_frame(detections: sv.Detections, region: Region, shape: tuple[int, ...]) -> sv.Detections:
+    """Moves detections from a crop's coordinates back into the full frame."""
+    x1, y1, x2, y2 = region
+    if len(detections) == 0:
+        return detections
+    detections.xyxy = detections.xyxy + np.array([x1, y1, x1, y1], dtype=detections.xyxy.dtype)
+    if detections.mask is not None:
+        mask = np.zeros((len(detections), shape[0], shape[1]), dtype=detections.mask.dtype)
+        mask[:, y1:y2, x1:x2] = detections.mask
+        detections.mask = mask
+    return detections
+
+
+class DetectionAnnotator:
+    """Draws boxes, labels and traces from a DetectionResult without re-running the model."""
+
+    def __init__(self):
+        self.box_annotator = sv.BoxAnnotator()
+        self.label_annotator = sv.LabelAnnotator()
+        self.trace_annotator = sv.TraceAnnotator()
+
+    def annotate(self, frame: np.ndarray, result: DetectionResult, out: np.ndarray | None = None) -> np.ndarray:
+        """
+        Returns an annotated copy of the frame. The input frame is left untouched.
+        Pass `out` (same shape and dtype as frame) to render into a preallocated buffer instead of allocating one.
+        """
+        if out is None:
+            annotated_frame = frame.copy()
+        else:
+            np.copyto(out, frame)
+            annotated_frame = out
+
+        if not result.has_class_names:
+            return annotated_frame
+
+        annotated_frame = self.box_annotator.annotate(
+            annotated_frame, detections=result.detections)
+        annotated_frame = self.label_annotator.annotate(
+            annotated_frame, detections=result.detections, labels=result.labels)
+        return self.trace_annotator.annotate(
+            annotated_frame, detections=result.detections)
+
+
+class FPSCounter:
+    """Frame rate over a rolling window of the last `window` frames."""
+
+    def __init__(self, window: int = 30):
+        self._timestamps: deque[float] = deque(maxlen=window)
+
+    def tick(self):
+        self._timestamps.append(time.perf_counter())
+
+    @property
+    def fps(self) -> float:
+        if len(self._timestamps) < 2:
+            return 0.0
+        elapsed = self._timestamps[-1] - self._timestamps[0]
+        if elapsed <= 0:
+            return 0.0
+        return (len(self._timestamps) - 1) / elapsed
+
+    def draw(self, frame: np.ndarray) -> np.ndarray:
+        """Draws the current frame rate in the top left corner of the frame (in place)."""
+        cv2.putText(frame, f"{self.fps:.1f} FPS", (10, 30), cv2.FONT_HERSHEY_DUPLEX, 1.0, (0, 255, 0), 2)
+        return frame
@@ -1,73 +1,175 @@
-IMAGE_FOLDER_PATH = "/users/json/downloads/limited training data"
-OUTPUT_FOLDER_PATH = IMAGE_FOLDER_PATH + "/_segmented"
-SAM_PATH = "/Users/json/Developer/src/jasonappah/cv-project/embeddding-based-detection/sam-checkpoints/sam_vit_b_01ec64.pth"
-SAM_MODEL_TYPE = "vit_b"
-USE_AUTOMATIC_MASK_GENERATOR = True
-
-import os
-import cv2
-import time
-import pickle
-import numpy as np
-import torch
-from segment_anything import SamPredictor, sam_model_registry, SamAutomaticMaskGenerator
-sam = sam_model_registry[SAM_MODEL_TYPE](checkpoint=SAM_PATH)
-
-if torch.cuda.is_available():
-    print("Using CUDA")
-    sam.to(device="cuda")
-# elif torch.backends.mps.is_available():
-#     print("Using MPS")
-#     sam.to(device="mps")
-
-
-
-if USE_AUTOMATIC_MASK_GENERATOR:
-    mask_generator = SamAutomaticMaskGenerator(sam)
-    predictor = None
-else:
-    predictor = SamPredictor(sam)
-    mask_generator = None
-
-
-
-for image_path in os.listdir(IMAGE_FOLDER_PATH):
-    start_time = time.time()
-    print(f"Processing {image_path}")
-    if not image_path.endswith((".png", ".jpg", ".jpeg")):
-        print(f"Skipping {image_path} because it is not a PNG, JPG, or JPEG file")
-        continue
-
-    image = cv2.imread(os.path.join(IMAGE_FOLDER_PATH, image_path))
-
-    if USE_AUTOMATIC_MASK_GENERATOR:
-        masks = mask_generator.generate(image)
-    else:
-        predictor.set_image(image)
-        masks, _, _ = predictor.predict("get all tools or tool cases in the image")
+"""
+Segments every tool image in a folder with SAM's automatic mask generator.
 
-    end_time = time.time()
-    print(f"Time taken: {end_time - start_time} seconds")
-    
+    python 1-segment-tool-images.py "limited training data" --checkpoint sam-checkpoints/sam_vit_b_01ec64.pth
+    python 1-segment-tool-images.py images/ --checkpoint sam_vit_b_01ec64.pth --workers 3 --max-side 768 --save-crops
 
-    # Ensure output folder exists
-    os.makedirs(OUTPUT_FOLDER_PATH, exist_ok=True)
+Each worker process loads SAM once and takes images off a shared queue. Images are downscaled
+so their longer side is at most --max-side before mask generation, which bounds SAM's memory use
+(its notes below: "guzzling memory"). The masks of every image go into one compact .npz
+(see mask_io.py), cropped to their bounding boxes and run-length encoded.
 
-    for idx, mask in enumerate(masks):
-        # Write each mask as a pickle file
-        mask_path = os.path.join(OUTPUT_FOLDER_PATH, f"{os.path.splitext(image_path)[0]}_mask_{idx}.pkl")
-        with open(mask_path, "wb") as f:
-            pickle.dump(mask, f)
+<output>/manifest.jsonl records every finished image by the SHA-1 of its content and the settings
+it was segmented with, so re-running only processes new or changed images, and a run that was
+interrupted picks up where it stopped.
+"""
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import multiprocessing
+import time
 
-        # Create masked image: keep only segmented region, set rest to 0
-        segmentation = mask["segmentation"]
-        segmented_image = np.zeros_like(image)
-        segmented_image[segmentation] = image[segmentation]
+import cv2
+import numpy as np
 
-        # Save the masked image to disk
-        base_name = os.path.splitext(image_path)[0]
-        output_image_path = os.path.join(OUTPUT_FOLDER_PATH, f"{base_name}_seg_{idx}.png")
-        cv2.imwrite(output_image_path, segmented_image)
+from mask_io import load_masks, save_masks
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+# Loaded once per worker process by load_model()
+mask_generator = None
+torch_module = None
+
+
+def load_model(checkpoint: str, model_type: str, device: str, points_per_side: int, points_per_batch: int):
+    global mask_generator, torch_module
+    import torch
+    from segment_anything import SamAutomaticMaskGenerator, sam_model_registry
+
+    # MPS can't run SAM: "Cannot convert a MPS Tensor to float64 dtype"
+    if device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    sam = sam_model_registry[model_type](checkpoint=checkpoint).to(device=device)
+    mask_generator = SamAutomaticMaskGenerator(sam, points_per_side=points_per_side, points_per_batch=points_per_batch)
+    torch_module = torch
+
+
+def settings_key(args: argparse.Namespace) -> str:
+    """Everything that changes the masks; an image segmented with other settings is done again."""
+    return f"{args.model_type}/max{args.max_side}/pps{args.points_per_side}"
+
+
+def read_manifest(path: Path) -> dict[str, dict]:
+    done = {}
+    if path.exists():
+        for line in path.read_text().splitlines():
+            # The last line may be cut short by an interrupted run
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done[f"{record['sha1']}/{record['settings']}"] = record
+    return done
+
+
+def segment_image(task: tuple[str, str, str, int, str, bool]) -> dict:
+    """Runs in a worker. Returns the manifest record, or one with an "error" for the caller to report."""
+    image_path, sha1, output_path, max_side, settings, save_crops = task
+    start = time.perf_counter()
+    try:
+        image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError("could not read image")
+        scale = min(1.0, max_side / max(image.shape[:2]))
+        processed = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1.0 else image
+        with torch_module.inference_mode():
+            # SAM expects RGB
+            sam_masks = mask_generator.generate(cv2.cvtColor(processed, cv2.COLOR_BGR2RGB))
+        save_masks(output_path, sam_masks, processed.shape[:2], scale)
+        mask_count = len(sam_masks)
+        del sam_masks
+        if save_crops:
+            write_crops(image, output_path)
+    except Exception as e:
+        return {"file": image_path, "error": f"{type(e).__name__}: {e}"}
+    return {
+        "sha1": sha1,
+        "settings": settings,
+        "file": image_path,
+        "output": Path(output_path).name,
+        "masks": mask_count,
+        "scale": round(scale, 6),
+        "seconds": round(time.perf_counter() - start, 2),
+    }
+
+
+def write_crops(image: np.ndarray, masks_path: str):
+    """Masked crops at the original resolution next to the .npz, for looking at the result."""
+    mask_file = load_masks(masks_path)
+    crops_dir = Path(masks_path).with_suffix("")
+    crops_dir.mkdir(exist_ok=True)
+    for position, mask in enumerate(mask_file.masks):
+        cv2.imwrite(str(crops_dir / f"{position:03d}.png"), mask.masked_crop(image, mask_file.scale))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", help="Folder of tool images")
+    parser.add_argument("--output", default=None, help="Output folder (default: <images>/_segmented)")
+    parser.add_argument("--checkpoint", required=True, help="SAM checkpoint, e.g. sam_vit_b_01ec64.pth")
+    parser.add_argument("--model-type", default="vit_b", choices=["vit_b", "vit_l", "vit_h"])
+    parser.add_argument("--device", default="auto", help="cuda, cpu or auto")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes, each holding one SAM model")
+    parser.add_argument("--max-side", type=int, default=1024, help="Downscale images so the longer side is at most this before segmenting")
+    parser.add_argument("--points-per-side", type=int, default=32, help="SAM point grid density (more masks, slower)")
+    parser.add_argument("--points-per-batch", type=int, default=64, help="Points SAM decodes at once; lower it to save memory")
+    parser.add_argument("--save-crops", action="store_true", help="Also write every mask as a cropped PNG")
+    args = parser.parse_args()
+
+    image_dir = Path(args.images)
+    output_dir = Path(args.output) if args.output else image_dir / "_segmented"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = output_dir / "manifest.jsonl"
+    done = read_manifest(manifest_path)
+    settings = settings_key(args)
+
+    tasks = []
+    skipped = 0
+    for image_path in sorted(path for path in image_dir.iterdir() if path.suffix.lower() in IMAGE_EXTENSIONS):
+        sha1 = hashlib.sha1(image_path.read_bytes()).hexdigest()
+        output_path = output_dir / f"{image_path.stem}-{sha1[:12]}.npz"
+        record = done.get(f"{sha1}/{settings}")
+        if record is not None and (output_dir / record["output"]).exists():
+            skipped += 1
+            continue
+        tasks.append((str(image_path), sha1, str(output_path), args.max_side, settings, args.save_crops))
+    print(f"{len(tasks)} images to segment, {skipped} already done ({settings})")
+    if not tasks:
+        return
+
+    model_args = (args.checkpoint, args.model_type, args.device, args.points_per_side, args.points_per_batch)
+    workers = max(1, min(args.workers, len(tasks)))
+    start = time.perf_counter()
+    failed = 0
+    with open(manifest_path, "a") as manifest:
+        if workers == 1:
+            load_model(*model_args)
+            results = map(segment_image, tasks)
+            pool = None
+        else:
+            # Spawned so CUDA and torch's threads start cleanly in every worker
+            pool = multiprocessing.get_context("spawn").Pool(workers, initializer=load_model, initargs=model_args)
+            results = pool.imap_unordered(segment_image, tasks)
+        try:
+            for finished, record in enumerate(results, start=1):
+                if "error" in record:
+                    failed += 1
+                    print(f"[{finished}/{len(tasks)}] {record['file']}: {record['error']}")
+                    continue
+                # One line per finished image, flushed right away so an interrupted run loses nothing
+                manifest.write(json.dumps(record) + "\n")
+                manifest.flush()
+                print(f"[{finished}/{len(tasks)}] {record['file']}: {record['masks']} masks in {record['seconds']}s")
+        finally:
+            if pool is not None:
+                pool.terminate()
+    elapsed = time.perf_counter() - start
+    print(f"segmented {len(tasks) - failed} images in {elapsed:.1f}s with {workers} workers, {failed} failed")
+
+
+if __name__ == "__main__":
+    main()
 
 """
 Observations:
@@ -77,4 +179,4 @@ Observations:
 TypeError: Cannot convert a MPS Tensor to float64 dtype as the MPS framework doesn't support float64. Please use float32 instead.
 ```
 
-"""
\ No newline at end of file
+"""
@@ -0,0 +1,151 @@
+"""
+Embeds the tool segments found by 1-segment-tool-images.py into a searchable dataset.
+
+    python 2-embed-segments.py "limited training data/_segmented"
+    python 2-embed-segments.py images/_segmented --dataset segment_embeddings --batch-size 64 --min-stability 0.95
+
+Images are streamed from <segmented>/manifest.jsonl one at a time: their masks are read from the
+.npz, tiny, huge, thin and low-confidence masks are dropped (see SegmentFilters), and the masked
+crops of the rest are embedded in batches, on the CPU by default. Vectors and one line of metadata
+per vector are appended to the dataset (see segment_dataset.py) and the similarity index is then
+updated with the new vectors only. Images already in the dataset are skipped, so re-running after
+adding a few images costs just those images.
+"""
+from pathlib import Path
+from typing import Iterator
+import argparse
+import json
+import shutil
+import sys
+import time
+
+import cv2
+import numpy as np
+
+# The embedders and vector index live at the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from mask_io import load_masks
+from segment_dataset import SegmentDataset, SegmentFilters
+from tool_identification import EMBEDDER_BACKENDS, load_embedder
+
+
+def read_manifest(path: Path) -> Iterator[dict]:
+    """Finished images, oldest first; the last line may be cut short by an interrupted segmentation run."""
+    with open(path) as manifest:
+        for line in manifest:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def image_segments(record: dict, segmented_dir: Path, filters: SegmentFilters) -> Iterator[tuple[dict, np.ndarray]]:
+    """(metadata, masked crop) of every mask of one image that passes the filters."""
+    image = cv2.imread(record["file"])
+    if image is None:
+        raise ValueError(f"could not read {record['file']}")
+    mask_file = load_masks(segmented_dir / record["output"])
+    image_area = image.shape[0] * image.shape[1]
+    for position, mask in enumerate(mask_file.masks):
+        if not filters.keep(mask.box, mask.area, mask.stability_score, mask.predicted_iou, mask_file.scale, image_area):
+            continue
+        row = {
+            "sha1": record["sha1"],
+            "file": record["file"],
+            "mask": position,
+            # Original image coordinates
+            "box": [int(round(value / mask_file.scale)) for value in mask.box],
+            "area": int(round(mask.area / mask_file.scale ** 2)),
+            "predicted_iou": round(mask.predicted_iou, 4),
+            "stability_score": round(mask.stability_score, 4),
+        }
+        yield row, mask.masked_crop(image, mask_file.scale)
+
+
+def main():
+    defaults = SegmentFilters()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("segmented", help="Output folder of 1-segment-tool-images.py (holds manifest.jsonl)")
+    parser.add_argument("--dataset", default=None, help="Dataset folder (default: <segmented>/../_embedded)")
+    parser.add_argument("--embedder", choices=EMBEDDER_BACKENDS, default="torch")
+    parser.add_argument("--model", default=None, help="Torch hub model name or .onnx file")
+    parser.add_argument("--device", default="cpu", help="cpu, cuda or auto")
+    parser.add_argument("--batch-size", type=int, default=32, help="Crops per embedding batch")
+    parser.add_argument("--min-area", type=int, default=defaults.min_area, help="Smallest mask kept, in original pixels")
+    parser.add_argument("--max-area-fraction", type=float, default=defaults.max_area_fraction, help="Largest mask kept, as a fraction of the image")
+    parser.add_argument("--min-side", type=int, default=defaults.min_side, help="Shortest box side kept, in original pixels")
+    parser.add_argument("--max-aspect", type=float, default=defaults.max_aspect, help="Most elongated box kept (long side / short side)")
+    parser.add_argument("--min-stability", type=float, default=defaults.min_stability, help="Lowest SAM stability score kept")
+    parser.add_argument("--min-iou", type=float, default=defaults.min_predicted_iou, help="Lowest SAM predicted IoU kept")
+    parser.add_argument("--rebuild", action="store_true", help="Delete the dataset and embed everything again")
+    args = parser.parse_args()
+
+    segmented_dir = Path(args.segmented)
+    dataset_dir = Path(args.dataset) if args.dataset else segmented_dir.parent / "_embedded"
+    filters = SegmentFilters(
+        min_area=args.min_area,
+        max_area_fraction=args.max_area_fraction,
+        min_side=args.min_side,
+        max_aspect=args.max_aspect,
+        min_stability=args.min_stability,
+        min_predicted_iou=args.min_iou,
+    )
+    if args.rebuild and dataset_dir.exists():
+        shutil.rmtree(dataset_dir)
+    dataset = SegmentDataset(dataset_dir).load()
+
+    # The last record of an image wins if it was segmented more than once
+    latest = {record["sha1"]: record for record in read_manifest(segmented_dir / "manifest.jsonl")}
+    pending = [record for record in latest.values() if f"{record['sha1']}/{record['settings']}" not in dataset.done]
+    print(f"{len(pending)} images to embed, {len(latest) - len(pending)} already in {dataset_dir} ({dataset.count} vectors)")
+    if not pending:
+        if dataset.indexed < dataset.count:
+            print(dataset.update_index())
+        return
+
+    embedder = load_embedder(args.embedder, args.model, args.device)
+    dataset.open_for_append(embedder.name, filters)
+    start = time.perf_counter()
+    first_new_row = dataset.count
+    crops: list[np.ndarray] = []
+    rows: list[dict] = []
+    # (image key, rows queued once all of its segments are) for images not yet committed
+    unfinished: list[tuple[str, int]] = []
+    queued = dataset.count
+    failed = 0
+
+    def flush(size: int):
+        nonlocal crops, rows
+        if size:
+            dataset.append(embedder.embed_batch(crops[:size]), rows[:size])
+            crops, rows = crops[size:], rows[size:]
+        while unfinished and unfinished[0][1] <= dataset.count:
+            dataset.done.add(unfinished.pop(0)[0])
+        dataset.commit()
+
+    for position, record in enumerate(pending, start=1):
+        try:
+            segments = list(image_segments(record, segmented_dir, filters))
+        except (OSError, ValueError, KeyError) as e:
+            failed += 1
+            print(f"[{position}/{len(pending)}] {record.get('file')}: {type(e).__name__}: {e}")
+            continue
+        for row, crop in segments:
+            rows.append(row)
+            crops.append(crop)
+        queued += len(segments)
+        unfinished.append((f"{record['sha1']}/{record['settings']}", queued))
+        print(f"[{position}/{len(pending)}] {record['file']}: kept {len(segments)} of {record['masks']} masks")
+        while len(crops) >= args.batch_size:
+            flush(args.batch_size)
+    flush(len(crops))
+
+    elapsed = time.perf_counter() - start
+    added = dataset.count - first_new_row
+    print(f"embedded {added} segments of {len(pending) - failed} images in {elapsed:.1f}s ({added / max(elapsed, 1e-9):.1f}/s), {failed} failed")
+    print(dataset.update_index())
+
+
+if __name__ == "__main__":
+    main()
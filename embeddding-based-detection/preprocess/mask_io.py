@@ -0,0 +1,112 @@
+"""
+Compact storage for the SAM masks written by 1-segment-tool-images.py.
+
+One .npz per image holds every mask cropped to its bounding box and run-length encoded:
+- `boxes`: (N, 4) int32 (x1, y1, x2, y2), exclusive x2/y2, in the coordinates of the processed (downscaled) image
+- `rle_counts`: all masks' run lengths back to back (uint32, row-major, each mask starts with a run of zeros)
+- `rle_offsets`: (N + 1,) int64; mask i's runs are rle_counts[rle_offsets[i]:rle_offsets[i + 1]]
+- `area`, `predicted_iou`, `stability_score`: (N,) per-mask values from SAM
+- `scale`: processed size / original size, `image_shape`: (height, width) of the processed image
+"""
+from dataclasses import dataclass
+from pathlib import Path
+import os
+
+import cv2
+import numpy as np
+
+
+def rle_encode(mask: np.ndarray) -> np.ndarray:
+    """Row-major run lengths of a boolean mask, starting with the (possibly empty) run of False."""
+    flat = np.ascontiguousarray(mask, dtype=bool).ravel()
+    # Positions where the value changes, plus both ends
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    boundaries = np.concatenate(([0], changes, [flat.size]))
+    counts = np.diff(boundaries)
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return counts.astype(np.uint32)
+
+
+def rle_decode(counts: np.ndarray, shape: tuple[int, int]) -> np.ndarray:
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+    return np.repeat(values, counts.astype(np.int64)).reshape(shape)
+
+
+@dataclass
+class SegmentMask:
+    # (x1, y1, x2, y2) in processed image coordinates, x2/y2 exclusive
+    box: tuple[int, int, int, int]
+    # Boolean mask of the box only
+    mask: np.ndarray
+    area: int
+    predicted_iou: float
+    stability_score: float
+
+    def masked_crop(self, image: np.ndarray, scale: float = 1.0) -> np.ndarray:
+        """
+        The masked region of `image` cropped to the box, background set to 0. Pass the image at its original
+        size together with the file's `scale`; the crop is then taken from the original resolution.
+        """
+        x1, y1, x2, y2 = (int(round(value / scale)) for value in self.box)
+        crop = image[y1:y2, x1:x2].copy()
+        mask = self.mask if scale == 1.0 else cv2.resize(self.mask.astype(np.uint8), (crop.shape[1], crop.shape[0]), interpolation=cv2.INTER_NEAREST).astype(bool)
+        crop[~mask] = 0
+        return crop
+
+
+@dataclass
+class MaskFile:
+    masks: list[SegmentMask]
+    scale: float
+    image_shape: tuple[int, int]
+
+
+def save_masks(path: str | Path, sam_masks: list[dict], image_shape: tuple[int, int], scale: float):
+    """Writes the output of SamAutomaticMaskGenerator.generate() for one image, atomically."""
+    boxes = np.zeros((len(sam_masks), 4), dtype=np.int32)
+    runs = []
+    for position, sam_mask in enumerate(sam_masks):
+        segmentation = sam_mask["segmentation"]
+        ys, xs = np.nonzero(segmentation)
+        if len(xs) == 0:
+            runs.append(np.zeros(0, dtype=np.uint32))
+            continue
+        x1, y1, x2, y2 = int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1
+        boxes[position] = (x1, y1, x2, y2)
+        runs.append(rle_encode(segmentation[y1:y2, x1:x2]))
+    offsets = np.zeros(len(runs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(run) for run in runs])
+
+    path = Path(path)
+    # np.savez appends .npz to names without it, so give the temporary file the suffix too
+    temporary_path = path.with_name(f".{path.stem}.tmp.npz")
+    np.savez_compressed(
+        temporary_path,
+        boxes=boxes,
+        rle_counts=np.concatenate(runs) if runs else np.zeros(0, dtype=np.uint32),
+        rle_offsets=offsets,
+        area=np.array([sam_mask["area"] for sam_mask in sam_masks], dtype=np.int64),
+        predicted_iou=np.array([sam_mask["predicted_iou"] for sam_mask in sam_masks], dtype=np.float32),
+        stability_score=np.array([sam_mask["stability_score"] for sam_mask in sam_masks], dtype=np.float32),
+        scale=np.float64(scale),
+        image_shape=np.array(image_shape[:2], dtype=np.int64),
+    )
+    os.replace(temporary_path, path)
+
+
+def load_masks(path: str | Path) -> MaskFile:
+    with np.load(path) as data:
+        boxes, counts, offsets = data["boxes"], data["rle_counts"], data["rle_offsets"]
+        masks = [
+            SegmentMask(
+                box=tuple(int(value) for value in box),
+                mask=rle_decode(counts[offsets[position]:offsets[position + 1]], (int(box[3] - box[1]), int(box[2] - box[0]))),
+                area=int(data["area"][position]),
+                predicted_iou=float(data["predicted_iou"][position]),
+                stability_score=float(data["stability_score"][position]),
+            )
+            for position, box in enumerate(boxes)
+        ]
+        return MaskFile(masks=masks, scale=float(data["scale"]), image_shape=tuple(int(value) for value in data["image_shape"]))
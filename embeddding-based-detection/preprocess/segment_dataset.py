@@ -0,0 +1,176 @@
+"""
+On-disk dataset of segment embeddings written by 2-embed-segments.py.
+
+One folder holds:
+- `vectors.f32`: float32 embeddings back to back, appended batch by batch and read back through np.memmap
+- `rows.jsonl`: one line of metadata per vector (source image, mask position, box, area, SAM scores)
+- `state.json`: embedder, dimensions and filters the dataset was built with, the number of committed rows,
+  how many of them are in the index, and the images already embedded
+- `ivf.npz`: the IVF index over the vectors (vector_index.IVFIndex.save), once there are enough of them;
+  smaller datasets are searched exactly and need no file
+
+state.json is replaced after the vectors and rows it counts are written, so after an interrupted run the
+files are cut back to its row count and the unfinished images are embedded again.
+"""
+from dataclasses import dataclass
+from pathlib import Path
+import json
+import os
+
+import numpy as np
+
+from vector_index import IVFIndex, VectorIndex, make_index
+
+# Retrain the IVF centroids once the dataset has grown this much past what they were trained on
+RETRAIN_GROWTH = 2.0
+
+
+@dataclass
+class SegmentFilters:
+    """Masks kept for embedding; areas and sides are in pixels of the original image."""
+
+    min_area: int = 1024
+    # Drops the background and table masks SAM returns alongside the tools
+    max_area_fraction: float = 0.5
+    min_side: int = 16
+    # Longer box side / shorter box side; thin slivers along edges and shadows
+    max_aspect: float = 8.0
+    min_stability: float = 0.92
+    min_predicted_iou: float = 0.85
+
+    def keep(self, box: tuple[int, int, int, int], area: int, stability_score: float, predicted_iou: float, scale: float, image_area: int) -> bool:
+        """`box` and `area` are in processed (downscaled) image coordinates, as stored by mask_io."""
+        width, height = (box[2] - box[0]) / scale, (box[3] - box[1]) / scale
+        original_area = area / (scale * scale)
+        if min(width, height) < self.min_side or max(width, height) > self.max_aspect * min(width, height):
+            return False
+        if original_area < self.min_area or original_area > self.max_area_fraction * image_area:
+            return False
+        return stability_score >= self.min_stability and predicted_iou >= self.min_predicted_iou
+
+
+class SegmentDataset:
+    def __init__(self, dataset_dir: str | Path):
+        self.dataset_dir = Path(dataset_dir)
+        self.vectors_path = self.dataset_dir / "vectors.f32"
+        self.rows_path = self.dataset_dir / "rows.jsonl"
+        self.state_path = self.dataset_dir / "state.json"
+        self.index_path = self.dataset_dir / "ivf.npz"
+        self.embedder: str | None = None
+        self.dimensions = 0
+        self.filters: dict = {}
+        self.count = 0
+        self.indexed = 0
+        # "<sha1>/<segmentation settings>" of every image whose segments are all in the committed rows
+        self.done: set[str] = set()
+
+    def load(self) -> "SegmentDataset":
+        if self.state_path.exists():
+            state = json.loads(self.state_path.read_text())
+            self.embedder = state["embedder"]
+            self.dimensions = state["dimensions"]
+            self.filters = state["filters"]
+            self.count = state["count"]
+            self.indexed = state["indexed"]
+            self.done = set(state["done"])
+        return self
+
+    def open_for_append(self, embedder: str, filters: SegmentFilters):
+        """Checks the dataset was built the same way and drops anything written after the last committed state."""
+        filter_settings = vars(filters).copy()
+        if self.embedder is not None and (self.embedder != embedder or self.filters != filter_settings):
+            raise ValueError(
+                f"{self.dataset_dir} was built with embedder {self.embedder} and filters {self.filters}; "
+                "use the same settings, another --dataset or --rebuild"
+            )
+        self.embedder = embedder
+        self.filters = filter_settings
+        self.dataset_dir.mkdir(parents=True, exist_ok=True)
+        if self.vectors_path.exists():
+            with open(self.vectors_path, "r+b") as vectors_file:
+                vectors_file.truncate(self.count * self.dimensions * 4)
+        if self.rows_path.exists():
+            with open(self.rows_path, "rb") as rows_file:
+                lines = rows_file.readlines()
+            if len(lines) != self.count or (lines and not lines[-1].endswith(b"\n")):
+                with open(self.rows_path, "wb") as rows_file:
+                    rows_file.writelines(lines[:self.count])
+
+    def append(self, embeddings: np.ndarray, rows: list[dict]):
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if self.dimensions == 0:
+            self.dimensions = embeddings.shape[1]
+        elif embeddings.shape[1] != self.dimensions:
+            raise ValueError(f"expected {self.dimensions}-dimensional embeddings, got {embeddings.shape[1]}")
+        with open(self.vectors_path, "ab") as vectors_file:
+            vectors_file.write(embeddings.tobytes())
+        with open(self.rows_path, "a") as rows_file:
+            rows_file.writelines(json.dumps(row) + "\n" for row in rows)
+        self.count += len(rows)
+
+    def commit(self):
+        """Atomically records the current row count, index size and finished images."""
+        temporary_path = self.state_path.with_name(f".{self.state_path.name}.tmp")
+        temporary_path.write_text(json.dumps({
+            "embedder": self.embedder,
+            "dimensions": self.dimensions,
+            "filters": self.filters,
+            "count": self.count,
+            "indexed": self.indexed,
+            "done": sorted(self.done),
+        }))
+        os.replace(temporary_path, self.state_path)
+
+    def vectors(self) -> np.ndarray:
+        """The committed vectors, memory-mapped read-only."""
+        if self.count == 0:
+            return np.zeros((0, self.dimensions), dtype=np.float32)
+        return np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.count, self.dimensions))
+
+    def rows(self) -> list[dict]:
+        if not self.rows_path.exists():
+            return []
+        with open(self.rows_path) as rows_file:
+            return [json.loads(line) for _, line in zip(range(self.count), rows_file)]
+
+    def update_index(self) -> str:
+        """
+        Brings the index up to date with the committed vectors: new vectors are added to the saved IVF
+        index, which is only retrained once the dataset has outgrown its centroids. Returns what was done.
+        """
+        vectors = self.vectors()
+        if not isinstance(make_index(self.count), IVFIndex):
+            self.index_path.unlink(missing_ok=True)
+            self.indexed = self.count
+            self.commit()
+            return f"{self.count} vectors, searched exactly"
+        action = "built"
+        index = None
+        if self.index_path.exists() and 0 < self.indexed <= self.count:
+            try:
+                index = IVFIndex.load(self.index_path, vectors[:self.indexed])
+            except ValueError as e:
+                print(f"rebuilding the index: {e}")
+                index = None
+            if index is not None and index.trained_size * RETRAIN_GROWTH < self.count:
+                action = "retrained"
+                index = None
+        if index is None:
+            index = make_index(self.count)
+            index.build(vectors)
+        else:
+            action = f"added {self.count - self.indexed} vectors to"
+            index.add(vectors[self.indexed:])
+        index.save(self.index_path)
+        self.indexed = self.count
+        self.commit()
+        return f"{action} the IVF index over {self.count} vectors"
+
+    def load_index(self) -> VectorIndex:
+        """The similarity index over the committed vectors, for searching."""
+        vectors = self.vectors()
+        if self.index_path.exists() and self.indexed == self.count and self.count:
+            return IVFIndex.load(self.index_path, vectors)
+        index = make_index(self.count)
+        index.build(vectors)
+        return index
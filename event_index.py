@@ -0,0 +1,162 @@
+"""
+Secondary indexes over InventoryStateManager.event_log for paginated, filtered queries.
+"""
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Iterable, Literal, Sequence
+
+if TYPE_CHECKING:
+    from tool_state import InventoryUpdateLogEntry
+
+
+@dataclass
+class EventQuery:
+    user_id: str | None = None
+    tool: str | None = None
+    event_type: str | None = None
+    # Inclusive bounds on InventoryUpdateLogEntry.timestamp (unix seconds)
+    since: int | None = None
+    until: int | None = None
+    # Opaque cursor returned as next_cursor by the previous page; it names an event by its sequence number
+    # (its position in the whole history), so it stays valid across restarts
+    cursor: str | None = None
+    limit: int | None = None
+    order: Literal["asc", "desc"] = "asc"
+
+
+@dataclass
+class EventPage:
+    events: list["InventoryUpdateLogEntry"] = field(default_factory=list)
+    # Pass back as EventQuery.cursor to get the next page, None on the last page
+    next_cursor: str | None = None
+
+
+class EventLogIndex:
+    """
+    Position lists into the append-only event log, keyed by user id, tool id and event type,
+    plus the timestamp of every position for time-range lookups.
+
+    Every list is sorted by position because entries are only ever appended, so a query bisects
+    to its bounds and walks the smallest matching list: the cost depends on the page size, not on
+    how long the log is.
+    """
+
+    def __init__(self):
+        self.by_user: defaultdict[str, list[int]] = defaultdict(list)
+        self.by_tool: defaultdict[str, list[int]] = defaultdict(list)
+        self.by_type: defaultdict[str, list[int]] = defaultdict(list)
+        # Timestamp per position; appended in time order so it stays sorted
+        self.timestamps: list[int] = []
+        # Sequence number of position 0: how many older events the log in memory doesn't hold
+        self.first_sequence = 0
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def add(self, position: int, entry: "InventoryUpdateLogEntry"):
+        assert position == len(self.timestamps), "event log entries must be indexed in append order"
+        # Guard against the wall clock stepping backwards so timestamps stays sorted
+        timestamp = max(entry.timestamp, self.timestamps[-1]) if self.timestamps else entry.timestamp
+        self.timestamps.append(timestamp)
+        if entry.user is not None:
+            self.by_user[entry.user.id].append(position)
+        if entry.tool is not None:
+            self.by_tool[entry.tool.id].append(position)
+        self.by_type[entry.type].append(position)
+
+    def rebuild(self, events: Sequence["InventoryUpdateLogEntry"], first_sequence: int = 0):
+        self.__init__()
+        self.first_sequence = first_sequence
+        for position, entry in enumerate(events):
+            self.add(position, entry)
+
+    def query(self, events: Sequence["InventoryUpdateLogEntry"], query: EventQuery) -> EventPage:
+        # Narrow everything down to a [start, stop) window of positions first; the log and the index are
+        # appended to from the camera thread while this runs, so only read positions both already have
+        start, stop = 0, min(len(self.timestamps), len(events))
+        if query.since is not None:
+            start = max(start, bisect_left(self.timestamps, query.since))
+        if query.until is not None:
+            stop = min(stop, bisect_right(self.timestamps, query.until))
+        if query.cursor is not None:
+            cursor_position = decode_cursor(query.cursor) - self.first_sequence
+            if query.order == "asc":
+                start = max(start, cursor_position)
+            else:
+                stop = min(stop, cursor_position + 1)
+        if start >= stop:
+            return EventPage()
+
+        # Walk the most selective index; check the remaining filters on the entries themselves
+        candidate_lists = []
+        if query.user_id is not None:
+            candidate_lists.append(self.by_user.get(query.user_id, []))
+        if query.tool is not None:
+            candidate_lists.append(self.by_tool.get(query.tool, []))
+        if query.event_type is not None:
+            candidate_lists.append(self.by_type.get(query.event_type, []))
+        if candidate_lists:
+            driver = min(candidate_lists, key=len)
+            positions = driver[bisect_left(driver, start):bisect_left(driver, stop)]
+        else:
+            positions = range(start, stop)
+        if query.order == "desc":
+            positions = reversed(positions)
+
+        page = EventPage()
+        for position in positions:
+            entry = events[position]
+            if not _matches(entry, query):
+                continue
+            if query.limit is not None and len(page.events) == query.limit:
+                page.next_cursor = encode_cursor(self.first_sequence + position)
+                break
+            page.events.append(entry)
+        return page
+
+
+def query_scanned(scanned: Iterable[tuple[int, "InventoryUpdateLogEntry"]], query: EventQuery, limit: int | None) -> EventPage:
+    """
+    One page of events that aren't in memory, from (sequence number, entry) pairs read from disk in
+    query.order (EventStore.scan_events). Cursor bounds are the caller's job; `limit` replaces query.limit
+    so the page can continue one started in memory.
+    """
+    page = EventPage()
+    for sequence, entry in scanned:
+        # Events are logged in time order, so once past the time range nothing further matches
+        if query.since is not None and entry.timestamp < query.since:
+            if query.order == "desc":
+                break
+            continue
+        if query.until is not None and entry.timestamp > query.until:
+            if query.order == "asc":
+                break
+            continue
+        if not _matches(entry, query):
+            continue
+        if limit is not None and len(page.events) == limit:
+            page.next_cursor = encode_cursor(sequence)
+            break
+        page.events.append(entry)
+    return page
+
+
+def _matches(entry: "InventoryUpdateLogEntry", query: EventQuery) -> bool:
+    if query.user_id is not None and (entry.user is None or entry.user.id != query.user_id):
+        return False
+    if query.tool is not None and (entry.tool is None or entry.tool.id != query.tool):
+        return False
+    if query.event_type is not None and entry.type != query.event_type:
+        return False
+    return True
+
+
+def encode_cursor(sequence: int) -> str:
+    return f"p{sequence}"
+
+
+def decode_cursor(cursor: str) -> int:
+    if not cursor.startswith("p") or not cursor[1:].isdigit():
+        raise ValueError(f"invalid cursor {cursor!r}")
+    return int(cursor[1:])
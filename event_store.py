@@ -0,0 +1,301 @@
+"""
+Persistence for InventoryStateManager: an append-only JSON-lines log plus periodic snapshots.
+
+Records are appended by the camera thread without blocking (they go onto a queue) and written by
+a background thread in batches, with a configurable fsync policy. The writer keeps its own copy of
+the aggregate state by applying each record it writes, so every snapshot is consistent with the
+log offset it records. Recovery loads the newest snapshot and replays only the log written after
+it, so restoring the inventory depends on the snapshot interval, not on total history. The snapshot
+only carries the most recent events; older ones stay on disk and are read on demand with
+scan_events(), through the byte offset of every EVENT_OFFSET_STRIDE-th event kept in the snapshot.
+"""
+from collections import deque
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Any, Iterator, Literal
+import json
+import os
+import queue
+import threading
+import time
+
+from tool_state import InventoryAggregates, InventoryUpdateLogEntry, Tool, User
+
+FsyncPolicy = Literal["always", "interval", "never"]
+
+EVENT_RECORD_PREFIX = b'{"kind": "event"'
+
+# Every this many events, the log offset of the event record is kept, so reading an old event
+# means seeking to the closest offset before it and skipping at most this many event records
+EVENT_OFFSET_STRIDE = 1000
+
+SNAPSHOT_VERSION = 3
+
+
+@dataclass
+class RecoveredState:
+    """Everything InventoryStateManager needs to resume where the previous run stopped."""
+    inventory: dict[str, dict[str, int]] = field(default_factory=dict)
+    drawer_state: dict[str, bool] = field(default_factory=dict)
+    aggregates: InventoryAggregates = field(default_factory=InventoryAggregates)
+    # Most recent events, oldest first, at most EventStore.retain_events of them
+    recent_events: deque[InventoryUpdateLogEntry] = field(default_factory=deque)
+    # Every event ever applied, including the ones trimmed from recent_events
+    events_total: int = 0
+    # Log offset of event number i * EVENT_OFFSET_STRIDE (numbered from 0 over the whole history)
+    event_offsets: list[int] = field(default_factory=list)
+    records_applied: int = 0
+
+    def apply(self, record: dict[str, Any], log_offset: int):
+        """Applies one record, written to the log at `log_offset`."""
+        kind = record["kind"]
+        if kind == "inventory":
+            drawers = self.inventory.setdefault(record["tool"], {})
+            drawers[record["drawer"]] = drawers.get(record["drawer"], 0) + record["delta"]
+            self.aggregates.apply_inventory_delta(record["delta"])
+        elif kind == "event":
+            entry = entry_from_dict(record["entry"])
+            if self.events_total % EVENT_OFFSET_STRIDE == 0:
+                self.event_offsets.append(log_offset)
+            self.recent_events.append(entry)
+            self.events_total += 1
+            self.aggregates.apply_event(entry)
+        elif kind == "drawer_state":
+            self.drawer_state[record["drawer"]] = record["value"]
+        else:
+            raise ValueError(f"unknown record kind {kind!r}")
+        self.records_applied += 1
+
+
+def entry_from_dict(data: dict[str, Any]) -> InventoryUpdateLogEntry:
+    return InventoryUpdateLogEntry(
+        id=data["id"],
+        timestamp=data["timestamp"],
+        type=data["type"],
+        user=User(**data["user"]) if data["user"] is not None else None,
+        tool=Tool(**data["tool"]) if data["tool"] is not None else None,
+        eventImageUrl=data["eventImageUrl"],
+    )
+
+
+class EventStore:
+    """
+    Args:
+        directory: Where events.jsonl and snapshot.json live.
+        fsync: "always" fsyncs after every batch, "interval" at most every fsync_interval_s, "never" leaves it to the OS.
+        batch_size: Maximum records per write.
+        flush_interval_s: How long the writer waits to fill a batch before writing what it has.
+        snapshot_every: Write a snapshot after this many records.
+        retain_events: How many of the most recent events are kept in the snapshot and loaded on startup. Older
+            events are read from the log when a query reaches them (scan_events). Larger snapshots are slower
+            to rewrite; smaller ones send more queries to disk.
+    """
+
+    def __init__(
+        self,
+        directory: str = "data",
+        fsync: FsyncPolicy = "interval",
+        fsync_interval_s: float = 1.0,
+        batch_size: int = 64,
+        flush_interval_s: float = 0.2,
+        snapshot_every: int = 500,
+        retain_events: int = 10000,
+    ):
+        self.directory = Path(directory)
+        self.fsync = fsync
+        self.fsync_interval_s = fsync_interval_s
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.snapshot_every = snapshot_every
+        self.retain_events = retain_events
+
+        self.log_path = self.directory / "events.jsonl"
+        self.snapshot_path = self.directory / "snapshot.json"
+
+        self._queue: queue.Queue[dict[str, Any] | None] = queue.Queue()
+        self._writer: threading.Thread | None = None
+        self._state: RecoveredState | None = None
+        self._records_since_snapshot = 0
+        self._last_fsync = 0.0
+
+    def recover(self) -> RecoveredState:
+        """Loads the latest snapshot, replays the log written after it and starts the writer thread."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        start = time.perf_counter()
+        state, log_offset = self._load_snapshot()
+
+        replayed = 0
+        valid_end = log_offset
+        if self.log_path.exists():
+            with open(self.log_path, "rb") as log:
+                log.seek(log_offset)
+                for line in log:
+                    if not line.endswith(b"\n"):
+                        # Torn write from a crash; everything after the last full line is dropped
+                        break
+                    state.apply(json.loads(line), valid_end)
+                    valid_end += len(line)
+                    replayed += 1
+            # Cut off a torn tail so new records start on a clean line
+            if valid_end < self.log_path.stat().st_size:
+                os.truncate(self.log_path, valid_end)
+
+        self._trim_events(state)
+        self._state = state
+        self._records_since_snapshot = replayed
+        print(
+            f"event store: recovered {len(state.recent_events)} of {state.events_total} events "
+            f"in {1000 * (time.perf_counter() - start):.0f}ms ({replayed} records replayed after the snapshot)"
+        )
+
+        self._writer = threading.Thread(target=self._run_writer, name="event-store-writer", daemon=True)
+        self._writer.start()
+        return state
+
+    def scan_events(self, start: int, stop: int, order: Literal["asc", "desc"] = "asc") -> Iterator[tuple[int, InventoryUpdateLogEntry]]:
+        """
+        (sequence number, event) of the logged events numbered [start, stop), read lazily from the log.
+        Descending scans read one EVENT_OFFSET_STRIDE block at a time, newest block first.
+        """
+        offsets = self._state.event_offsets if self._state is not None else []
+        stop = min(stop, self._state.events_total if self._state is not None else 0)
+        if start >= stop:
+            return
+        if order == "asc":
+            yield from self._read_block(offsets, start, stop)
+            return
+        block_start = (stop - 1) // EVENT_OFFSET_STRIDE * EVENT_OFFSET_STRIDE
+        while stop > start:
+            block_start = max(block_start, start)
+            yield from reversed(list(self._read_block(offsets, block_start, stop)))
+            stop = block_start
+            block_start -= EVENT_OFFSET_STRIDE
+
+    def _read_block(self, offsets: list[int], start: int, stop: int) -> Iterator[tuple[int, InventoryUpdateLogEntry]]:
+        block = start // EVENT_OFFSET_STRIDE
+        if block >= len(offsets):
+            return
+        sequence = block * EVENT_OFFSET_STRIDE
+        with open(self.log_path, "rb") as log:
+            log.seek(offsets[block])
+            for line in log:
+                # append_event writes the kind first, so other records are skipped without parsing them
+                if not line.startswith(EVENT_RECORD_PREFIX):
+                    continue
+                if sequence >= start:
+                    yield sequence, entry_from_dict(json.loads(line)["entry"])
+                sequence += 1
+                if sequence >= stop:
+                    return
+
+    def append(self, record: dict[str, Any]):
+        """Queues a record for the writer thread. Never blocks on disk."""
+        self._queue.put(record)
+
+    def append_event(self, entry: InventoryUpdateLogEntry):
+        self.append({"kind": "event", "entry": asdict(entry)})
+
+    def append_inventory_change(self, tool_class: str, drawer_identifier: str, delta: int):
+        self.append({"kind": "inventory", "tool": tool_class, "drawer": drawer_identifier, "delta": delta})
+
+    def append_drawer_state(self, drawer_identifier: str, value: bool):
+        self.append({"kind": "drawer_state", "drawer": drawer_identifier, "value": value})
+
+    def close(self):
+        """Flushes everything queued so far, writes a final snapshot and stops the writer."""
+        if self._writer is None:
+            return
+        self._queue.put(None)
+        self._writer.join()
+        self._writer = None
+
+    def _run_writer(self):
+        with open(self.log_path, "ab") as log:
+            stopping = False
+            while not stopping:
+                batch, stopping = self._next_batch()
+                if batch:
+                    lines = [json.dumps(record).encode("utf-8") + b"\n" for record in batch]
+                    log_offset = log.tell()
+                    log.write(b"".join(lines))
+                    log.flush()
+                    for record, line in zip(batch, lines):
+                        self._state.apply(record, log_offset)
+                        log_offset += len(line)
+                    self._records_since_snapshot += len(batch)
+                    self._maybe_fsync(log)
+                if self._records_since_snapshot >= self.snapshot_every or (stopping and self._records_since_snapshot):
+                    os.fsync(log.fileno())
+                    self._write_snapshot(log.tell())
+
+    def _next_batch(self) -> tuple[list[dict[str, Any]], bool]:
+        """Blocks for the first record, then gathers more for up to flush_interval_s. Returns (batch, stopping)."""
+        batch = []
+        first = self._queue.get()
+        if first is None:
+            return batch, True
+        batch.append(first)
+        deadline = time.monotonic() + self.flush_interval_s
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                record = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if record is None:
+                return batch, True
+            batch.append(record)
+        return batch, False
+
+    def _maybe_fsync(self, log):
+        if self.fsync == "always":
+            os.fsync(log.fileno())
+        elif self.fsync == "interval" and time.monotonic() - self._last_fsync >= self.fsync_interval_s:
+            os.fsync(log.fileno())
+            self._last_fsync = time.monotonic()
+
+    def _write_snapshot(self, log_offset: int):
+        state = self._state
+        self._trim_events(state)
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "log_offset": log_offset,
+            "records_applied": state.records_applied,
+            "inventory": state.inventory,
+            "drawer_state": state.drawer_state,
+            "aggregates": state.aggregates.to_dict(),
+            "events_total": state.events_total,
+            "event_offsets": state.event_offsets,
+            "recent_events": [asdict(entry) for entry in state.recent_events],
+        }
+        temporary_path = self.snapshot_path.with_suffix(".tmp")
+        with open(temporary_path, "w") as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+            snapshot_file.flush()
+            os.fsync(snapshot_file.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+        self._records_since_snapshot = 0
+
+    def _load_snapshot(self) -> tuple[RecoveredState, int]:
+        if not self.snapshot_path.exists():
+            return RecoveredState(), 0
+        snapshot = json.loads(self.snapshot_path.read_text())
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            print(f"event store: ignoring snapshot with unknown version {snapshot.get('version')}, replaying the full log")
+            return RecoveredState(), 0
+        state = RecoveredState(
+            inventory=snapshot["inventory"],
+            drawer_state=snapshot["drawer_state"],
+            aggregates=InventoryAggregates.from_dict(snapshot["aggregates"]),
+            recent_events=deque(entry_from_dict(entry) for entry in snapshot["recent_events"]),
+            events_total=snapshot["events_total"],
+            event_offsets=snapshot["event_offsets"],
+            records_applied=snapshot["records_applied"],
+        )
+        return state, snapshot["log_offset"]
+
+    def _trim_events(self, state: RecoveredState):
+        while len(state.recent_events) > self.retain_events:
+            state.recent_events.popleft()
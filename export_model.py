@@ -0,0 +1,91 @@
+"""
+Exports the tools model for a CPU backend and checks its detections against the PyTorch model.
+
+    python export_model.py --format onnx
+    python export_model.py --format openvino --images path/to/frames --iou 0.9 --conf-tolerance 0.05
+    python export_model.py --format onnx --dynamic   # batch size chosen at run time, for multi_station.py
+
+Frames for the comparison are read from --images (every .jpg/.png in it); without it a few frames
+are grabbed from the Kinect. The script exits with status 1 if any detection has no counterpart of
+the same class with at least --iou overlap and a confidence within --conf-tolerance.
+"""
+from pathlib import Path
+import argparse
+import sys
+
+import cv2
+import numpy as np
+import supervision as sv
+
+from inference_backends import DEFAULT_WEIGHTS, UltralyticsDetector, exported_path, load_detector
+
+
+def load_frames(images: str | None, count: int) -> list[np.ndarray]:
+    if images is not None:
+        paths = sorted(path for path in Path(images).iterdir() if path.suffix.lower() in (".jpg", ".jpeg", ".png"))
+        return [cv2.imread(str(path)) for path in paths[:count]]
+
+    import freenect
+
+    frames = []
+    for _ in range(count):
+        frame, _ = freenect.sync_get_video()
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+    return frames
+
+
+def compare(reference: sv.Detections, candidate: sv.Detections, iou: float, conf_tolerance: float) -> list[str]:
+    """Greedily pairs detections of the same class by IoU; returns a description of every mismatch."""
+    problems = []
+    unmatched = set(range(len(candidate)))
+    overlaps = sv.box_iou_batch(reference.xyxy, candidate.xyxy) if len(reference) and len(candidate) else np.zeros((len(reference), len(candidate)))
+    for row in np.argsort(-reference.confidence) if len(reference) else []:
+        name = reference.data["class_name"][row]
+        best, best_overlap = None, iou
+        for column in unmatched:
+            if candidate.data["class_name"][column] == name and overlaps[row, column] >= best_overlap:
+                best, best_overlap = column, overlaps[row, column]
+        if best is None:
+            problems.append(f"missing {name} ({reference.confidence[row]:.2f}) at {np.round(reference.xyxy[row]).astype(int).tolist()}")
+            continue
+        unmatched.discard(best)
+        if abs(reference.confidence[row] - candidate.confidence[best]) > conf_tolerance:
+            problems.append(f"{name} confidence {reference.confidence[row]:.2f} vs {candidate.confidence[best]:.2f}")
+    for column in sorted(unmatched):
+        problems.append(f"extra {candidate.data['class_name'][column]} ({candidate.confidence[column]:.2f})")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--weights", default=DEFAULT_WEIGHTS)
+    parser.add_argument("--format", choices=["onnx", "openvino"], default="onnx")
+    parser.add_argument("--imgsz", type=int, default=480)
+    parser.add_argument("--dynamic", action="store_true", help="Export with a dynamic batch size so several stations share one model call")
+    parser.add_argument("--images", default=None, help="Directory of frames to compare on (default: grab from the Kinect)")
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--iou", type=float, default=0.9, help="Minimum IoU between matching boxes")
+    parser.add_argument("--conf-tolerance", type=float, default=0.05)
+    parser.add_argument("--skip-export", action="store_true", help="Only compare an existing export")
+    args = parser.parse_args()
+
+    reference_detector = UltralyticsDetector(args.weights)
+    if not args.skip_export:
+        exported = reference_detector.model.export(format=args.format, imgsz=args.imgsz, dynamic=args.dynamic)
+        print(f"exported {exported}")
+    candidate_detector = load_detector(args.format, exported_path(args.weights, args.format))
+
+    frames = load_frames(args.images, args.frames)
+    mismatched_frames = 0
+    for index, frame in enumerate(frames):
+        problems = compare(reference_detector.detect(frame), candidate_detector.detect(frame), args.iou, args.conf_tolerance)
+        if problems:
+            mismatched_frames += 1
+            print(f"frame {index}: " + "; ".join(problems))
+
+    print(f"{len(frames) - mismatched_frames}/{len(frames)} frames match (IoU >= {args.iou}, confidence within {args.conf_tolerance})")
+    sys.exit(1 if mismatched_frames else 0)
+
+
+if __name__ == "__main__":
+    main()
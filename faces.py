@@ -0,0 +1,334 @@
+"""
+Face recognition helpers for the webcam stage in main.py.
+"""
+from dataclasses import dataclass, field
+from pathlib import Path
+import hashlib
+import json
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import clock
+from tool_state import DrawerOpenState, NoDrawerOpenState, User
+from vector_index import ExactIndex, VectorIndex, make_index
+
+
+@dataclass
+class RecognizedFace:
+    # (top, right, bottom, left) in full webcam frame coordinates, same order as face_recognition
+    location: tuple[int, int, int, int]
+    name: str
+    user: User | None = None
+
+
+class FaceRecognitionScheduler:
+    """
+    Decides when the (expensive) face detection + encoding should run on a webcam frame.
+
+    Full recognition runs when a DrawerOpenState begins, or when the cadence is due and the scene
+    has changed since the last recognition (a cheap frame difference on a tiny grayscale thumbnail).
+    In between, the last recognized faces and user are reused so the identity persists.
+    """
+
+    def __init__(
+        self,
+        every_n_frames: int | None = 5,
+        every_ms: float | None = None,
+        motion_threshold: float = 6.0,
+        thumbnail_size: tuple[int, int] = (64, 48),
+    ):
+        """
+        Args:
+            every_n_frames: Run at most once every N webcam frames (None to disable the frame cadence).
+            every_ms: Run at most once every T milliseconds (None to disable the time cadence).
+                If both are set, recognition is due when either one is.
+            motion_threshold: Mean absolute grayscale difference (0-255) against the thumbnail from the
+                last recognition run above which the scene counts as changed.
+            thumbnail_size: (width, height) of the thumbnail used for the frame difference.
+        """
+        self.every_n_frames = every_n_frames
+        self.every_ms = every_ms
+        self.motion_threshold = motion_threshold
+        self.thumbnail_size = thumbnail_size
+
+        self.last_faces: list[RecognizedFace] = []
+        self.last_user: User | None = None
+
+        self.frames_seen = 0
+        self.recognition_runs = 0
+        self._frames_since_run = 0
+        self._last_run_at: float | None = None
+        self._reference_thumbnail: np.ndarray | None = None
+        self._last_drawer_state: DrawerOpenState | NoDrawerOpenState | None = None
+        self._pending_thumbnail: np.ndarray | None = None
+
+    def should_run(self, frame: np.ndarray, tool_detection_state: DrawerOpenState | NoDrawerOpenState) -> bool:
+        """Call once per new webcam frame. If this returns True, run recognition and call record_result."""
+        self.frames_seen += 1
+        self._frames_since_run += 1
+        thumbnail = self._make_thumbnail(frame)
+        self._pending_thumbnail = thumbnail
+
+        drawer_just_opened = (
+            isinstance(tool_detection_state, DrawerOpenState)
+            and tool_detection_state is not self._last_drawer_state
+        )
+        self._last_drawer_state = tool_detection_state
+        if drawer_just_opened or self._reference_thumbnail is None:
+            return True
+
+        if not self._is_cadence_due():
+            return False
+        return self._scene_changed(thumbnail)
+
+    def record_result(self, faces: list[RecognizedFace], user: User | None):
+        self.last_faces = faces
+        self.last_user = user
+        self.recognition_runs += 1
+        self._frames_since_run = 0
+        self._last_run_at = clock.monotonic()
+        self._reference_thumbnail = self._pending_thumbnail
+
+    def _is_cadence_due(self) -> bool:
+        if self.every_n_frames is None and self.every_ms is None:
+            return True
+        if self.every_n_frames is not None and self._frames_since_run >= self.every_n_frames:
+            return True
+        if self.every_ms is not None and self._last_run_at is not None:
+            return (clock.monotonic() - self._last_run_at) * 1000 >= self.every_ms
+        return False
+
+    def _scene_changed(self, thumbnail: np.ndarray) -> bool:
+        difference = cv2.absdiff(thumbnail, self._reference_thumbnail)
+        return float(difference.mean()) > self.motion_threshold
+
+    def _make_thumbnail(self, frame: np.ndarray) -> np.ndarray:
+        small = cv2.resize(frame, self.thumbnail_size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+
+def draw_faces(frame: np.ndarray, faces: list[RecognizedFace]):
+    """Draws a labelled box around each face, in place."""
+    for face in faces:
+        top, right, bottom, left = face.location
+        # Draw a box around the face
+        cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 255), 2)
+
+        # Draw a label with a name below the face
+        cv2.rectangle(frame, (left, bottom - 35), (right, bottom), (0, 0, 255), cv2.FILLED)
+        font = cv2.FONT_HERSHEY_DUPLEX
+        cv2.putText(frame, face.name, (left + 6, bottom - 6), font, 1.0, (255, 255, 255), 1)
+
+
+UNKNOWN_FACE_NAME = "Unknown"
+FACE_IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+@dataclass
+class FaceMatch:
+    # Display string for InventoryStateManager.make_user_from_string, or "Unknown"
+    name: str
+    distance: float
+    # Nearest (name, distance) pairs from the gallery index, closest first
+    candidates: list[tuple[str, float]] = field(default_factory=list)
+
+    @property
+    def is_known(self) -> bool:
+        return self.name != UNKNOWN_FACE_NAME
+
+
+class FaceGallery:
+    """
+    Known faces, loaded from the images in `faces_dir` that have an entry in `<faces_dir>/names.json`
+    ({"mason.png": "Mason Thomas - mgt210000"}), searchable through a vector_index index. Images
+    without a name are skipped with a warning, so nobody is enrolled by just dropping a photo in.
+
+    Encodings are cached in `<faces_dir>/.encodings.npy` (memory-mapped on load) with an index in
+    `<faces_dir>/.encodings.json` keyed by the SHA-1 of each image, so startup only runs dlib on new
+    or changed images. Changes to the folder are picked up by reload_if_changed(), which encodes on a
+    background thread so the frame loop never waits for dlib.
+    """
+
+    def __init__(self, faces_dir: str = "faces", tolerance: float = 0.6, reload_interval_s: float = 5.0):
+        self.faces_dir = Path(faces_dir)
+        self.tolerance = tolerance
+        self.reload_interval_s = reload_interval_s
+
+        # (names, encodings, index), replaced as one tuple so match() never sees them out of step
+        self._gallery: tuple[list[str], np.ndarray, VectorIndex] = ([], np.zeros((0, 128)), ExactIndex())
+        self._reload_thread: threading.Thread | None = None
+
+        self._cache_path = self.faces_dir / ".encodings.npy"
+        self._index_path = self.faces_dir / ".encodings.json"
+        self._names_path = self.faces_dir / "names.json"
+        self._directory_signature: tuple | None = None
+        self._last_scan_at = 0.0
+
+    @property
+    def names(self) -> list[str]:
+        return self._gallery[0]
+
+    @property
+    def encodings(self) -> np.ndarray:
+        return self._gallery[1]
+
+    @property
+    def index(self) -> VectorIndex:
+        return self._gallery[2]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def load(self):
+        """Scans faces_dir and (re)builds the gallery, only encoding images that aren't in the cache. Blocks while encoding."""
+        self._last_scan_at = time.monotonic()
+        self._directory_signature = self._scan_signature()
+        display_names = json.loads(self._names_path.read_text()) if self._names_path.exists() else {}
+
+        cached_rows, cached_encodings = self._read_cache()
+
+        names = []
+        rows = []
+        cache_entries = {}
+        newly_encoded = 0
+        for image_path in self._image_paths():
+            if image_path.name not in display_names:
+                print(f"face gallery: {image_path.name} has no entry in {self._names_path}, not enrolling it")
+                continue
+            file_hash = hashlib.sha1(image_path.read_bytes()).hexdigest()
+            if file_hash in cached_rows:
+                cached_row = cached_rows[file_hash]
+                encoding = None if cached_row is None else cached_encodings[cached_row]
+            else:
+                encoding = self._encode_image(image_path)
+                newly_encoded += 1
+
+            if encoding is None:
+                # Remember images without a face so we don't run dlib on them again
+                cache_entries[file_hash] = {"file": image_path.name, "row": None}
+                continue
+
+            cache_entries[file_hash] = {"file": image_path.name, "row": len(rows)}
+            # Copy out of the memory-mapped cache, which gets rewritten below
+            rows.append(np.array(encoding, dtype=np.float64))
+            names.append(display_names[image_path.name])
+
+        encodings = np.stack(rows) if rows else np.zeros((0, 128))
+        if newly_encoded or set(cache_entries) != set(cached_rows):
+            self._write_cache(encodings, cache_entries)
+
+        # Exact search for small galleries, an IVF index once the gallery grows past a few thousand faces
+        index = make_index(len(encodings))
+        index.build(encodings)
+
+        # One assignment, so a concurrent match never sees mismatched names/encodings
+        self._gallery = (names, encodings, index)
+        print(f"face gallery: {len(names)} faces loaded from {self.faces_dir} ({newly_encoded} newly encoded, {type(index).__name__})")
+
+    def reload_if_changed(self) -> bool:
+        """
+        Called from the frame loop. At most every reload_interval_s, starts a background check of the folder
+        (file names, sizes and mtimes) that reloads the gallery if anything changed; matching keeps using the
+        current gallery until the new one is swapped in. Returns whether a check was started.
+        """
+        if time.monotonic() - self._last_scan_at < self.reload_interval_s:
+            return False
+        self._last_scan_at = time.monotonic()
+        if self._reload_thread is not None and self._reload_thread.is_alive():
+            return False
+        self._reload_thread = threading.Thread(target=self._reload_in_background, name="face-gallery-reload", daemon=True)
+        self._reload_thread.start()
+        return True
+
+    def _reload_in_background(self):
+        if self._scan_signature() == self._directory_signature:
+            return
+        try:
+            self.load()
+        except Exception as e:
+            # Keep recognizing with the current gallery; the next check retries
+            print(f"face gallery: reload failed ({type(e).__name__}: {e})")
+            self._directory_signature = None
+
+    def match(self, face_encodings: list[np.ndarray], top_k: int = 3) -> list[FaceMatch]:
+        """
+        Looks up every detected face in the gallery index in one batch.
+        Returns the closest known name and its distance per face (faces farther than `tolerance` are "Unknown"),
+        plus the `top_k` nearest (name, distance) candidates.
+        """
+        if len(face_encodings) == 0:
+            return []
+        queries = np.asarray(face_encodings, dtype=np.float64)
+        # Grab the gallery once so a concurrent reload can't mix an old index with new names
+        names, _, index = self._gallery
+
+        indices, distances = index.search(queries, top_k)
+        matches = []
+        for row_indices, row_distances in zip(indices, distances):
+            candidates = [
+                (names[candidate], float(distance))
+                for candidate, distance in zip(row_indices, row_distances)
+                if candidate >= 0
+            ]
+            if candidates and candidates[0][1] <= self.tolerance:
+                name, distance = candidates[0]
+            else:
+                name = UNKNOWN_FACE_NAME
+                distance = candidates[0][1] if candidates else float("inf")
+            matches.append(FaceMatch(name=name, distance=distance, candidates=candidates))
+        return matches
+
+    def _image_paths(self) -> list[Path]:
+        if not self.faces_dir.is_dir():
+            return []
+        return sorted(
+            path for path in self.faces_dir.iterdir()
+            if path.suffix.lower() in FACE_IMAGE_EXTENSIONS and not path.name.startswith(".")
+        )
+
+    def _scan_signature(self) -> tuple:
+        paths = self._image_paths()
+        if self._names_path.exists():
+            paths.append(self._names_path)
+        signature = []
+        for path in paths:
+            stat = path.stat()
+            signature.append((path.name, stat.st_size, stat.st_mtime_ns))
+        return tuple(signature)
+
+    def _read_cache(self) -> tuple[dict[str, int | None], np.ndarray]:
+        if not self._index_path.exists() or not self._cache_path.exists():
+            return {}, np.zeros((0, 128))
+        try:
+            index = json.loads(self._index_path.read_text())
+            encodings = np.load(self._cache_path, mmap_mode="r")
+        except (OSError, ValueError) as e:
+            print(f"face gallery: ignoring unreadable encoding cache ({e})")
+            return {}, np.zeros((0, 128))
+        return {file_hash: entry["row"] for file_hash, entry in index.items()}, encodings
+
+    def _write_cache(self, encodings: np.ndarray, cache_entries: dict):
+        try:
+            # Write to a temporary file and swap it in, never truncate a file that may still be memory-mapped
+            temporary_path = self._cache_path.with_suffix(".tmp.npy")
+            np.save(temporary_path, encodings)
+            os.replace(temporary_path, self._cache_path)
+            self._index_path.write_text(json.dumps(cache_entries, indent=2))
+        except OSError as e:
+            print(f"face gallery: could not write encoding cache ({e})")
+
+    @staticmethod
+    def _encode_image(image_path: Path) -> np.ndarray | None:
+        # Imported here so modules that only need the gallery types (and the benchmarks) don't need dlib
+        import face_recognition
+
+        image = face_recognition.load_image_file(str(image_path))
+        encodings = face_recognition.face_encodings(image)
+        if not encodings:
+            print(f"face gallery: no face found in {image_path}, skipping")
+            return None
+        return encodings[0]
@@ -0,0 +1,147 @@
+"""
+Encode-once cache for frames published through a FrameExchange.
+
+Every published frame is encoded at most once per (format, quality), in a worker thread so the
+asyncio event loop stays free, and all concurrent requests for the same frame share that encode.
+"""
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import AsyncIterator, Literal
+from uuid import uuid4
+import asyncio
+import base64
+import time
+
+import cv2
+import numpy as np
+
+from frame_exchange import FrameExchange
+
+ImageFormat = Literal["png", "jpeg"]
+
+MEDIA_TYPES: dict[str, str] = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+}
+
+
+@dataclass
+class EncodedFrame:
+    seq: int
+    image_format: ImageFormat
+    quality: int
+    data: bytes
+    etag: str = field(repr=False)
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES[self.image_format]
+
+    @cached_property
+    def data_uri(self) -> str:
+        return f"data:{self.media_type};base64,{base64.b64encode(self.data).decode('utf-8')}"
+
+
+def encode_frame(frame: np.ndarray, image_format: ImageFormat, quality: int = 85) -> bytes:
+    """Encodes a BGR frame straight from OpenCV, no RGB conversion or PIL round trip needed."""
+    if image_format == "jpeg":
+        ok, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    else:
+        ok, buffer = cv2.imencode(".png", frame)
+    if not ok:
+        raise ValueError(f"could not encode frame as {image_format}")
+    return buffer.tobytes()
+
+
+class EncodedFrameCache:
+    """
+    Keeps the latest encoding per (format, quality), keyed by frame sequence number.
+    Must be used from a single event loop (the API server's).
+    """
+
+    def __init__(self, exchange: FrameExchange):
+        self.exchange = exchange
+        self.encodes = 0
+        self.hits = 0
+        # ETags must change across restarts even though sequence numbers start over
+        self._instance_id = uuid4().hex[:8]
+        self._latest: dict[tuple[str, int], EncodedFrame] = {}
+        self._pending: dict[tuple[str, int], tuple[int, asyncio.Task]] = {}
+
+    def etag_for(self, seq: int, image_format: ImageFormat, quality: int) -> str:
+        return f'"{self._instance_id}-{seq}-{image_format}-{quality}"'
+
+    async def get(self, image_format: ImageFormat, quality: int = 85) -> EncodedFrame | None:
+        """Returns the newest frame encoded as requested, or None if no frame has been published yet."""
+        seq = self.exchange.latest_seq
+        if seq == 0:
+            return None
+
+        key = (image_format, quality)
+        cached = self._latest.get(key)
+        if cached is not None and cached.seq >= seq:
+            self.hits += 1
+            return cached
+
+        pending = self._pending.get(key)
+        if pending is None or pending[0] < seq:
+            task = asyncio.ensure_future(self._encode(image_format, quality))
+            self._pending[key] = (seq, task)
+        else:
+            # Someone is already encoding this frame, share their result
+            self.hits += 1
+            task = pending[1]
+        return await asyncio.shield(task)
+
+    async def _encode(self, image_format: ImageFormat, quality: int) -> EncodedFrame | None:
+        key = (image_format, quality)
+        try:
+            consistent = await asyncio.to_thread(
+                self.exchange.read_consistent, lambda frame: encode_frame(frame, image_format, quality))
+            if consistent is None:
+                return None
+            seq, data = consistent
+            self.encodes += 1
+            encoded = EncodedFrame(
+                seq=seq, image_format=image_format, quality=quality, data=data,
+                etag=self.etag_for(seq, image_format, quality),
+            )
+            latest = self._latest.get(key)
+            if latest is None or latest.seq < encoded.seq:
+                self._latest[key] = encoded
+            return encoded
+        finally:
+            pending = self._pending.get(key)
+            if pending is not None and pending[1] is asyncio.current_task():
+                del self._pending[key]
+
+
+async def stream_encoded_frames(
+    cache: EncodedFrameCache,
+    image_format: ImageFormat = "jpeg",
+    quality: int = 80,
+    fps: float = 10.0,
+) -> AsyncIterator[EncodedFrame]:
+    """
+    Yields at most `fps` new frames per second for one streaming client.
+
+    Frames come from the shared cache, so one encode fans out to every client with the same format and quality.
+    Nothing is buffered per client: the consumer awaits each send, and whenever it comes back for
+    the next frame it gets the newest one, so a slow client simply skips the frames it missed.
+    """
+    frame_interval_s = 1.0 / fps
+    last_seq = 0
+    next_frame_at = time.monotonic()
+    while True:
+        # Pace the client, then wait for a frame it hasn't seen yet
+        delay = next_frame_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await cache.exchange.wait_for_frame(last_seq)
+
+        encoded = await cache.get(image_format, quality)
+        if encoded is None or encoded.seq <= last_seq:
+            continue
+        last_seq = encoded.seq
+        next_frame_at = max(next_frame_at + frame_interval_s, time.monotonic())
+        yield encoded
@@ -0,0 +1,135 @@
+"""
+Hand-off of the latest annotated frame from the camera loop to the API server threads.
+"""
+from dataclasses import dataclass
+from typing import Callable, TypeVar
+import asyncio
+import threading
+
+import numpy as np
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class FrameView:
+    """A read-only view of one published frame. Only valid while FrameExchange.is_current(view) is True."""
+    seq: int
+    slot: int
+    frame: np.ndarray
+
+
+class FrameExchange:
+    """
+    Ring of preallocated frame buffers with a single producer and any number of readers.
+
+    The producer renders straight into the next free buffer (begin_write) and publishes it with
+    commit(), which swaps one (seq, slot) reference, so there is no lock and no copy on the read side.
+    Readers get a versioned view; a view stays valid until the producer wraps around the ring and
+    reuses its slot, which read_consistent() detects and retries (a seqlock).
+    API handlers that want the next frame park on wait_for_frame(), which commit() wakes without blocking.
+    """
+
+    def __init__(self, slots: int = 4):
+        assert slots >= 2, "need at least one slot to read while another is written"
+        self._buffers: list[np.ndarray | None] = [None] * slots
+        # Sequence number of the frame currently held in each slot, 0 while the slot is being written
+        self._slot_seqs: list[int] = [0] * slots
+        # (seq, slot) of the newest committed frame, replaced with a single reference assignment
+        self._latest: tuple[int, int] | None = None
+        self._next_seq = 1
+        self._writing_slot: int | None = None
+        self._waiters_lock = threading.Lock()
+        self._waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Future]] = set()
+
+    @property
+    def latest_seq(self) -> int:
+        """Sequence number of the newest committed frame, 0 if nothing has been published yet."""
+        latest = self._latest
+        return latest[0] if latest is not None else 0
+
+    def begin_write(self, shape: tuple[int, ...], dtype=np.uint8) -> np.ndarray:
+        """Returns the buffer for the next frame. Fill it in place, then call commit()."""
+        slot = self._next_seq % len(self._buffers)
+        buffer = self._buffers[slot]
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != np.dtype(dtype):
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[slot] = buffer
+        # Invalidate views of the frame that previously lived in this slot before overwriting it
+        self._slot_seqs[slot] = 0
+        self._writing_slot = slot
+        return buffer
+
+    def commit(self) -> int:
+        """Publishes the buffer returned by the last begin_write() and returns its sequence number."""
+        assert self._writing_slot is not None, "commit() without begin_write()"
+        seq = self._next_seq
+        slot = self._writing_slot
+        self._slot_seqs[slot] = seq
+        self._latest = (seq, slot)
+        self._next_seq += 1
+        self._writing_slot = None
+        with self._waiters_lock:
+            waiters = list(self._waiters)
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+        return seq
+
+    def write(self, frame: np.ndarray) -> int:
+        """Copies an already rendered frame into the ring and publishes it."""
+        np.copyto(self.begin_write(frame.shape, frame.dtype), frame)
+        return self.commit()
+
+    def read(self) -> FrameView | None:
+        """Returns a view of the newest frame, or None if nothing has been published yet."""
+        latest = self._latest
+        if latest is None:
+            return None
+        seq, slot = latest
+        frame = self._buffers[slot].view()
+        frame.flags.writeable = False
+        return FrameView(seq=seq, slot=slot, frame=frame)
+
+    def is_current(self, view: FrameView) -> bool:
+        """True if the producer hasn't started overwriting the view's slot."""
+        return self._slot_seqs[view.slot] == view.seq
+
+    def read_consistent(self, fn: Callable[[np.ndarray], T], retries: int = 3) -> tuple[int, T] | None:
+        """
+        Runs fn on the newest frame and returns (seq, fn(frame)), retrying if the producer
+        reused the slot while fn was running. Returns None if nothing has been published yet.
+        """
+        for _ in range(retries + 1):
+            view = self.read()
+            if view is None:
+                return None
+            result = fn(view.frame)
+            if self.is_current(view):
+                return view.seq, result
+        raise RuntimeError(f"frame was overwritten {retries + 1} times while being read")
+
+    async def wait_for_frame(self, seq: int, timeout: float | None = None) -> bool:
+        """Waits until a frame newer than `seq` is committed. Returns False on timeout."""
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while self.latest_seq <= seq:
+            future = loop.create_future()
+            waiter = (loop, future)
+            with self._waiters_lock:
+                self._waiters.add(waiter)
+            try:
+                # Re-check now that we're registered, in case a commit slipped in between
+                if self.latest_seq > seq:
+                    break
+                await asyncio.wait_for(future, timeout=None if deadline is None else max(deadline - loop.time(), 0.0))
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                with self._waiters_lock:
+                    self._waiters.discard(waiter)
+        return True
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,123 @@
+"""
+Content-addressed on-disk store for event snapshot images.
+
+Only frames that actually become events are JPEG-encoded. Each image is stored once under the
+SHA-256 of its bytes and served by /api/images/{image_id}, so event payloads carry a short URL
+instead of an inline base64 data URI.
+"""
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import os
+import re
+import threading
+import time
+
+import cv2
+import numpy as np
+
+IMAGE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+class ImageStore:
+    """
+    Args:
+        root: Directory the images are written to (sharded by the first two characters of the id).
+        url_prefix: Prefix for image URLs; the id is appended after a slash.
+        max_bytes: Oldest images are evicted once the store grows past this size.
+        max_age_s: Images older than this are evicted, and no longer served even if nothing new was stored since.
+        jpeg_quality: Quality used when encoding frames.
+    """
+
+    def __init__(
+        self,
+        root: str = "data/images",
+        url_prefix: str = "/api/images",
+        max_bytes: int = 512 * 1024 * 1024,
+        max_age_s: float = 90 * 24 * 3600,
+        jpeg_quality: int = 85,
+    ):
+        self.root = Path(root)
+        self.url_prefix = url_prefix.rstrip("/")
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.jpeg_quality = jpeg_quality
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # image id -> (mtime, size), oldest first
+        self._entries: OrderedDict[str, tuple[float, int]] = OrderedDict()
+        self._total_bytes = 0
+        self._load_existing()
+
+    def put_frame(self, frame: np.ndarray) -> str:
+        """JPEG-encodes a BGR frame, stores it and returns its image id."""
+        ok, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+        if not ok:
+            raise ValueError("could not encode frame as JPEG")
+        return self.put_bytes(buffer.tobytes())
+
+    def put_bytes(self, data: bytes) -> str:
+        image_id = hashlib.sha256(data).hexdigest()[:32]
+        path = self._path(image_id)
+        now = time.time()
+        with self._lock:
+            if image_id in self._entries:
+                # Same image again: refresh its age instead of writing a duplicate
+                os.utime(path, (now, now))
+                self._entries.move_to_end(image_id)
+                self._entries[image_id] = (now, len(data))
+                return image_id
+
+            path.parent.mkdir(exist_ok=True)
+            temporary_path = path.with_suffix(".tmp")
+            temporary_path.write_bytes(data)
+            os.replace(temporary_path, path)
+            self._entries[image_id] = (now, len(data))
+            self._total_bytes += len(data)
+            self._evict(now)
+        return image_id
+
+    def url_for(self, image_id: str) -> str:
+        return f"{self.url_prefix}/{image_id}"
+
+    def path_for(self, image_id: str) -> Path | None:
+        """Path of a stored image, or None if the id is malformed or the image was evicted or has expired."""
+        if not IMAGE_ID_PATTERN.match(image_id):
+            return None
+        with self._lock:
+            entry = self._entries.get(image_id)
+            if entry is None:
+                return None
+            now = time.time()
+            if now - entry[0] > self.max_age_s:
+                # Nothing may have been stored for a while; expire this image and everything older now
+                self._evict(now)
+                return None
+        return self._path(image_id)
+
+    def _path(self, image_id: str) -> Path:
+        return self.root / image_id[:2] / f"{image_id}.jpg"
+
+    def _evict(self, now: float):
+        while self._entries:
+            oldest_id, (mtime, size) = next(iter(self._entries.items()))
+            if self._total_bytes <= self.max_bytes and now - mtime <= self.max_age_s:
+                break
+            del self._entries[oldest_id]
+            self._total_bytes -= size
+            try:
+                self._path(oldest_id).unlink()
+            except FileNotFoundError:
+                pass
+
+    def _load_existing(self):
+        existing = []
+        for path in self.root.glob("*/*.jpg"):
+            if IMAGE_ID_PATTERN.match(path.stem):
+                stat = path.stat()
+                existing.append((stat.st_mtime, path.stem, stat.st_size))
+        for mtime, image_id, size in sorted(existing):
+            self._entries[image_id] = (mtime, size)
+            self._total_bytes += size
+        self._evict(time.time())
@@ -0,0 +1,49 @@
+"""
+Builds or updates the tool identification index from the tool catalogue.
+
+    python index_tools.py
+    python index_tools.py --catalogue tool_catalogue --index data/tool_index --embedder onnx --model dinov2_vits14.onnx
+
+Put reference photos of each tool in tool_catalogue/<tool id>/ (optionally described in
+tool_catalogue/tools.json) and re-run; only new or changed photos are embedded. Afterwards every
+reference photo is looked up against the others (leave one out), as a quick check that the tools
+are far enough apart for the chosen --min-similarity.
+"""
+import argparse
+
+import numpy as np
+
+from tool_identification import EMBEDDER_BACKENDS, ToolIndex, load_embedder
+
+
+def leave_one_out_accuracy(index: ToolIndex, min_similarity: float) -> float:
+    """Fraction of reference photos whose nearest other photo belongs to the same tool and is similar enough."""
+    if len(index) < 2:
+        return float("nan")
+    # The nearest neighbour of a reference photo is itself, so look at the second one
+    neighbours = index.search(np.asarray(index.embeddings), k=2)
+    hits = [
+        len(candidates) > 1 and candidates[1][0] == tool_id and candidates[1][1] >= min_similarity
+        for tool_id, candidates in zip(index.labels, neighbours)
+    ]
+    return float(np.mean(hits))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--catalogue", default="tool_catalogue")
+    parser.add_argument("--index", default="data/tool_index")
+    parser.add_argument("--embedder", choices=EMBEDDER_BACKENDS, default="torch")
+    parser.add_argument("--model", default=None, help="Torch hub model name, or the .onnx file for --embedder onnx")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--min-similarity", type=float, default=0.6)
+    args = parser.parse_args()
+
+    embedder = load_embedder(args.embedder, args.model)
+    index = ToolIndex(args.index)
+    index.update(args.catalogue, embedder, batch_size=args.batch_size)
+    print(f"leave-one-out accuracy: {leave_one_out_accuracy(index, args.min_similarity):.3f}")
+
+
+if __name__ == "__main__":
+    main()
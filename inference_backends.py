@@ -0,0 +1,240 @@
+"""
+Interchangeable backends for the tools model.
+
+Every backend turns a BGR frame into sv.Detections with a "class_name" data field, exactly like
+sv.Detections.from_ultralytics, so the tracker, the state machine and the annotators don't care
+which one is running. The exported backends (ONNX Runtime, OpenVINO) do their own letterboxing and
+NMS and never import torch or ultralytics, which keeps startup fast on CPU-only machines.
+
+Export the model with:
+    python export_model.py --format onnx
+"""
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Literal, Protocol
+import ast
+import json
+
+import cv2
+import numpy as np
+import supervision as sv
+
+Backend = Literal["ultralytics", "onnx", "openvino"]
+BACKENDS: tuple[Backend, ...] = ("ultralytics", "onnx", "openvino")
+
+DEFAULT_WEIGHTS = "tools_medium_480.pt"
+
+
+class Detector(Protocol):
+    def detect(self, frame: np.ndarray) -> sv.Detections: ...
+
+    def detect_batch(self, frames: list[np.ndarray]) -> list[sv.Detections]: ...
+
+
+class UltralyticsDetector:
+    """The original PyTorch path through ultralytics."""
+
+    def __init__(self, weights: str = DEFAULT_WEIGHTS, conf: float = 0.25, iou: float = 0.7):
+        from ultralytics import YOLO
+
+        self.model = YOLO(weights)
+        self.conf = conf
+        self.iou = iou
+
+    def detect(self, frame: np.ndarray) -> sv.Detections:
+        return self.detect_batch([frame])[0]
+
+    def detect_batch(self, frames: list[np.ndarray]) -> list[sv.Detections]:
+        results = self.model(frames, conf=self.conf, iou=self.iou, verbose=False)
+        return [sv.Detections.from_ultralytics(result) for result in results]
+
+
+class ExportedYoloDetector(ABC):
+    """
+    Pre- and post-processing shared by the exported backends: letterbox to the export size,
+    decode the (1, 4 + classes [+ mask coefficients], anchors) output, class-aware NMS and scale
+    the boxes back to the frame. Mask coefficients of segmentation exports are ignored.
+    Subclasses load the export and implement _infer.
+
+    Args:
+        class_names: Class names by class id, as stored in the export's metadata.
+        imgsz: (height, width) the model was exported with.
+        conf: Minimum confidence, same default as ultralytics.
+        iou: NMS IoU threshold, same default as ultralytics.
+        max_det: Maximum detections per frame.
+        dynamic_batch: Whether the export takes a dynamic batch size (`export dynamic=True`);
+            otherwise detect_batch runs the frames one at a time.
+    """
+
+    def __init__(
+        self,
+        class_names: list[str],
+        imgsz: tuple[int, int],
+        conf: float = 0.25,
+        iou: float = 0.7,
+        max_det: int = 300,
+        dynamic_batch: bool = False,
+    ):
+        self.class_names = np.array(class_names)
+        self.imgsz = imgsz
+        self.conf = conf
+        self.iou = iou
+        self.max_det = max_det
+        self.dynamic_batch = dynamic_batch
+
+    def detect(self, frame: np.ndarray) -> sv.Detections:
+        blob, gain, pad = letterbox(frame, self.imgsz)
+        output = self._infer(blob)
+        return self._postprocess(output[0], gain, pad, frame.shape)
+
+    def detect_batch(self, frames: list[np.ndarray]) -> list[sv.Detections]:
+        if not self.dynamic_batch or len(frames) == 1:
+            return [self.detect(frame) for frame in frames]
+        letterboxed = [letterbox(frame, self.imgsz) for frame in frames]
+        output = self._infer(np.concatenate([blob for blob, _, _ in letterboxed]))
+        return [
+            self._postprocess(prediction, gain, pad, frame.shape)
+            for prediction, (_, gain, pad), frame in zip(output, letterboxed, frames)
+        ]
+
+    @abstractmethod
+    def _infer(self, blob: np.ndarray) -> np.ndarray:
+        """Runs the model on a (batch, 3, height, width) float32 blob and returns its raw output."""
+
+    def _postprocess(self, output: np.ndarray, gain: float, pad: tuple[float, float], shape: tuple[int, ...]) -> sv.Detections:
+        """Decodes one image's output."""
+        class_count = len(self.class_names)
+        # (4 + classes [+ mask coefficients], anchors) -> (anchors, ...)
+        predictions = output.T
+        scores = predictions[:, 4:4 + class_count]
+        class_ids = scores.argmax(axis=1)
+        confidences = scores[np.arange(len(scores)), class_ids]
+        keep = confidences > self.conf
+        if not keep.any():
+            return sv.Detections.empty()
+
+        centers_and_sizes = predictions[keep, :4]
+        class_ids = class_ids[keep]
+        confidences = confidences[keep]
+        boxes = np.empty_like(centers_and_sizes)
+        boxes[:, :2] = centers_and_sizes[:, :2] - centers_and_sizes[:, 2:] / 2
+        boxes[:, 2:] = centers_and_sizes[:, 2:]
+        kept = cv2.dnn.NMSBoxesBatched(boxes.tolist(), confidences.tolist(), class_ids.tolist(), self.conf, self.iou)
+        kept = np.asarray(kept, dtype=int).reshape(-1)[:self.max_det]
+
+        xyxy = np.concatenate([boxes[kept, :2], boxes[kept, :2] + boxes[kept, 2:]], axis=1)
+        # Undo the letterbox
+        xyxy[:, [0, 2]] = (xyxy[:, [0, 2]] - pad[0]) / gain
+        xyxy[:, [1, 3]] = (xyxy[:, [1, 3]] - pad[1]) / gain
+        xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clip(0, shape[1])
+        xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clip(0, shape[0])
+        return sv.Detections(
+            xyxy=xyxy.astype(np.float32),
+            confidence=confidences[kept].astype(np.float32),
+            class_id=class_ids[kept],
+            data={"class_name": self.class_names[class_ids[kept]]},
+        )
+
+
+class OnnxRuntimeDetector(ExportedYoloDetector):
+    """An ONNX export (`yolo export format=onnx`) run with ONNX Runtime on the CPU."""
+
+    def __init__(self, path: str = "tools_medium_480.onnx", conf: float = 0.25, iou: float = 0.7, threads: int | None = None):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if threads is not None:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        super().__init__(
+            _parse_names(metadata["names"]),
+            _parse_imgsz(metadata["imgsz"]),
+            conf=conf,
+            iou=iou,
+            # Dynamic dimensions are reported by name instead of size
+            dynamic_batch=not isinstance(model_input.shape[0], int),
+        )
+
+    def _infer(self, blob: np.ndarray) -> np.ndarray:
+        return self.session.run(None, {self.input_name: blob})[0]
+
+
+class OpenVinoDetector(ExportedYoloDetector):
+    """An OpenVINO export (`yolo export format=openvino`, a directory with the .xml and metadata.yaml) on the CPU."""
+
+    def __init__(self, path: str = "tools_medium_480_openvino_model", conf: float = 0.25, iou: float = 0.7):
+        import openvino
+        import yaml
+
+        directory = Path(path)
+        core = openvino.Core()
+        self.compiled_model = core.compile_model(core.read_model(next(directory.glob("*.xml"))), "CPU")
+        self.output = self.compiled_model.output(0)
+        metadata = yaml.safe_load((directory / "metadata.yaml").read_text())
+        names = [metadata["names"][class_id] for class_id in sorted(metadata["names"])]
+        super().__init__(
+            names,
+            tuple(metadata["imgsz"]),
+            conf=conf,
+            iou=iou,
+            dynamic_batch=self.compiled_model.input(0).get_partial_shape()[0].is_dynamic,
+        )
+
+    def _infer(self, blob: np.ndarray) -> np.ndarray:
+        return self.compiled_model(blob)[self.output]
+
+
+def load_detector(backend: Backend = "ultralytics", weights: str | None = None) -> Detector:
+    """
+    Loads the tools model with the given backend. `weights` defaults to the file
+    export_model.py writes for that backend next to tools_medium_480.pt.
+    """
+    if backend == "ultralytics":
+        return UltralyticsDetector(weights or DEFAULT_WEIGHTS)
+    if backend == "onnx":
+        return OnnxRuntimeDetector(weights or exported_path(DEFAULT_WEIGHTS, "onnx"))
+    if backend == "openvino":
+        return OpenVinoDetector(weights or exported_path(DEFAULT_WEIGHTS, "openvino"))
+    raise ValueError(f"unknown inference backend {backend!r}, expected one of {', '.join(BACKENDS)}")
+
+
+def exported_path(weights: str, backend: Backend) -> str:
+    """Where ultralytics writes the export of `weights` for a backend."""
+    stem = Path(weights).with_suffix("")
+    if backend == "onnx":
+        return f"{stem}.onnx"
+    if backend == "openvino":
+        return f"{stem}_openvino_model"
+    return weights
+
+
+def letterbox(frame: np.ndarray, imgsz: tuple[int, int]) -> tuple[np.ndarray, float, tuple[float, float]]:
+    """
+    Resizes a BGR frame to fit `imgsz` (height, width) keeping the aspect ratio, pads it with grey
+    like ultralytics does and returns (NCHW float32 RGB blob in [0, 1], scale, (pad x, pad y)).
+    """
+    height, width = frame.shape[:2]
+    gain = min(imgsz[0] / height, imgsz[1] / width)
+    resized_width, resized_height = round(width * gain), round(height * gain)
+    pad_x, pad_y = (imgsz[1] - resized_width) / 2, (imgsz[0] - resized_height) / 2
+    if (resized_width, resized_height) != (width, height):
+        frame = cv2.resize(frame, (resized_width, resized_height), interpolation=cv2.INTER_LINEAR)
+    top, bottom = round(pad_y - 0.1), round(pad_y + 0.1)
+    left, right = round(pad_x - 0.1), round(pad_x + 0.1)
+    padded = cv2.copyMakeBorder(frame, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    blob = np.ascontiguousarray(padded[:, :, ::-1].transpose(2, 0, 1)[None], dtype=np.float32) / 255.0
+    return blob, gain, (left, top)
+
+
+def _parse_names(value: str) -> list[str]:
+    # Ultralytics stores the names dict as a Python literal ("{0: 'hammer', ...}")
+    names = ast.literal_eval(value)
+    return [names[class_id] for class_id in sorted(names)]
+
+
+def _parse_imgsz(value: str) -> tuple[int, int]:
+    imgsz = json.loads(value)
+    return (imgsz, imgsz) if isinstance(imgsz, int) else (imgsz[0], imgsz[1])
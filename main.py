@@ -1,27 +1,57 @@
-import freenect
 import cv2
 import numpy as np
-import face_recognition
-from ultralytics import YOLO
-import supervision as sv
 import threading
+import time
 import uvicorn
-import base64
-
-from api import state_manager, update_annotated_frame, app
-
-from tool_state import InventoryStateManager, DrawerOpenState
-model = YOLO("tools_medium_480.pt")
-tracker = sv.ByteTrack(track_activation_threshold=0.3, minimum_matching_threshold=0.2, lost_track_buffer=90)
-box_annotator = sv.BoxAnnotator()
-label_annotator = sv.LabelAnnotator()
-trace_annotator = sv.TraceAnnotator()
-
-video_capture = cv2.VideoCapture(0)
-
+import os
+import argparse
+import tempfile
+from dataclasses import dataclass
+
+from api import state_manager, frame_exchange, app
+
+from event_store import EventStore
+from image_store import ImageStore
+from faces import FaceGallery
+from pipeline import CaptureThread, LatestFrameQueue, PipelineFrame, StageStats, format_stage_report
+from inference_backends import BACKENDS, load_detector
+from tool_identification import EMBEDDER_BACKENDS, load_tool_identifier
+from stations import KinectSource, Station, StationConfig, VideoSource
+from recording import Recorder, Recording, ReplaySource, replay_serial
+import clock
+import metrics
+
+parser = argparse.ArgumentParser(description="Kinect tool cabinet tracker")
+parser.add_argument("--backend", choices=BACKENDS, default=os.environ.get("INFERENCE_BACKEND", "ultralytics"),
+                    help="How to run the tools model; export it first for onnx/openvino (python export_model.py)")
+parser.add_argument("--weights", default=None, help="Model file or export directory (defaults to the one for the backend)")
+parser.add_argument("--tool-index", default=os.environ.get("TOOL_INDEX"),
+                    help="Identify tools by embedding similarity against this index (python index_tools.py) instead of DRAWER_TO_TOOL_MAP")
+parser.add_argument("--embedder", choices=EMBEDDER_BACKENDS, default="torch", help="Embedding model backend for --tool-index")
+parser.add_argument("--embedder-model", default=None, help="Torch hub model name, or the .onnx file for --embedder onnx")
+parser.add_argument("--record", metavar="DIR", default=None, help="Record the Kinect and webcam streams to this directory")
+parser.add_argument("--replay", metavar="DIR", default=None, help="Replay a recording instead of reading the cameras")
+parser.add_argument("--replay-speed", type=float, default=1.0, help="Playback speed for --replay; 0 replays as fast as possible")
+parser.add_argument("--serial", action="store_true",
+                    help="With --replay: process every recorded frame in order on one thread, on the recording's clock (deterministic)")
+parser.add_argument("--headless", action="store_true", help="Don't open any windows")
+parser.add_argument("--no-api", action="store_true", help="Don't start the API server")
+parser.add_argument("--retain-events", type=int, default=10000,
+                    help="Events kept in the snapshot; older ones are read back from events.jsonl on startup")
+parser.add_argument("--data-dir", default=None,
+                    help="Where inventory, events and images are persisted (default: data/, or a fresh temporary directory for --replay)")
+args = parser.parse_args()
+if args.serial and args.replay is None:
+    parser.error("--serial needs --replay")
+
+# Replays start from an empty inventory so they don't depend on (or change) the live data
+data_dir = args.data_dir or (tempfile.mkdtemp(prefix="replay-data-") if args.replay else "data")
+
+detector = load_detector(args.backend, args.weights)
+print(f"tools model: {args.backend} backend")
+tool_identifier = load_tool_identifier(args.tool_index, args.embedder, args.embedder_model) if args.tool_index else None
 
 clicked_point = None
-previous_drawer_identifier = None
 
 def on_mouse(event, x, y, flags, param):
     global clicked_point
@@ -29,314 +59,239 @@ def on_mouse(event, x, y, flags, param):
         clicked_point = (x, y)
         print("Clicked at:", clicked_point)
 
-def frame_to_data_url(frame: np.ndarray):
-  _, buffer = cv2.imencode('.jpg', frame)
-  frame_bytes = buffer.tobytes()
-  frame_base64 = base64.b64encode(frame_bytes).decode('utf-8')
-  frame_data_uri = f"data:image/jpeg;base64,{frame_base64}"
-#   return frame_data_uri
-  return "https://picsum.photos/seed/1/500"
-  
-
-print("setting up facial encodings")
-
-mason_image = face_recognition.load_image_file("faces/mason.png")
-mason_face_encoding = face_recognition.face_encodings(mason_image)[0]
-
-gabriel_image = face_recognition.load_image_file("faces/gabe.jpg")
-gabriel_face_encoding = face_recognition.face_encodings(gabriel_image)[0]
+# Restore inventory and event history from the previous run; changes are persisted off the camera thread
+event_store = EventStore(data_dir, fsync="interval", retain_events=args.retain_events)
+state_manager.attach_event_store(event_store)
 
-colin_image = face_recognition.load_image_file("faces/colin.jpg")
-colin_face_encoding = face_recognition.face_encodings(colin_image)[0]
+# Event snapshot images are stored on disk and served by the API at /api/images/{id}
+API_PUBLIC_URL = os.environ.get("API_PUBLIC_URL", "http://localhost:8000")
+state_manager.image_store = ImageStore(f"{data_dir}/images", url_prefix=f"{API_PUBLIC_URL}/api/images")
 
-# carrie_image = face_recognition.load_image_file("faces/carrie.png")
-# carrie_face_encoding = face_recognition.face_encodings(carrie_image)[0]
+print("setting up facial encodings")
 
-# mike_image = face_recognition.load_image_file("faces/mike.png")
-# mike_face_encoding = face_recognition.face_encodings(mike_image)[0]
+# Every image in faces/ with a display name in faces/names.json is enrolled.
+# Encodings are cached next to the images, so only new or changed images are encoded here.
+face_gallery = FaceGallery("faces")
+face_gallery.load()
 
 print("we have finished encodings")
 
-known_face_encodings = [
-    mason_face_encoding,
-    gabriel_face_encoding,
-    colin_face_encoding,
-    # carrie_face_encoding,
-    # mike_face_encoding
-]
-known_face_names = [
-    "Mason Thomas - mgt210000",
-    "Gabriel Burbach - gmb190004",
-    "Colin Wong - csw220002",
-    # "Carrie Thomas",
-    # "Michael Thomas"
-]
-
-def get_video():
-    frame, _ = freenect.sync_get_video()
-    return cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-
-def get_depth_frame():
-    frame, _ = freenect.sync_get_depth()
-    return frame
-
-def get_depth_at_point(frame, x: int, y: int, max_variance: int = 150):
-    """
-    Get average depth value in a 50px square around the given point.
-    Samples a 50x50 pixel region centered on (x, y).
-    Filters out readings with high variance (mixed depths like drawer + floor).
-    
-    Args:
-        frame: Depth frame
-        x: X coordinate
-        y: Y coordinate
-        max_variance: Maximum allowed variance (default 100). Higher = more tolerance.
-    
-    Returns:
-        Average depth value, or None if variance is too high (unreliable reading)
-    """
-    # 50px square means 25px radius on each side
-    half_size = 15
-    
-    # Calculate bounds, ensuring we don't go outside the frame
-    y_start = max(0, y - half_size)
-    y_end = min(frame.shape[0], y + half_size)
-    x_start = max(0, x - half_size)
-    x_end = min(frame.shape[1], x + half_size)
-    
-    # Extract the region of interest
-    roi = frame[y_start:y_end, x_start:x_end]
-    
-    # Calculate average depth, ignoring zero values (invalid depth readings)
-    # Zero values typically indicate areas where depth couldn't be measured
-    valid_depths = roi[roi > 0]
-    
-    if len(valid_depths) == 0:
-        # If no valid depths, return None to indicate unreliable reading
-        return None
-    
-    # Calculate variance to check if depths are uniform
-    # High variance indicates mixed depths (e.g., drawer partially open with floor visible)
-    variance = np.var(valid_depths)
-    
-    if variance > max_variance:
-        # Variance too high - likely mixing drawer and floor/background
-        # Return None to indicate unreliable reading
-        return None
-    
-    # Return the average of valid depth values (variance is acceptable)
-    return int(np.mean(valid_depths))
-
-def get_drawer_identifier_from_depth(left_depth: int, right_depth: int) -> str | None:
-    """
-    Maps depth values to drawer identifiers based on depth ranges.
-    Returns drawer identifier string or None if no drawer is open.
-    """
-    # Check right drawer first
-    if 890 > right_depth > 861:
-        return "sanding and scales"
-    if 860 > right_depth > 841:
-        return "clamps"
-    if 840 > right_depth > 826:
-        return "electrical and hot glue"
-    if 825 > right_depth > 801:
-        return "sockets and allen keys"
-    if 800 > right_depth > 780:
-        return "drivers and bits"
-    
-    # Check left drawer
-    if 890 > left_depth > 851:
-        return "drill and dremmel"
-    if 850 > left_depth > 841:
-        return "measruing"
-    if 840 > left_depth > 826:
-        return "hammers"
-    if 825 > left_depth > 801:
-        return "pliers and cutters"
-    if 800 > left_depth > 780:
-        return "drivers and bits"
-    
-    # No drawer open (depth indicates closed state)
-    if 920 > right_depth > 891 or 920 > left_depth > 891:
-        return None
-    
-    # Default: no drawer open if depth doesn't match any range
-    return None
-
-cv2.namedWindow("Depth")
-cv2.setMouseCallback("Depth", on_mouse)
+# This process runs a single cabinet; see multi_station.py for several cabinets sharing one model.
+# Drawer probe points, depth bands and filtering are in depth_probes.json, detection regions in detection_regions.json
+station = Station.from_config(
+    StationConfig(name="main", kinect=0, webcam=0, data_dir=data_dir),
+    state_manager,
+    detector,
+    face_gallery,
+    frame_exchange=frame_exchange,
+    verbose=True,
+    tool_identifier=tool_identifier,
+)
+depth_probe_engine = station.drawer_state_filter.engine
+
+if args.replay is not None:
+    recording = Recording(args.replay)
+    print(f"replaying {args.replay} ({recording.duration_s:.1f}s, streams: {', '.join(recording.streams)})")
+    replay_speed = args.replay_speed if args.replay_speed > 0 else None
+    replay_sources = {name: ReplaySource(stream, speed=replay_speed) for name, stream in recording.streams.items()}
+    get_video = replay_sources["kinect_color"].read
+    get_depth_frame = replay_sources["depth"].read
+    # A recording without a webcam stream gets no webcam capture thread
+    read_webcam = replay_sources["webcam"].read if "webcam" in replay_sources else None
+else:
+    kinect = KinectSource(0)
+    webcam = VideoSource(0)
+    get_video = kinect.read_color
+    get_depth_frame = kinect.read_depth
+    read_webcam = webcam.read
+
+recorder = None
+if args.record is not None:
+    recorder = Recorder(args.record)
+    get_video = recorder.wrap("kinect_color", get_video)
+    get_depth_frame = recorder.wrap("depth", get_depth_frame)
+    if read_webcam is not None:
+        read_webcam = recorder.wrap("webcam", read_webcam)
+    print(f"recording to {args.record}")
+
+if not args.headless:
+    cv2.namedWindow("Depth")
+    cv2.setMouseCallback("Depth", on_mouse)
 
 def run_api_server():
     """Run the FastAPI server in a background thread"""
     uvicorn.run(app, host="0.0.0.0", port=8000, log_level="info")
 
 # Start the API server in a background thread
-print("Starting API server on http://0.0.0.0:8000")
-api_thread = threading.Thread(target=run_api_server, daemon=True)
-api_thread.start()
-print("API server started. Camera loop starting...")
-
-def object_tracking_annotated_frame(frame: np.ndarray):
-    results = model(frame)[0]
-    detections = sv.Detections.from_ultralytics(results)
-    detections = tracker.update_with_detections(detections)
-
-    if "class_name" not in detections.data:
-        return frame
-        
-    labels = [
-        f"#{tracker_id} {class_name}"
-        for class_name, tracker_id
-        in zip(detections.data["class_name"], detections.tracker_id)
-    ]
-
-    annotated_frame = box_annotator.annotate(
-        frame.copy(), detections=detections)
-    annotated_frame = label_annotator.annotate(
-        annotated_frame, detections=detections, labels=labels)
-    return trace_annotator.annotate(
-        annotated_frame, detections=detections)
-
-
-while True:
-    depth_frame = get_depth_frame()
-    kinect_color_frame = get_video()
-    ret, frame = video_capture.read()
-    if not ret:
-        continue
-    
-    # Get tracked detections for tool state management
-    tracked_results = model(kinect_color_frame, verbose=False)[0]
-    tracked_detections = sv.Detections.from_ultralytics(tracked_results)
-    tracked_detections = tracker.update_with_detections(tracked_detections)
-    
-    # Extract tool detections in format "{class_name} {tracker_id}"
-    tool_detection_set = set()
-    if "class_name" in tracked_detections.data and tracked_detections.tracker_id is not None:
-        tracker_ids = tracked_detections.tracker_id
-        for class_name, tracker_id in zip(tracked_detections.data["class_name"], tracker_ids):
-            if tracker_id is not None:
-                tool_detection_set.add(f"{class_name} {tracker_id}")
-    
-    # Update tool detection state if drawer is open
-    if isinstance(state_manager.tool_detection_state, DrawerOpenState):
-        drawer_state = state_manager.tool_detection_state
-        if drawer_state.detailed_state == "waiting_for_initial_tool_detection":
-            # Update initial tool detection state
-            drawer_state.initial_detection_count += len(tool_detection_set)
-            if drawer_state.initial_detection_count >= 10 and len(tool_detection_set) > len(drawer_state.initial_tool_detection_state):
-              drawer_state.initial_tool_detection_state = tool_detection_set.copy()
-        elif drawer_state.detailed_state == "watching_for_tool_checkin_or_checkout":
-            # Update current tool detection state
-            drawer_state.current_tool_detection_state = tool_detection_set.copy()
-            # Record snapshot for 2-second buffer
-            drawer_state.record_tool_detection_snapshot(frame_to_data_url(kinect_color_frame))
-    
-    rgb_frame = frame[:, :, ::-1]
-    small = cv2.resize(rgb_frame, (0, 0), fx=0.25, fy=0.25)
-    
+if not args.no_api:
+    print("Starting API server on http://0.0.0.0:8000")
+    api_thread = threading.Thread(target=run_api_server, daemon=True)
+    api_thread.start()
+    print("API server started. Camera loop starting...")
+
+
+@dataclass
+class ProcessedFrames:
+    """Everything the presentation stage needs to show and publish one processed frame."""
+    webcam_frame: np.ndarray | None
+    kinect_color_frame: np.ndarray
+    depth_frame: np.ndarray
+    annotated_frame: np.ndarray
+
+
+def print_clicked_depth(depth_frame: np.ndarray):
+    global clicked_point
     if clicked_point is not None:
         cx, cy = clicked_point
         if 0 <= cx < depth_frame.shape[1] and 0 <= cy < depth_frame.shape[0]:
-            depth_value = get_depth_at_point(depth_frame, cx, cy)
+            depth_value = depth_probe_engine.measure_point(depth_frame, cx, cy)
             if depth_value is not None:
-                print(f"Depth at {clicked_point}: {depth_value} (averaged over 50px square)")
+                print(f"Depth at {clicked_point}: {depth_value} (averaged over {2 * depth_probe_engine.half_size}px square)")
             else:
                 print(f"Depth at {clicked_point}: Unreliable (high variance - likely mixed depths)")
         clicked_point = None
-    
-    face_locations = face_recognition.face_locations(small)
-    face_encodings = face_recognition.face_encodings(small, face_locations)
-    
-    # Track detected user for this frame
-    detected_user = None
-    
-       # Loop through each face in this frame of video
-    for (top, right, bottom, left), face_encoding in zip(face_locations, face_encodings):
-        top *= 4
-        right *= 4
-        bottom *= 4
-        left *= 4
-        # See if the face is a match for the known face(s)
-        matches = face_recognition.compare_faces(known_face_encodings, face_encoding)
-
-        name = "Unknown"
-
-        # If a match was found in known_face_encodings, just use the first one.
-        # if True in matches:
-        #     first_match_index = matches.index(True)
-        #     name = known_face_names[first_match_index]
-
-        # Or instead, use the known face with the smallest distance to the new face
-        face_distances = face_recognition.face_distance(known_face_encodings, face_encoding)
-        best_match_index = np.argmin(face_distances)
-        if matches[best_match_index]:
-            name = known_face_names[best_match_index]
-            # Update state manager with detected user
-            user = InventoryStateManager.make_user_from_string(name)
-            state_manager.update_currently_detected_user(user)
-            name = user.name
-
-        # Draw a box around the face
-        cv2.rectangle(frame, (left, top), (right, bottom), (0, 0, 255), 2)
-
-        # Draw a label with a name below the face
-        cv2.rectangle(frame, (left, bottom - 35), (right, bottom), (0, 0, 255), cv2.FILLED)
-        font = cv2.FONT_HERSHEY_DUPLEX
-        cv2.putText(frame, name, (left + 6, bottom - 6), font, 1.0, (255, 255, 255), 1)
-    
-    # Update state manager with detected user (or None if no face detected)
-    state_manager.update_currently_detected_user(detected_user)
-
-    # Get annotated frame with object tracking
-    annotated_frame = object_tracking_annotated_frame(kinect_color_frame.copy())
-    
-    # Update the annotated frame for the API
-    update_annotated_frame(annotated_frame)
-    
-    cv2.imshow('Video', frame)
-    cv2.imshow('RGB', kinect_color_frame)
-    cv2.imshow('Depth', depth_frame / 2048)  # simple visualization
-    cv2.imshow('Detections', annotated_frame)
-    
-    left_depth = get_depth_at_point(depth_frame, 500, 366)
-    right_depth = get_depth_at_point(depth_frame, 243, 371)
-    
-    # If depth readings are unreliable (None), treat as no drawer open
-    # This happens when variance is too high (e.g., drawer partially open mixing with floor)
-    if left_depth is None:
-        left_depth = 1000  # Default to "no drawer open" depth
-    if right_depth is None:
-        right_depth = 1000  # Default to "no drawer open" depth
-    
-    # Get current drawer identifier from depth
-    current_drawer_identifier = get_drawer_identifier_from_depth(left_depth, right_depth)
-    
-    # Handle drawer state transitions
-    if previous_drawer_identifier != current_drawer_identifier:
-        # Transition from no drawer to drawer open
-        if previous_drawer_identifier is None and current_drawer_identifier is not None:
-            state_manager.transition_to_drawer_open(current_drawer_identifier)
-        # Transition from drawer open to no drawer
-        elif previous_drawer_identifier is not None and current_drawer_identifier is None:
-            state_manager.transition_to_no_drawer_open()
-        # Transition from one drawer to different drawer
-        elif previous_drawer_identifier is not None and current_drawer_identifier is not None and previous_drawer_identifier != current_drawer_identifier:
-            state_manager.transition_to_no_drawer_open()
-            state_manager.transition_to_drawer_open(current_drawer_identifier)
-        
-        previous_drawer_identifier = current_drawer_identifier
-    
-    # Debug output (keeping original print statements for reference)
-    print(left_depth, right_depth, end=" - ")
-    
-    if current_drawer_identifier is None:
-        print("no drawer open")
-    else:
-        print(current_drawer_identifier)
-
-    if cv2.waitKey(1) & 0xFF == 27:
-        break
-
-cv2.destroyAllWindows()
 
+
+def process_frames(depth_frame: np.ndarray, kinect_color_frame: np.ndarray, webcam_frame: np.ndarray | None, is_new_webcam_frame: bool) -> ProcessedFrames:
+    """One inference step. All state machine updates happen here, on the inference thread."""
+    # Run the model and the tracker once; the state machine and the annotators share the result
+    detection_result = station.detect(kinect_color_frame)
+    print_clicked_depth(depth_frame)
+    annotated_frame = station.process(depth_frame, kinect_color_frame, webcam_frame, is_new_webcam_frame, detection_result)
+
+    return ProcessedFrames(
+        webcam_frame=webcam_frame,
+        kinect_color_frame=kinect_color_frame,
+        depth_frame=depth_frame,
+        annotated_frame=annotated_frame,
+    )
+
+
+def show(processed: ProcessedFrames):
+    # The annotated frame was already published to the API by the inference worker
+    if processed.webcam_frame is not None:
+        cv2.imshow('Video', processed.webcam_frame)
+    cv2.imshow('RGB', processed.kinect_color_frame)
+    cv2.imshow('Depth', processed.depth_frame / 2048)  # simple visualization
+    cv2.imshow('Detections', processed.annotated_frame)
+
+
+CAPTURE_JOIN_TIMEOUT_S = 2.0
+
+
+def shutdown(threads: list[threading.Thread] = ()):
+    # Let the capture threads finish the read they are in, so the recorder gets their last frames before it closes
+    for thread in threads:
+        thread.join(timeout=CAPTURE_JOIN_TIMEOUT_S)
+    if recorder is not None:
+        recorder.close()
+    event_store.close()
+    if not args.headless:
+        cv2.destroyAllWindows()
+
+
+if args.serial:
+    # Every recorded colour frame is processed, in order, on this thread, with time following the recording.
+    # Nothing is dropped and nothing depends on how fast this machine is, so runs are reproducible.
+    replay_clock = clock.ReplayClock()
+    clock.set_clock(replay_clock)
+    processed_count = 0
+    for step in replay_serial(recording, replay_clock=replay_clock):
+        if step.frames["depth"] is None:
+            continue
+        processed = process_frames(step.frames["depth"], step.frames["kinect_color"], step.frames.get("webcam"), step.is_new.get("webcam", False))
+        processed_count += 1
+        if not args.headless:
+            show(processed)
+            if cv2.waitKey(1) & 0xFF == 27:
+                break
+    print(f"replayed {processed_count} frames, {len(state_manager.event_log)} events")
+    shutdown()
+    raise SystemExit(0)
+
+
+stop_event = threading.Event()
+depth_queue = LatestFrameQueue("depth")
+kinect_color_queue = LatestFrameQueue("kinect_color")
+webcam_queue = LatestFrameQueue("webcam")
+presentation_queue = LatestFrameQueue("presentation")
+
+capture_threads = [
+    CaptureThread("depth", get_depth_frame, depth_queue, stop_event),
+    CaptureThread("kinect_color", get_video, kinect_color_queue, stop_event),
+]
+if read_webcam is not None:
+    capture_threads.append(CaptureThread("webcam", read_webcam, webcam_queue, stop_event))
+inference_stats = StageStats("inference", output=presentation_queue)
+presentation_stats = StageStats("presentation")
+STAGE_REPORT_INTERVAL_S = 5.0
+# Capture to presentation; what "sluggish" feels like
+frame_age = metrics.registry.histogram("cabinet_frame_age_seconds", "Time from capturing a colour frame to presenting it")
+
+
+def run_inference_worker():
+    """Pairs the newest Kinect colour frame with the newest depth and webcam frames and processes them."""
+    depth_frame = None
+    webcam_frame = None
+    while not stop_event.is_set():
+        kinect_color = kinect_color_queue.get(timeout=0.5)
+        if kinect_color is None:
+            if args.replay is not None and replay_sources["kinect_color"].exhausted:
+                # Every recorded frame has been processed
+                stop_event.set()
+            continue
+
+        depth = depth_queue.get(timeout=0)
+        if depth is not None:
+            depth_frame = depth.data
+        webcam = webcam_queue.get(timeout=0)
+        if webcam is not None:
+            webcam_frame = webcam.data
+        # Faces are optional (a recording may have no webcam stream); drawers need depth
+        if depth_frame is None:
+            continue
+
+        with inference_stats.measure():
+            processed = process_frames(depth_frame, kinect_color.data, webcam_frame, is_new_webcam_frame=webcam is not None)
+        presentation_queue.put(PipelineFrame(seq=kinect_color.seq, captured_at=kinect_color.captured_at, data=processed))
+
+
+for capture_thread in capture_threads:
+    capture_thread.start()
+inference_thread = threading.Thread(target=run_inference_worker, name="inference", daemon=True)
+inference_thread.start()
+
+# The presentation stage stays on the main thread because OpenCV's HighGUI isn't thread safe
+last_stage_report = time.perf_counter()
+try:
+    while True:
+        presented = presentation_queue.get(timeout=0.1)
+        if presented is not None:
+            processed: ProcessedFrames = presented.data
+            with presentation_stats.measure():
+                if not args.headless:
+                    show(processed)
+
+            now = time.perf_counter()
+            frame_age.observe(now - presented.captured_at)
+            if now - last_stage_report >= STAGE_REPORT_INTERVAL_S:
+                frame_age_ms = 1000 * (now - presented.captured_at)
+                stages = [thread.stats for thread in capture_threads] + [inference_stats, presentation_stats]
+                report = f"[pipeline] frame age {frame_age_ms:.0f}ms | {format_stage_report(stages)} | detection calls saved {station.detection_scheduler.saved_calls_per_minute}/min"
+                identity_cache = station.detection_stage.identity_cache
+                if identity_cache is not None:
+                    report += f" | tool identities cached {100 * identity_cache.hit_rate:.0f}% ({identity_cache.embedded} embedded)"
+                print(report)
+                last_stage_report = now
+        elif stop_event.is_set():
+            break
+
+        if args.headless:
+            continue
+        if cv2.waitKey(1) & 0xFF == 27:
+            break
+except KeyboardInterrupt:
+    pass
+
+stop_event.set()
+shutdown(capture_threads)
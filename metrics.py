@@ -0,0 +1,357 @@
+"""
+Hot-path metrics for the camera loop, served by api.py at /metrics.
+
+Stages are timed with histograms and events are counted with counters, all in the process-wide
+`registry`. Both are cheap enough to call on every frame: a histogram observation is a bisect and
+a couple of increments under an uncontended lock, a few microseconds, so the dozen or so per frame
+stay around 0.1% of a 33 ms frame. Histograms keep cumulative buckets for Prometheus plus a rolling
+window (the last minute by default) from which the JSON view estimates recent percentiles.
+
+SamplingProfiler captures where the Python threads spend their time on demand, by periodically
+sampling their stacks; it costs nothing until a capture is started.
+"""
+from bisect import bisect_left
+from collections import Counter as _TallyCounter
+from dataclasses import dataclass, field
+from pathlib import Path
+import math
+import sys
+import threading
+import time
+
+# Seconds; a 30 fps frame is 0.033
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.02, 0.033, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict[str, str], extra: dict[str, str] | None = None) -> str:
+    labels = {**labels, **(extra or {})}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float | None) -> str:
+    if value is None or math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    """Monotonic count, e.g. frames captured or model calls."""
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+
+class Gauge:
+    """A value read when metrics are collected, e.g. a queue length owned by someone else. None means unknown (NaN)."""
+
+    def __init__(self, function):
+        self.function = function
+
+    @property
+    def value(self) -> float | None:
+        return self.function()
+
+
+class _Timer:
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: "Histogram"):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class Histogram:
+    """
+    Latency histogram with cumulative buckets since start, plus a rolling window of `window_s`
+    seconds kept as `window_slots` rotating slots (the window moves in steps of window_s / window_slots).
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS, window_s: float = 60.0, window_slots: int = 6):
+        self.buckets = tuple(buckets)
+        self.count = 0
+        self.sum = 0.0
+        # One extra bucket for values above the last bound (+Inf)
+        self._bucket_counts = [0] * (len(self.buckets) + 1)
+        self._slot_s = window_s / window_slots
+        self._slots = [[0] * (len(self.buckets) + 1) for _ in range(window_slots)]
+        self._slot_sums = [0.0] * window_slots
+        self._slot_maxes = [0.0] * window_slots
+        self._current_slot = int(time.monotonic() / self._slot_s)
+        self._lock = threading.Lock()
+
+    def time(self) -> _Timer:
+        """`with histogram.time():` observes how long the block took."""
+        return _Timer(self)
+
+    def observe(self, value: float):
+        bucket = bisect_left(self.buckets, value)
+        slot_number = int(time.monotonic() / self._slot_s)
+        with self._lock:
+            if slot_number > self._current_slot:
+                self._rotate(slot_number)
+            self.count += 1
+            self.sum += value
+            self._bucket_counts[bucket] += 1
+            position = slot_number % len(self._slots)
+            self._slots[position][bucket] += 1
+            self._slot_sums[position] += value
+            if value > self._slot_maxes[position]:
+                self._slot_maxes[position] = value
+
+    def _rotate(self, slot_number: int):
+        """Clears the slots the window moved into since the last observation (all of them after an idle window)."""
+        for skipped in range(self._current_slot + 1, min(slot_number, self._current_slot + len(self._slots)) + 1):
+            position = skipped % len(self._slots)
+            self._slots[position] = [0] * (len(self.buckets) + 1)
+            self._slot_sums[position] = 0.0
+            self._slot_maxes[position] = 0.0
+        self._current_slot = slot_number
+
+    def cumulative_buckets(self) -> list[tuple[float, int]]:
+        """(upper bound, observations <= bound) pairs since start, ending with +Inf."""
+        with self._lock:
+            counts = list(self._bucket_counts)
+        running, result = 0, []
+        for bound, count in zip(self.buckets + (math.inf,), counts):
+            running += count
+            result.append((bound, running))
+        return result
+
+    def window_summary(self) -> dict:
+        """Count, mean, max and estimated p50/p95/p99 in ms over the rolling window."""
+        with self._lock:
+            slot_number = int(time.monotonic() / self._slot_s)
+            if slot_number > self._current_slot:
+                self._rotate(slot_number)
+            counts = [sum(slot[bucket] for slot in self._slots) for bucket in range(len(self.buckets) + 1)]
+            total_sum = sum(self._slot_sums)
+            maximum = max(self._slot_maxes)
+        count = sum(counts)
+        summary = {"count": count, "window_s": self._slot_s * len(self._slots)}
+        if count == 0:
+            return summary
+        summary["mean_ms"] = round(1000 * total_sum / count, 3)
+        for quantile in (0.5, 0.95, 0.99):
+            summary[f"p{round(quantile * 100)}_ms"] = round(1000 * self._quantile(counts, quantile, maximum), 3)
+        summary["max_ms"] = round(1000 * maximum, 3)
+        return summary
+
+    def _quantile(self, counts: list[int], quantile: float, maximum: float) -> float:
+        """Linear interpolation inside the bucket the quantile falls in, like Prometheus' histogram_quantile."""
+        rank = quantile * sum(counts)
+        running = 0
+        for bucket, count in enumerate(counts):
+            if count and running + count >= rank:
+                lower = self.buckets[bucket - 1] if bucket > 0 else 0.0
+                upper = self.buckets[bucket] if bucket < len(self.buckets) else maximum
+                return min(maximum, lower + (upper - lower) * (rank - running) / count)
+            running += count
+        return maximum
+
+
+@dataclass
+class _Family:
+    name: str
+    kind: str
+    help: str
+    # Children by their sorted label items
+    children: dict[tuple[tuple[str, str], ...], Counter | Gauge | Histogram] = field(default_factory=dict)
+
+
+class MetricsRegistry:
+    """
+    Named metrics with labels, e.g. registry.histogram("cabinet_stage_seconds", "...", station="main", stage="model").
+    Asking for the same name and labels again returns the same metric, so callers fetch theirs once and keep it.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._families: dict[str, _Family] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help: str, **labels: str) -> Counter:
+        return self._child(name, "counter", help, labels, Counter)
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS, **labels: str) -> Histogram:
+        return self._child(name, "histogram", help, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name: str, help: str, function, **labels: str) -> Gauge:
+        """A gauge computed by `function` at collection time; registering the same labels again replaces it."""
+        gauge = self._child(name, "gauge", help, labels, lambda: Gauge(function))
+        gauge.function = function
+        return gauge
+
+    def _child(self, name: str, kind: str, help: str, labels: dict[str, str], factory):
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = _Family(name, kind, help)
+            elif family.kind != kind:
+                raise ValueError(f"metric {name} is a {family.kind}, not a {kind}")
+            child = family.children.get(key)
+            if child is None:
+                child = family.children[key] = factory()
+            return child
+
+    def _snapshot(self) -> list[_Family]:
+        with self._lock:
+            return [_Family(family.name, family.kind, family.help, dict(family.children)) for family in self._families.values()]
+
+    def prometheus_text(self) -> str:
+        """Prometheus text exposition format 0.0.4."""
+        lines = []
+        for family in self._snapshot():
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for key, child in family.children.items():
+                labels = dict(key)
+                if isinstance(child, Histogram):
+                    for bound, count in child.cumulative_buckets():
+                        lines.append(f"{family.name}_bucket{_format_labels(labels, {'le': _format_value(bound)})} {count}")
+                    lines.append(f"{family.name}_sum{_format_labels(labels)} {_format_value(child.sum)}")
+                    lines.append(f"{family.name}_count{_format_labels(labels)} {child.count}")
+                else:
+                    lines.append(f"{family.name}{_format_labels(labels)} {_format_value(child.value)}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> dict:
+        """Counters and gauges with their values, histograms with totals and a summary of the rolling window."""
+        metrics = {}
+        for family in self._snapshot():
+            samples = []
+            for key, child in family.children.items():
+                sample = {"labels": dict(key)}
+                if isinstance(child, Histogram):
+                    sample.update(count=child.count, sum=child.sum, window=child.window_summary())
+                else:
+                    sample["value"] = child.value
+                samples.append(sample)
+            metrics[family.name] = {"type": family.kind, "help": family.help, "samples": samples}
+        return {"uptime_s": round(time.time() - self.started_at, 1), "metrics": metrics}
+
+
+# Shared by the camera loop and the API in this process
+registry = MetricsRegistry()
+
+# Time spent in each step of Station.process and the detection stage, per station
+STAGE_SECONDS = "cabinet_stage_seconds"
+STAGE_SECONDS_HELP = "Time spent in one step of the frame loop"
+
+
+def stage_timer(station: str, stage: str) -> Histogram:
+    return registry.histogram(STAGE_SECONDS, STAGE_SECONDS_HELP, station=station, stage=stage)
+
+
+@dataclass
+class Profile:
+    seconds: float
+    interval_s: float
+    samples: int
+    # "thread;outermost function;...;innermost function" -> samples, i.e. the folded format flame graph tools read
+    stacks: _TallyCounter = field(default_factory=_TallyCounter)
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit: int = 30) -> list[dict]:
+        """Functions by the share of their thread's samples where they were running (self), then where they were on the stack at all (total)."""
+        thread_samples = _TallyCounter()
+        own, total = _TallyCounter(), _TallyCounter()
+        for stack, count in self.stacks.items():
+            thread, *functions = stack.split(";")
+            thread_samples[thread] += count
+            if functions:
+                own[thread, functions[-1]] += count
+            for function in set(functions):
+                total[thread, function] += count
+        return [
+            {
+                "thread": thread,
+                "function": function,
+                "self_percent": round(100 * own[thread, function] / thread_samples[thread], 1),
+                "total_percent": round(100 * count / thread_samples[thread], 1),
+            }
+            for (thread, function), count in sorted(total.items(), key=lambda item: (own[item[0]], item[1]), reverse=True)[:limit]
+        ]
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler: every `interval_s` it records the Python stack of each thread (or only the
+    threads whose name contains `thread`). Sampling holds the GIL for the few tens of microseconds a
+    stack walk takes, so the loop slows by well under 1% at the default 10 ms interval, and only
+    while a capture runs. Time in C code (the model, OpenCV) shows up in the Python function that called it.
+    One capture at a time.
+    """
+
+    def __init__(self):
+        self._capture_lock = threading.Lock()
+        self._function_names: dict = {}
+
+    @property
+    def busy(self) -> bool:
+        return self._capture_lock.locked()
+
+    def capture(self, seconds: float, interval_s: float = 0.01, thread: str | None = None) -> Profile:
+        """Blocks for `seconds` while sampling. Raises RuntimeError if a capture is already running."""
+        if not self._capture_lock.acquire(blocking=False):
+            raise RuntimeError("a profile is already being captured")
+        try:
+            profile = Profile(seconds=seconds, interval_s=interval_s, samples=0)
+            own_id = threading.get_ident()
+            deadline = time.perf_counter() + seconds
+            next_sample = time.perf_counter()
+            while next_sample < deadline:
+                names = {worker.ident: worker.name for worker in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    name = names.get(thread_id, str(thread_id))
+                    if thread_id == own_id or (thread is not None and thread not in name):
+                        continue
+                    profile.stacks[self._fold(name, frame)] += 1
+                profile.samples += 1
+                next_sample += interval_s
+                delay = next_sample - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    # Fell behind; skip the missed samples rather than bursting
+                    next_sample = time.perf_counter()
+            return profile
+        finally:
+            self._capture_lock.release()
+
+    def _fold(self, thread_name: str, frame) -> str:
+        functions = []
+        while frame is not None:
+            code = frame.f_code
+            function = self._function_names.get(code)
+            if function is None:
+                function = self._function_names[code] = f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+            functions.append(function)
+            frame = frame.f_back
+        functions.append(thread_name)
+        return ";".join(reversed(functions))
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,210 @@
+"""
+Runs several tool cabinets ("stations") in one process with one copy of the tools model and the face models.
+
+    python multi_station.py --config stations.json --backend onnx
+
+Every station has its own capture threads, tracker, drawer filter and InventoryStateManager
+(persisted under its data_dir). Each tick, the newest colour frame of every station that needs
+detection goes into a single batched model call, and the results are routed back to the station
+they came from. The API serves the first station in the config.
+"""
+import argparse
+from collections import deque
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import uvicorn
+
+from api import app, frame_exchange, state_manager as api_state_manager
+from detection import DetectionResult, detect_batch
+from event_store import EventStore
+from faces import FaceGallery
+from image_store import ImageStore
+from inference_backends import BACKENDS, load_detector
+from pipeline import CaptureThread, LatestFrameQueue, StageStats, format_stage_report
+from recording import Recording, ReplaySource
+from stations import KinectSource, Station, StationConfig, VideoSource, load_station_configs
+from tool_identification import EMBEDDER_BACKENDS, ToolIdentifier, load_tool_identifier
+from tool_state import InventoryStateManager
+
+STAGE_REPORT_INTERVAL_S = 5.0
+
+
+@dataclass
+class StationInputs:
+    """Capture queues of one station and the newest frames taken from them."""
+    station: Station
+    depth_queue: LatestFrameQueue
+    color_queue: LatestFrameQueue
+    webcam_queue: LatestFrameQueue | None
+    event_store: EventStore
+    depth_frame: np.ndarray | None = None
+    webcam_frame: np.ndarray | None = None
+
+
+def start_station(
+    config: StationConfig,
+    state_manager: InventoryStateManager,
+    detector,
+    face_gallery: FaceGallery,
+    image_store: ImageStore,
+    stop_event: threading.Event,
+    capture_threads: list[CaptureThread],
+    publish_frames: bool,
+    tool_identifier: ToolIdentifier | None = None,
+) -> StationInputs:
+    # Restore this station's inventory and event history; changes are persisted off the inference thread
+    event_store = EventStore(config.data_dir, fsync="interval")
+    state_manager.attach_event_store(event_store)
+    # Images are content addressed, so all stations share one store (and the API serves all of them)
+    state_manager.image_store = image_store
+
+    station = Station.from_config(
+        config, state_manager, detector, face_gallery,
+        frame_exchange=frame_exchange if publish_frames else None,
+        tool_identifier=tool_identifier,
+    )
+    if config.replay is not None:
+        recording = Recording(config.replay)
+        read_color = ReplaySource(recording.streams["kinect_color"]).read
+        read_depth = ReplaySource(recording.streams["depth"]).read
+        read_webcam = ReplaySource(recording.streams["webcam"]).read if "webcam" in recording.streams else None
+    else:
+        kinect = KinectSource(config.kinect)
+        read_color, read_depth = kinect.read_color, kinect.read_depth
+        read_webcam = VideoSource(config.webcam).read if config.webcam is not None else None
+
+    inputs = StationInputs(
+        station=station,
+        depth_queue=LatestFrameQueue(f"{config.name}/depth"),
+        color_queue=LatestFrameQueue(f"{config.name}/kinect_color"),
+        webcam_queue=LatestFrameQueue(f"{config.name}/webcam") if read_webcam is not None else None,
+        event_store=event_store,
+    )
+    capture_threads.append(CaptureThread(f"{config.name}/depth", read_depth, inputs.depth_queue, stop_event))
+    capture_threads.append(CaptureThread(f"{config.name}/kinect_color", read_color, inputs.color_queue, stop_event))
+    if read_webcam is not None:
+        capture_threads.append(CaptureThread(f"{config.name}/webcam", read_webcam, inputs.webcam_queue, stop_event))
+    return inputs
+
+
+def run_inference_worker(stations: list[StationInputs], stop_event: threading.Event, tick_s: float, stats: StageStats, batch_sizes: deque[int]):
+    """Every tick: one batched model call for all stations with a new frame, then each station's state machine."""
+    next_tick = time.monotonic()
+    while not stop_event.is_set():
+        next_tick += tick_s
+        delay = next_tick - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            # Running behind; don't try to catch up with a burst of ticks
+            next_tick = time.monotonic()
+
+        ready = []
+        for inputs in stations:
+            color = inputs.color_queue.get(timeout=0)
+            if color is None:
+                continue
+            depth = inputs.depth_queue.get(timeout=0)
+            if depth is not None:
+                inputs.depth_frame = depth.data
+            webcam = inputs.webcam_queue.get(timeout=0) if inputs.webcam_queue is not None else None
+            if webcam is not None:
+                inputs.webcam_frame = webcam.data
+            if inputs.depth_frame is None:
+                continue
+            ready.append((inputs, color.data, webcam is not None))
+        if not ready:
+            continue
+
+        with stats.measure():
+            results: dict[int, DetectionResult] = {}
+            batch = []
+            for position, (inputs, color_frame, _) in enumerate(ready):
+                run, region = inputs.station.detection_request()
+                if run:
+                    batch.append((position, inputs.station.detection_stage, color_frame, region))
+                else:
+                    results[position] = inputs.station.detection_stage.skip()
+            if batch:
+                positions, stages, frames, regions = zip(*batch)
+                for position, result in zip(positions, detect_batch(list(stages), list(frames), list(regions))):
+                    results[position] = result
+                batch_sizes.append(len(batch))
+
+            for position, (inputs, color_frame, is_new_webcam_frame) in enumerate(ready):
+                inputs.station.process(inputs.depth_frame, color_frame, inputs.webcam_frame, is_new_webcam_frame, results[position])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config", default="stations.json")
+    parser.add_argument("--backend", choices=BACKENDS, default=os.environ.get("INFERENCE_BACKEND", "ultralytics"))
+    parser.add_argument("--weights", default=None, help="Model file or export directory (defaults to the one for the backend)")
+    parser.add_argument("--tool-index", default=os.environ.get("TOOL_INDEX"), help="Identify tools against this index (python index_tools.py)")
+    parser.add_argument("--embedder", choices=EMBEDDER_BACKENDS, default="torch")
+    parser.add_argument("--embedder-model", default=None)
+    parser.add_argument("--fps", type=float, default=30.0, help="Ticks per second; each tick is at most one batched model call")
+    args = parser.parse_args()
+
+    configs = load_station_configs(args.config)
+    detector = load_detector(args.backend, args.weights)
+    print(f"tools model: {args.backend} backend, {len(configs)} stations")
+    tool_identifier = load_tool_identifier(args.tool_index, args.embedder, args.embedder_model) if args.tool_index else None
+
+    print("setting up facial encodings")
+    face_gallery = FaceGallery("faces")
+    face_gallery.load()
+
+    api_public_url = os.environ.get("API_PUBLIC_URL", "http://localhost:8000")
+    image_store = ImageStore("data/images", url_prefix=f"{api_public_url}/api/images")
+
+    stop_event = threading.Event()
+    capture_threads: list[CaptureThread] = []
+    stations = []
+    for position, config in enumerate(configs):
+        # The first station is the one the API serves
+        state_manager = api_state_manager if position == 0 else InventoryStateManager()
+        stations.append(start_station(
+            config, state_manager, detector, face_gallery, image_store, stop_event, capture_threads,
+            publish_frames=position == 0, tool_identifier=tool_identifier,
+        ))
+
+    print(f"Starting API server on http://0.0.0.0:8000 (serving station {configs[0].name!r})")
+    threading.Thread(target=uvicorn.run, args=(app,), kwargs={"host": "0.0.0.0", "port": 8000, "log_level": "info"}, daemon=True).start()
+
+    inference_stats = StageStats("inference")
+    # Frames per model call over the last 100 calls
+    batch_sizes: deque[int] = deque(maxlen=100)
+    for capture_thread in capture_threads:
+        capture_thread.start()
+    inference_thread = threading.Thread(
+        target=run_inference_worker,
+        args=(stations, stop_event, 1 / args.fps, inference_stats, batch_sizes),
+        name="inference",
+        daemon=True,
+    )
+    inference_thread.start()
+
+    try:
+        while True:
+            time.sleep(STAGE_REPORT_INTERVAL_S)
+            recent_batches = list(batch_sizes)
+            average_batch = sum(recent_batches) / len(recent_batches) if recent_batches else 0.0
+            saved = sum(inputs.station.detection_scheduler.saved_calls_per_minute for inputs in stations)
+            stages = [thread.stats for thread in capture_threads] + [inference_stats]
+            print(f"[pipeline] {format_stage_report(stages)} | avg batch {average_batch:.1f} frames | detection calls saved {saved}/min")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        inference_thread.join(timeout=2)
+        for inputs in stations:
+            inputs.event_store.close()
+
+
+if __name__ == "__main__":
+    main()
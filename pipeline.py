@@ -0,0 +1,121 @@
+"""
+Building blocks for the threaded camera pipeline in main.py.
+
+Each sensor gets its own capture thread, and stages are joined by bounded latest-frame-wins
+queues: when a consumer falls behind, the oldest frame is dropped instead of backing up.
+Every stage keeps its own latency and drop counts so it's easy to see where the time goes.
+"""
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable
+import threading
+import time
+
+import metrics
+
+
+@dataclass
+class PipelineFrame:
+    seq: int
+    # time.perf_counter() at capture, used to report end-to-end frame age
+    captured_at: float
+    data: Any
+
+
+class LatestFrameQueue:
+    """
+    Bounded queue where the newest frame always wins.
+    Putting into a full queue drops the oldest frame and counts it in `dropped`.
+    """
+
+    def __init__(self, name: str, maxsize: int = 1):
+        self.name = name
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._dropped_counter = metrics.registry.counter("cabinet_frames_dropped_total", "Frames overwritten in a queue before they were used", queue=name)
+        self._items: deque[PipelineFrame] = deque()
+        self._condition = threading.Condition()
+
+    def put(self, item: PipelineFrame):
+        with self._condition:
+            while len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+                self._dropped_counter.inc()
+            self._items.append(item)
+            self._condition.notify()
+
+    def get(self, timeout: float | None = None) -> PipelineFrame | None:
+        """Returns the oldest queued frame, or None if nothing arrived within `timeout` seconds."""
+        with self._condition:
+            if not self._items and timeout != 0:
+                self._condition.wait_for(lambda: len(self._items) > 0, timeout=timeout)
+            if not self._items:
+                return None
+            return self._items.popleft()
+
+
+class StageStats:
+    """Rolling latency window plus processed/dropped counters for one pipeline stage."""
+
+    def __init__(self, name: str, output: LatestFrameQueue | None = None, window: int = 120):
+        self.name = name
+        self.output = output
+        self.processed = 0
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._histogram = metrics.registry.histogram("cabinet_pipeline_stage_seconds", "Time per frame in a pipeline thread", stage=name)
+
+    @contextmanager
+    def measure(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            latency = time.perf_counter() - start
+            self._latencies.append(latency)
+            self._histogram.observe(latency)
+            self.processed += 1
+
+    @property
+    def dropped(self) -> int:
+        """Frames this stage produced that were overwritten before the next stage picked them up."""
+        return self.output.dropped if self.output is not None else 0
+
+    def summary(self) -> str:
+        latencies = list(self._latencies)
+        if not latencies:
+            return f"{self.name}: idle"
+        avg_ms = 1000 * sum(latencies) / len(latencies)
+        max_ms = 1000 * max(latencies)
+        return f"{self.name}: {avg_ms:.1f}ms avg / {max_ms:.1f}ms max, {self.processed} frames, {self.dropped} dropped"
+
+
+class CaptureThread(threading.Thread):
+    """
+    Reads one sensor in a loop and publishes every frame to a LatestFrameQueue.
+    `read` should block until a frame is available and return None on a failed read.
+    """
+
+    def __init__(self, name: str, read: Callable[[], Any], output: LatestFrameQueue, stop_event: threading.Event):
+        super().__init__(name=f"capture-{name}", daemon=True)
+        self.read = read
+        self.output = output
+        self.stop_event = stop_event
+        self.stats = StageStats(f"capture/{name}", output=output)
+        self._captured = metrics.registry.counter("cabinet_frames_captured_total", "Frames read from a sensor", stream=name)
+        self._seq = 0
+
+    def run(self):
+        while not self.stop_event.is_set():
+            with self.stats.measure():
+                data = self.read()
+            if data is None:
+                continue
+            self._seq += 1
+            self._captured.inc()
+            self.output.put(PipelineFrame(seq=self._seq, captured_at=time.perf_counter(), data=data))
+
+
+def format_stage_report(stages: list[StageStats]) -> str:
+    return " | ".join(stats.summary() for stats in stages)
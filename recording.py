@@ -0,0 +1,237 @@
+"""
+Record-and-replay of the camera streams, so the pipeline can run without a Kinect on the desk.
+
+A recording is a directory with one set of files per stream ("kinect_color", "depth", "webcam"):
+- `<stream>.index`: one (timestamp, offset, length) record per frame, timestamps in seconds since the recording started
+- `<stream>.raw`: depth frames back to back as uint16, opened as a memory-mapped (frames, height, width) array
+- `<stream>.jpg` (or `.png`): colour frames as concatenated encoded images, located through the index
+- `meta.json`: format, shape and dtype of every stream
+
+    python main.py --record recordings/demo
+    python main.py --replay recordings/demo --replay-speed 0 --serial --headless
+
+ReplaySource plugs into CaptureThread in place of the live read functions, at the recorded pace or
+as fast as possible. replay_serial() instead walks all streams in timestamp order on one thread;
+together with a ReplayClock that makes a replay deterministic.
+"""
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Iterator, Literal
+import json
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import clock
+
+StreamFormat = Literal["raw", "jpg", "png"]
+
+INDEX_DTYPE = np.dtype([("timestamp", "<f8"), ("offset", "<i8"), ("length", "<i8")])
+# Default storage per stream; anything else is stored as JPEG
+STREAM_FORMATS: dict[str, StreamFormat] = {"depth": "raw", "kinect_color": "jpg", "webcam": "jpg"}
+
+
+class Recorder:
+    """
+    Appends frames from several capture threads to a recording directory.
+    Frames recorded after close() are dropped; stop the capture threads before closing to keep their last frames.
+
+    Args:
+        directory: Recording directory, created if needed. Existing streams in it are overwritten.
+        jpeg_quality: Quality for streams stored as JPEG.
+        formats: Storage format per stream name, overriding STREAM_FORMATS (e.g. {"kinect_color": "png"} for lossless colour).
+    """
+
+    def __init__(self, directory: str, jpeg_quality: int = 95, formats: dict[str, StreamFormat] | None = None):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.jpeg_quality = jpeg_quality
+        self.formats = {**STREAM_FORMATS, **(formats or {})}
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self._streams: dict[str, "_StreamWriter"] = {}
+        self._meta: dict[str, dict[str, Any]] = {}
+        self._closed = False
+
+    def wrap(self, stream: str, read: Callable[[], np.ndarray | None]) -> Callable[[], np.ndarray | None]:
+        """Returns a read function that records every frame `read` returns."""
+        def read_and_record():
+            frame = read()
+            if frame is not None:
+                self.record(stream, frame)
+            return frame
+        return read_and_record
+
+    def record(self, stream: str, frame: np.ndarray, timestamp: float | None = None):
+        timestamp = time.monotonic() - self._start if timestamp is None else timestamp
+        with self._lock:
+            if self._closed:
+                # Reopening would truncate the stream that was just closed
+                return
+            writer = self._streams.get(stream) or self._open(stream, frame)
+        # The writer drops the frame itself if close() got in first
+        writer.write(frame, timestamp)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for writer in self._streams.values():
+                writer.close()
+            self._streams.clear()
+
+    def _open(self, stream: str, frame: np.ndarray) -> "_StreamWriter":
+        """Called with the lock held."""
+        image_format = self.formats.get(stream, "jpg")
+        self._streams[stream] = _StreamWriter(self.directory, stream, image_format, self.jpeg_quality)
+        self._meta[stream] = {"format": image_format, "shape": list(frame.shape), "dtype": frame.dtype.str}
+        # Written as soon as a stream starts so a recording cut short by a crash is still readable
+        temporary_path = self.directory / "meta.json.tmp"
+        temporary_path.write_text(json.dumps({"streams": self._meta}, indent=2))
+        temporary_path.replace(self.directory / "meta.json")
+        return self._streams[stream]
+
+
+class _StreamWriter:
+    def __init__(self, directory: Path, stream: str, image_format: StreamFormat, jpeg_quality: int):
+        self.image_format = image_format
+        self.jpeg_quality = jpeg_quality
+        self._data = open(directory / f"{stream}.{image_format}", "wb")
+        self._index = open(directory / f"{stream}.index", "wb")
+        self._offset = 0
+        # Encoding happens outside it; only the file writes and close() are serialized
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def write(self, frame: np.ndarray, timestamp: float):
+        if self.image_format == "raw":
+            data = np.ascontiguousarray(frame).tobytes()
+        else:
+            params = [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality] if self.image_format == "jpg" else []
+            ok, buffer = cv2.imencode(f".{self.image_format}", frame, params)
+            if not ok:
+                raise ValueError(f"could not encode frame as {self.image_format}")
+            data = buffer.tobytes()
+        with self._lock:
+            if self._closed:
+                return
+            self._data.write(data)
+            self._index.write(np.array([(timestamp, self._offset, len(data))], dtype=INDEX_DTYPE).tobytes())
+            self._offset += len(data)
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._data.close()
+            self._index.close()
+
+
+class RecordedStream:
+    """Random access to the frames of one recorded stream."""
+
+    def __init__(self, directory: Path, stream: str, meta: dict[str, Any]):
+        self.name = stream
+        self.image_format: StreamFormat = meta["format"]
+        index = np.fromfile(directory / f"{stream}.index", dtype=INDEX_DTYPE)
+        data_path = directory / f"{stream}.{self.image_format}"
+        # Drop a frame whose data didn't make it to disk
+        data_size = data_path.stat().st_size
+        index = index[index["offset"] + index["length"] <= data_size]
+        self.timestamps = index["timestamp"]
+        self._index = index
+        if self.image_format == "raw":
+            shape = tuple(meta["shape"])
+            self._frames = np.memmap(data_path, dtype=np.dtype(meta["dtype"]), mode="r", shape=(len(index), *shape)) if len(index) else None
+        else:
+            self._data = np.memmap(data_path, dtype=np.uint8, mode="r") if data_size else None
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def frame(self, position: int) -> np.ndarray:
+        if self.image_format == "raw":
+            # A read-only view into the memory map; nothing in the pipeline writes into depth frames
+            return self._frames[position]
+        offset, length = int(self._index["offset"][position]), int(self._index["length"][position])
+        return cv2.imdecode(self._data[offset:offset + length], cv2.IMREAD_UNCHANGED)
+
+
+class Recording:
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        meta = json.loads((self.directory / "meta.json").read_text())
+        self.streams = {stream: RecordedStream(self.directory, stream, stream_meta) for stream, stream_meta in meta["streams"].items()}
+
+    @property
+    def duration_s(self) -> float:
+        return max((float(stream.timestamps[-1]) for stream in self.streams.values() if len(stream)), default=0.0)
+
+
+class ReplaySource:
+    """
+    Read function for CaptureThread that returns a recorded stream's frames in order.
+
+    Args:
+        stream: The stream to replay.
+        speed: Playback speed relative to the recording (1.0 is real time), or None for as fast as possible.
+    """
+
+    def __init__(self, stream: RecordedStream, speed: float | None = 1.0):
+        self.stream = stream
+        self.speed = speed
+        self._position = 0
+        self._started_at: float | None = None
+
+    @property
+    def exhausted(self) -> bool:
+        return self._position >= len(self.stream)
+
+    def read(self) -> np.ndarray | None:
+        if self.exhausted:
+            # CaptureThread keeps calling; don't spin
+            time.sleep(0.05)
+            return None
+        if self.speed is not None:
+            if self._started_at is None:
+                self._started_at = time.monotonic() - self.stream.timestamps[0] / self.speed
+            delay = self._started_at + self.stream.timestamps[self._position] / self.speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        frame = self.stream.frame(self._position)
+        self._position += 1
+        return frame
+
+
+@dataclass
+class ReplayStep:
+    # Timestamp of the primary stream's frame, in seconds since the recording started
+    timestamp: float
+    # Newest frame of every stream at that time (None for a stream that hasn't started yet)
+    frames: dict[str, np.ndarray | None]
+    # Whether each stream's frame is new since the previous step
+    is_new: dict[str, bool]
+
+
+def replay_serial(recording: Recording, primary: str = "kinect_color", replay_clock: clock.ReplayClock | None = None) -> Iterator[ReplayStep]:
+    """
+    Yields one step per frame of the primary stream, paired with the newest frame of every other
+    stream recorded at or before it, like the live pipeline pairs them. Advances `replay_clock` to
+    each step's timestamp before yielding it.
+    """
+    others = [stream for name, stream in recording.streams.items() if name != primary]
+    positions = {stream.name: -1 for stream in others}
+    frames: dict[str, np.ndarray | None] = {stream.name: None for stream in others}
+    primary_stream = recording.streams[primary]
+    for position, timestamp in enumerate(primary_stream.timestamps):
+        is_new = {primary: True}
+        for stream in others:
+            # Last frame of this stream recorded at or before the primary frame
+            latest = int(np.searchsorted(stream.timestamps, timestamp, side="right")) - 1
+            is_new[stream.name] = latest > positions[stream.name]
+            if is_new[stream.name]:
+                positions[stream.name] = latest
+                frames[stream.name] = stream.frame(latest)
+        if replay_clock is not None:
+            replay_clock.advance_to(float(timestamp))
+        yield ReplayStep(timestamp=float(timestamp), frames={primary: primary_stream.frame(position), **frames}, is_new=is_new)
@@ -0,0 +1,94 @@
+"""
+Fixed-capacity, time-indexed ring buffer for DrawerOpenState's tool detection history.
+"""
+from math import ceil
+from typing import Generic, TypeVar
+
+import numpy as np
+
+import clock
+
+FrameT = TypeVar("FrameT")
+
+
+class SnapshotRing(Generic[FrameT]):
+    """
+    Keeps (monotonic timestamp, detection set, frame) snapshots from the last `window_s` seconds.
+
+    Storage is preallocated for `expected_fps * window_s * headroom` snapshots, so appending is
+    constant time with no per-frame list rebuilds. Detection sets are stored as frozensets and
+    interned against the previous snapshot, so an unchanged set costs no allocation at all. If
+    frames arrive faster than expected the oldest snapshots are overwritten early.
+    """
+
+    def __init__(self, window_s: float = 2.0, expected_fps: float = 30.0, headroom: float = 2.0):
+        self.window_s = window_s
+        self.capacity = max(2, ceil(window_s * expected_fps * headroom) + 1)
+        self._timestamps = np.zeros(self.capacity, dtype=np.float64)
+        self._states: list[frozenset[str] | None] = [None] * self.capacity
+        self._frames: list[FrameT | None] = [None] * self.capacity
+        self._start = 0
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def append(self, states: set[str] | frozenset[str], frame: FrameT | None, now: float | None = None):
+        """Records a snapshot and drops the ones that fell out of the window."""
+        now = clock.monotonic() if now is None else now
+        self._evict_older_than(now - self.window_s)
+
+        if self._size > 0:
+            previous = self._states[self._physical(self._size - 1)]
+            # Interning: reuse the previous frozenset when the detections didn't change
+            frozen = previous if previous == states else frozenset(states)
+        else:
+            frozen = frozenset(states)
+
+        if self._size == self.capacity:
+            self._drop_oldest()
+        slot = self._physical(self._size)
+        self._timestamps[slot] = now
+        self._states[slot] = frozen
+        self._frames[slot] = frame
+        self._size += 1
+
+    def at_or_before(self, target: float) -> tuple[frozenset[str], FrameT | None] | None:
+        """
+        The newest snapshot taken at or before `target`, or the oldest snapshot if all of them are newer.
+        Returns None when the ring is empty. Binary search, O(log capacity).
+        """
+        if self._size == 0:
+            return None
+        low, high = 0, self._size
+        while low < high:
+            middle = (low + high) // 2
+            if self._timestamps[self._physical(middle)] <= target:
+                low = middle + 1
+            else:
+                high = middle
+        index = low - 1 if low > 0 else 0
+        slot = self._physical(index)
+        return self._states[slot], self._frames[slot]
+
+    def clear(self):
+        for index in range(self._size):
+            slot = self._physical(index)
+            self._states[slot] = None
+            self._frames[slot] = None
+        self._start = 0
+        self._size = 0
+
+    def _evict_older_than(self, cutoff: float):
+        while self._size > 0 and self._timestamps[self._start] <= cutoff:
+            self._drop_oldest()
+
+    def _drop_oldest(self):
+        # Release the references so old frames can be freed right away
+        self._states[self._start] = None
+        self._frames[self._start] = None
+        self._start = (self._start + 1) % self.capacity
+        self._size -= 1
+
+    def _physical(self, index: int) -> int:
+        return (self._start + index) % self.capacity
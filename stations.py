@@ -0,0 +1,332 @@
+"""
+Per-station state and processing.
+
+A station is one tool cabinet: a Kinect watching the drawers, optionally a webcam for faces, and its
+own tracker, drawer filter, detection scheduler and InventoryStateManager. main.py runs a single
+station; multi_station.py runs several in one process and batches their frames into one model call.
+"""
+from dataclasses import dataclass
+from pathlib import Path
+import json
+import time
+
+import cv2
+import numpy as np
+import supervision as sv
+
+from depth_probes import DrawerStateFilter
+from detection import DetectionAnnotator, DetectionResult, DetectionScheduler, FPSCounter, Region, ToolDetectionStage
+from faces import FaceGallery, FaceRecognitionScheduler, RecognizedFace, draw_faces
+from frame_exchange import FrameExchange
+import metrics
+from tool_identification import ToolIdentifier
+from tool_state import DrawerOpenState, InventoryStateManager, User
+
+
+@dataclass
+class StationConfig:
+    name: str
+    # freenect device index of the Kinect (colour and depth)
+    kinect: int = 0
+    # cv2.VideoCapture index or video file for face recognition, None for no webcam
+    webcam: int | str | None = None
+    depth_probes: str = "depth_probes.json"
+    detection_regions: str = "detection_regions.json"
+    # Event log, snapshots and inventory of this station
+    data_dir: str | None = None
+    # Recording directory to replay (recording.py) instead of reading the Kinect and webcam
+    replay: str | None = None
+
+    def __post_init__(self):
+        if self.data_dir is None:
+            self.data_dir = f"data/{self.name}"
+
+
+def load_station_configs(path: str = "stations.json") -> list[StationConfig]:
+    config = json.loads(Path(path).read_text())
+    stations = [StationConfig(**station) for station in config["stations"]]
+    names = [station.name for station in stations]
+    if len(set(names)) != len(names):
+        raise ValueError(f"station names in {path} must be unique")
+    return stations
+
+
+class KinectSource:
+    """Colour and depth reads for one Kinect, by freenect device index."""
+
+    def __init__(self, index: int = 0):
+        self.index = index
+
+    def read_color(self) -> np.ndarray | None:
+        import freenect
+
+        frame, _ = freenect.sync_get_video(index=self.index)
+        return cv2.cvtColor(frame, cv2.COLOR_RGB2BGR) if frame is not None else None
+
+    def read_depth(self) -> np.ndarray | None:
+        import freenect
+
+        frame, _ = freenect.sync_get_depth(index=self.index)
+        return frame
+
+
+class VideoSource:
+    """
+    A cv2.VideoCapture device index or a recorded video file.
+    Files are played back at their own frame rate and start over at the end.
+    """
+
+    def __init__(self, source: int | str):
+        self.source = source
+        self.capture = cv2.VideoCapture(source)
+        self.is_file = isinstance(source, str)
+        fps = self.capture.get(cv2.CAP_PROP_FPS) if self.is_file else 0
+        self.frame_interval_s = 1 / fps if fps > 0 else 0.0
+        self._next_frame_at = time.monotonic()
+
+    def read(self) -> np.ndarray | None:
+        if self.is_file:
+            delay = self._next_frame_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._next_frame_at = max(self._next_frame_at, time.monotonic() - 1) + self.frame_interval_s
+        ok, frame = self.capture.read()
+        if not ok and self.is_file:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ok, frame = self.capture.read()
+        if not ok:
+            # Don't spin on a dead device
+            time.sleep(0.1)
+            return None
+        return frame
+
+
+class Station:
+    """
+    Runs the tool state machine, face recognition and drawer detection for one cabinet.
+    The model call itself is left to the caller so several stations can share one batched call:
+    ask detection_request() what to run, then hand the result to process().
+    """
+
+    def __init__(
+        self,
+        name: str,
+        state_manager: InventoryStateManager,
+        detection_stage: ToolDetectionStage,
+        detection_scheduler: DetectionScheduler,
+        drawer_state_filter: DrawerStateFilter,
+        face_scheduler: FaceRecognitionScheduler,
+        face_gallery: FaceGallery,
+        frame_exchange: FrameExchange | None = None,
+        verbose: bool = False,
+    ):
+        self.name = name
+        self.state_manager = state_manager
+        self.detection_stage = detection_stage
+        self.detection_scheduler = detection_scheduler
+        self.drawer_state_filter = drawer_state_filter
+        self.face_scheduler = face_scheduler
+        self.face_gallery = face_gallery
+        # The annotated frame is only rendered for stations that publish it
+        self.frame_exchange = frame_exchange
+        self.verbose = verbose
+
+        self.annotator = DetectionAnnotator()
+        self.fps_counter = FPSCounter()
+        self.previous_drawer_identifier: str | None = None
+
+        # Fetched once so the loop itself only observes and increments (served at /metrics)
+        self.timers = {stage: metrics.stage_timer(name, stage) for stage in ("tool_state", "faces", "annotate", "publish", "depth_probes", "state_machine")}
+        self.frames_processed = metrics.registry.counter("cabinet_frames_processed_total", "Frames that went through the state machine", station=name)
+        self.face_recognition_runs = metrics.registry.counter("cabinet_face_recognition_runs_total", "Webcam frames face recognition ran on", station=name)
+        self.face_matches = {
+            known: metrics.registry.counter("cabinet_faces_total", "Faces found, by whether they matched someone in the gallery", station=name, match=match)
+            for known, match in ((True, "known"), (False, "unknown"))
+        }
+        self.state_transitions = {
+            state: metrics.registry.counter("cabinet_state_transitions_total", "Drawer state machine transitions, by the state entered", station=name, state=state)
+            for state in ("drawer_open", "no_drawer_open")
+        }
+        # What the verbose print shows, without the print
+        for position, probe in enumerate(drawer_state_filter.engine.probes):
+            metrics.registry.gauge(
+                "cabinet_depth_probe_reading", "Median filtered depth reading of a drawer probe, NaN while unreliable",
+                lambda position=position: self._probe_reading(position), station=name, probe=probe.name,
+            )
+
+    @classmethod
+    def from_config(
+        cls,
+        config: StationConfig,
+        state_manager: InventoryStateManager,
+        detector,
+        face_gallery: FaceGallery,
+        frame_exchange: FrameExchange | None = None,
+        verbose: bool = False,
+        tool_identifier: ToolIdentifier | None = None,
+    ) -> "Station":
+        tracker = sv.ByteTrack(track_activation_threshold=0.3, minimum_matching_threshold=0.2, lost_track_buffer=90)
+        if tool_identifier is not None:
+            state_manager.tool_catalogue = tool_identifier.index.tools
+        return cls(
+            name=config.name,
+            state_manager=state_manager,
+            detection_stage=ToolDetectionStage(detector, tracker, tool_identifier, station=config.name),
+            # The model only runs at full rate while a drawer is open, cropped to that drawer's region
+            detection_scheduler=DetectionScheduler.from_config(config.detection_regions),
+            drawer_state_filter=DrawerStateFilter.from_config(config.depth_probes),
+            # Full face recognition runs at most every 5 webcam frames, and only when the scene changed or a drawer was just opened
+            face_scheduler=FaceRecognitionScheduler(every_n_frames=5, every_ms=None, motion_threshold=6.0),
+            face_gallery=face_gallery,
+            frame_exchange=frame_exchange,
+            verbose=verbose,
+        )
+
+    def detection_request(self) -> tuple[bool, Region | None]:
+        """
+        Whether the model should run on this station's next frame, and on which region (None for the full frame).
+        With no drawer open nothing can be checked in or out, so the model only runs on a slow heartbeat.
+        """
+        tool_detection_state = self.state_manager.tool_detection_state
+        if not self.detection_scheduler.should_run(tool_detection_state):
+            return False, None
+        return True, self.detection_scheduler.region_for(tool_detection_state)
+
+    def detect(self, color_frame: np.ndarray) -> DetectionResult:
+        """Unbatched detection for a single station."""
+        run, region = self.detection_request()
+        if not run:
+            return self.detection_stage.skip()
+        return self.detection_stage.detect(color_frame, roi=region)
+
+    def process(
+        self,
+        depth_frame: np.ndarray,
+        color_frame: np.ndarray,
+        webcam_frame: np.ndarray | None,
+        is_new_webcam_frame: bool,
+        detection_result: DetectionResult,
+    ) -> np.ndarray | None:
+        """
+        One inference step after the model ran. All state machine updates happen here.
+        Returns the annotated frame if this station publishes one.
+        """
+        self.frames_processed.inc()
+        with self.timers["tool_state"].time():
+            self.update_tool_detection_state(detection_result.tool_detection_set, color_frame)
+
+        # The webcam runs at its own rate; only look for faces in frames we haven't seen yet
+        if webcam_frame is not None and is_new_webcam_frame:
+            self.recognize_faces(webcam_frame)
+
+        annotated_frame = None
+        self.fps_counter.tick()
+        if self.frame_exchange is not None:
+            # Render the annotated frame straight into the API's frame exchange (reuses this frame's detections)
+            with self.timers["annotate"].time():
+                annotated_frame = self.frame_exchange.begin_write(color_frame.shape, color_frame.dtype)
+                self.annotator.annotate(color_frame, detection_result, out=annotated_frame)
+                self.fps_counter.draw(annotated_frame)
+            with self.timers["publish"].time():
+                self.frame_exchange.commit()
+
+        self.update_drawer_state(depth_frame)
+        return annotated_frame
+
+    def update_tool_detection_state(self, tool_detection_set: set[str], color_frame: np.ndarray):
+        # Update tool detection state if drawer is open
+        if isinstance(self.state_manager.tool_detection_state, DrawerOpenState):
+            drawer_state = self.state_manager.tool_detection_state
+            if drawer_state.detailed_state == "waiting_for_initial_tool_detection":
+                # Update initial tool detection state
+                drawer_state.initial_detection_count += len(tool_detection_set)
+                if drawer_state.initial_detection_count >= 10 and len(tool_detection_set) > len(drawer_state.initial_tool_detection_state):
+                    drawer_state.initial_tool_detection_state = tool_detection_set
+            elif drawer_state.detailed_state == "watching_for_tool_checkin_or_checkout":
+                # Update current tool detection state (the detection set is built fresh every frame, no copy needed)
+                drawer_state.current_tool_detection_state = tool_detection_set
+                # Record snapshot for 2-second buffer
+                # The frame is kept by reference and only encoded if it ends up in an event
+                drawer_state.record_tool_detection_snapshot(color_frame)
+
+    def recognize_faces(self, frame: np.ndarray):
+        """Runs face recognition on a webcam frame when the scheduler says so, updates the detected user and draws the faces in place."""
+        self.face_gallery.reload_if_changed()
+        if self.face_scheduler.should_run(frame, self.state_manager.tool_detection_state):
+            with self.timers["faces"].time():
+                faces, detected_user = self.find_faces(frame)
+            self.face_scheduler.record_result(faces, detected_user)
+
+        draw_faces(frame, self.face_scheduler.last_faces)
+
+        # Update state manager with the last recognized user (or None if nobody was recognized);
+        # between recognition runs this keeps the identity from the last run
+        self.state_manager.update_currently_detected_user(self.face_scheduler.last_user)
+
+    def find_faces(self, frame: np.ndarray) -> tuple[list[RecognizedFace], User | None]:
+        """Face detection, encoding and gallery matching on one webcam frame. Returns the faces and the first known user."""
+        import face_recognition
+
+        rgb_frame = frame[:, :, ::-1]
+        small = cv2.resize(rgb_frame, (0, 0), fx=0.25, fy=0.25)
+
+        face_locations = face_recognition.face_locations(small)
+        face_encodings = face_recognition.face_encodings(small, face_locations)
+
+        # Track detected user for this frame
+        detected_user = None
+        faces = []
+
+        # Match every face in this frame against the whole gallery at once
+        face_matches = self.face_gallery.match(face_encodings)
+        self.face_recognition_runs.inc()
+        for (top, right, bottom, left), face_match in zip(face_locations, face_matches):
+            self.face_matches[face_match.is_known].inc()
+            name = face_match.name
+            user = None
+            if face_match.is_known:
+                user = InventoryStateManager.make_user_from_string(face_match.name)
+                detected_user = detected_user or user
+                name = user.name
+
+            faces.append(RecognizedFace(location=(top * 4, right * 4, bottom * 4, left * 4), name=name, user=user))
+        return faces, detected_user
+
+    def _probe_reading(self, position: int) -> int | None:
+        readings = self.drawer_state_filter.readings
+        return readings[position] if position < len(readings) else None
+
+    def update_drawer_state(self, depth_frame: np.ndarray):
+        # Readings are median filtered and a new drawer only counts once it has held for min_dwell_s,
+        # so a single unreliable frame (e.g. a drawer edge mixing with the floor) no longer flips the state
+        with self.timers["depth_probes"].time():
+            current_drawer_identifier = self.drawer_state_filter.update(depth_frame)
+        with self.timers["state_machine"].time():
+            self.apply_drawer_transition(current_drawer_identifier)
+
+    def apply_drawer_transition(self, current_drawer_identifier: str | None):
+        """Moves the state machine to the drawer the depth probes settled on (None for no drawer open)."""
+        previous_drawer_identifier = self.previous_drawer_identifier
+
+        # Handle drawer state transitions
+        if previous_drawer_identifier != current_drawer_identifier:
+            # Transition from no drawer to drawer open
+            if previous_drawer_identifier is None and current_drawer_identifier is not None:
+                self.state_manager.transition_to_drawer_open(current_drawer_identifier)
+                self.state_transitions["drawer_open"].inc()
+            # Transition from drawer open to no drawer
+            elif previous_drawer_identifier is not None and current_drawer_identifier is None:
+                self.state_manager.transition_to_no_drawer_open()
+                self.state_transitions["no_drawer_open"].inc()
+            # Transition from one drawer to different drawer
+            elif previous_drawer_identifier is not None and current_drawer_identifier is not None and previous_drawer_identifier != current_drawer_identifier:
+                self.state_manager.transition_to_no_drawer_open()
+                self.state_manager.transition_to_drawer_open(current_drawer_identifier)
+                self.state_transitions["no_drawer_open"].inc()
+                self.state_transitions["drawer_open"].inc()
+
+            self.previous_drawer_identifier = current_drawer_identifier
+
+        if self.verbose:
+            drawer = current_drawer_identifier if current_drawer_identifier is not None else "no drawer open"
+            print(f"[{self.name}] {self.fps_counter.fps:.1f} fps", *self.drawer_state_filter.readings, "-", drawer)
@@ -0,0 +1,422 @@
+"""
+Identifies individual tools by embedding similarity instead of by the tools model's classes.
+
+The tools model only proposes where tools are. Each proposed box is cropped, all crops of a frame
+are embedded in one batched forward pass of an image embedding model (DINOv2 by default), and
+every embedding is looked up in a vector_index index over the catalogue's reference images.
+TrackIdentityCache keeps the result per ByteTrack id, so only new tracks get embedded.
+Adding a tool means dropping its photos into the catalogue and re-indexing, not retraining.
+
+Catalogue layout (like faces/):
+    tool_catalogue/<tool id>/*.jpg     reference photos of one tool
+    tool_catalogue/tools.json          optional {"<tool id>": {"name", "description", "type", "cost", "imageUrl"}}
+
+Build or update the index with:
+    python index_tools.py --catalogue tool_catalogue --index data/tool_index
+"""
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Literal, Protocol
+import hashlib
+import json
+import os
+
+import cv2
+import numpy as np
+import supervision as sv
+
+from tool_state import Tool
+from vector_index import VectorIndex, make_index
+
+EmbedderBackend = Literal["torch", "onnx"]
+EMBEDDER_BACKENDS: tuple[EmbedderBackend, ...] = ("torch", "onnx")
+
+DEFAULT_EMBEDDER_MODEL = "dinov2_vits14"
+TOOL_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+# DINOv2 takes multiples of its 14px patch size; 224 is what it was trained on
+EMBEDDING_INPUT_SIZE = 224
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+class ToolEmbedder(Protocol):
+    # Identifies the model, so an index built with a different one is never mixed in
+    name: str
+
+    def embed_batch(self, crops: list[np.ndarray]) -> np.ndarray:
+        """L2-normalized embeddings of shape (len(crops), dimensions) for BGR crops of any size."""
+        ...
+
+
+def preprocess_crops(crops: list[np.ndarray], size: int = EMBEDDING_INPUT_SIZE) -> np.ndarray:
+    """BGR crops to one normalized (N, 3, size, size) float32 batch."""
+    batch = np.empty((len(crops), size, size, 3), dtype=np.float32)
+    for position, crop in enumerate(crops):
+        resized = cv2.resize(crop, (size, size), interpolation=cv2.INTER_AREA if min(crop.shape[:2]) > size else cv2.INTER_LINEAR)
+        batch[position] = resized[:, :, ::-1]
+    batch = (batch / 255.0 - IMAGENET_MEAN) / IMAGENET_STD
+    return np.ascontiguousarray(batch.transpose(0, 3, 1, 2))
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+class TorchHubEmbedder:
+    """DINOv2 from torch hub (downloaded on first use), on the GPU when there is one unless `device` says otherwise."""
+
+    def __init__(self, model: str = DEFAULT_EMBEDDER_MODEL, device: str = "auto"):
+        import torch
+
+        self.name = model
+        if device == "auto":
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
+        self.model = torch.hub.load("facebookresearch/dinov2", model).to(self.device).eval()
+
+    def embed_batch(self, crops: list[np.ndarray]) -> np.ndarray:
+        import torch
+
+        if not crops:
+            return np.zeros((0, 0), dtype=np.float32)
+        with torch.inference_mode():
+            batch = torch.from_numpy(preprocess_crops(crops)).to(self.device)
+            # The CLS token embedding
+            embeddings = self.model(batch).float().cpu().numpy()
+        return normalize(embeddings)
+
+
+class OnnxEmbedder:
+    """
+    Any ONNX image embedding model taking a (N, 3, 224, 224) ImageNet-normalized batch, e.g. DINOv2
+    exported with torch.onnx.export and a dynamic batch axis. Outputs of shape (N, tokens, dimensions)
+    use the first (CLS) token.
+    """
+
+    def __init__(self, path: str, device: str = "auto"):
+        import onnxruntime as ort
+
+        self.name = Path(path).stem
+        providers = ["CPUExecutionProvider"] if device == "cpu" else ort.get_available_providers()
+        self.session = ort.InferenceSession(path, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def embed_batch(self, crops: list[np.ndarray]) -> np.ndarray:
+        if not crops:
+            return np.zeros((0, 0), dtype=np.float32)
+        embeddings = self.session.run(None, {self.input_name: preprocess_crops(crops)})[0]
+        if embeddings.ndim == 3:
+            embeddings = embeddings[:, 0]
+        return normalize(embeddings.astype(np.float32))
+
+
+def load_embedder(backend: EmbedderBackend = "torch", model: str | None = None, device: str = "auto") -> ToolEmbedder:
+    """`model` is the torch hub model name for "torch" and the .onnx file for "onnx"; `device` is "auto", "cpu" or a torch device."""
+    if backend == "torch":
+        return TorchHubEmbedder(model or DEFAULT_EMBEDDER_MODEL, device)
+    if backend == "onnx":
+        return OnnxEmbedder(model or f"{DEFAULT_EMBEDDER_MODEL}.onnx", device)
+    raise ValueError(f"unknown embedder backend {backend!r}, expected one of {EMBEDDER_BACKENDS}")
+
+
+@dataclass
+class ToolMatch:
+    tool: Tool
+    # Cosine similarity of the closest reference image of this tool
+    similarity: float
+    # Nearest (tool id, similarity) pairs from the index, closest first
+    candidates: list[tuple[str, float]] = field(default_factory=list)
+
+
+class ToolIndex:
+    """
+    Reference embeddings of every catalogue image, searchable through a vector_index index.
+
+    Persisted in `<index_dir>/embeddings.npy` (memory-mapped on load) with `<index_dir>/index.json`
+    holding the embedder name, the tool of every row and the SHA-1 of every indexed image, so
+    update() only embeds new or changed images.
+    """
+
+    def __init__(self, index_dir: str = "data/tool_index"):
+        self.index_dir = Path(index_dir)
+        self.embedder_name: str | None = None
+        self.tools: dict[str, Tool] = {}
+        # Tool id of every row of embeddings
+        self.labels: list[str] = []
+        self.embeddings = np.zeros((0, 0), dtype=np.float32)
+        self.index: VectorIndex = make_index(0)
+        self._images: dict[str, dict] = {}
+
+        self._embeddings_path = self.index_dir / "embeddings.npy"
+        self._index_path = self.index_dir / "index.json"
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def load(self) -> "ToolIndex":
+        if not self._index_path.exists() or not self._embeddings_path.exists():
+            raise FileNotFoundError(f"no tool index in {self.index_dir}; build one with python index_tools.py")
+        meta = json.loads(self._index_path.read_text())
+        self.embedder_name = meta["embedder"]
+        self.tools = {tool_id: Tool(**tool) for tool_id, tool in meta["tools"].items()}
+        self._images = meta["images"]
+        self._set_embeddings(np.load(self._embeddings_path, mmap_mode="r"), meta["labels"])
+        print(f"tool index: {len(self.tools)} tools, {len(self)} reference images from {self.index_dir} ({type(self.index).__name__})")
+        return self
+
+    def update(self, catalogue_dir: str, embedder: ToolEmbedder, batch_size: int = 32):
+        """Re-indexes the catalogue, embedding only images that aren't in the index yet, and saves it."""
+        catalogue = Path(catalogue_dir)
+        metadata = json.loads((catalogue / "tools.json").read_text()) if (catalogue / "tools.json").exists() else {}
+        if self._index_path.exists():
+            previous = json.loads(self._index_path.read_text())
+            # Embeddings from another model live in another space; start over
+            if previous["embedder"] == embedder.name:
+                self.load()
+        cached_embeddings = self.embeddings
+
+        tools = {}
+        images = {}
+        labels = []
+        rows = []
+        pending: list[tuple[str, str, np.ndarray]] = []
+        for tool_dir in sorted(path for path in catalogue.iterdir() if path.is_dir() and not path.name.startswith(".")):
+            tool_id = tool_dir.name
+            tools[tool_id] = _make_tool(tool_id, metadata.get(tool_id, {}))
+            for image_path in sorted(path for path in tool_dir.iterdir() if path.suffix.lower() in TOOL_IMAGE_EXTENSIONS):
+                file_hash = hashlib.sha1(image_path.read_bytes()).hexdigest()
+                cached = self._images.get(file_hash)
+                if cached is not None and cached["tool"] == tool_id:
+                    images[file_hash] = {"file": str(image_path.relative_to(catalogue)), "tool": tool_id, "row": len(rows)}
+                    rows.append(np.array(cached_embeddings[cached["row"]], dtype=np.float32))
+                    labels.append(tool_id)
+                    continue
+                image = cv2.imread(str(image_path))
+                if image is None:
+                    print(f"tool index: could not read {image_path}, skipping")
+                    continue
+                pending.append((file_hash, str(image_path.relative_to(catalogue)), image))
+                if len(pending) >= batch_size:
+                    self._embed_pending(pending, embedder, images, rows, labels)
+                    pending = []
+        self._embed_pending(pending, embedder, images, rows, labels)
+
+        embeddings = np.stack(rows) if rows else np.zeros((0, 0), dtype=np.float32)
+        self.embedder_name = embedder.name
+        self.tools = tools
+        self._images = images
+        self._save(embeddings, labels)
+        self._set_embeddings(np.load(self._embeddings_path, mmap_mode="r"), labels)
+        print(f"tool index: {len(tools)} tools, {len(self)} reference images saved to {self.index_dir}")
+
+    def search(self, embeddings: np.ndarray, k: int = 5) -> list[list[tuple[str, float]]]:
+        """Nearest (tool id, cosine similarity) pairs per query embedding, closest first."""
+        if len(embeddings) == 0:
+            return []
+        labels, index = self.labels, self.index
+        indices, distances = index.search(np.asarray(embeddings, dtype=np.float64), k)
+        # Both sides are unit length, so |a - b|^2 = 2 - 2 cos(a, b)
+        similarities = 1.0 - distances ** 2 / 2.0
+        return [
+            [(labels[row], float(similarity)) for row, similarity in zip(row_indices, row_similarities) if row >= 0]
+            for row_indices, row_similarities in zip(indices, similarities)
+        ]
+
+    def _embed_pending(self, pending: list[tuple[str, str, np.ndarray]], embedder: ToolEmbedder, images: dict, rows: list, labels: list):
+        if not pending:
+            return
+        embeddings = embedder.embed_batch([image for _, _, image in pending])
+        for (file_hash, file_name, _), embedding in zip(pending, embeddings):
+            tool_id = Path(file_name).parts[0]
+            images[file_hash] = {"file": file_name, "tool": tool_id, "row": len(rows)}
+            rows.append(np.asarray(embedding, dtype=np.float32))
+            labels.append(tool_id)
+
+    def _set_embeddings(self, embeddings: np.ndarray, labels: list[str]):
+        index = make_index(len(embeddings))
+        index.build(embeddings)
+        # Swap everything in at once so a concurrent search never sees mismatched labels and rows
+        self.embeddings, self.labels, self.index = embeddings, list(labels), index
+
+    def _save(self, embeddings: np.ndarray, labels: list[str]):
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file and swap it in, never truncate a file that may still be memory-mapped
+        temporary_path = self._embeddings_path.with_suffix(".tmp.npy")
+        np.save(temporary_path, embeddings)
+        os.replace(temporary_path, self._embeddings_path)
+        meta = {
+            "embedder": self.embedder_name,
+            "tools": {tool_id: tool.__dict__ for tool_id, tool in self.tools.items()},
+            "labels": labels,
+            "images": self._images,
+        }
+        temporary_path = self._index_path.with_suffix(".tmp.json")
+        temporary_path.write_text(json.dumps(meta, indent=2))
+        os.replace(temporary_path, self._index_path)
+
+
+def _make_tool(tool_id: str, metadata: dict) -> Tool:
+    return Tool(
+        id=tool_id,
+        name=metadata.get("name", tool_id),
+        description=metadata.get("description", tool_id),
+        imageUrl=metadata.get("imageUrl", f"https://picsum.photos/seed/{tool_id}/500"),
+        type=metadata.get("type", tool_id),
+        cost=float(metadata.get("cost", 0.0)),
+    )
+
+
+class ToolIdentifier:
+    """
+    Identifies the tool in every detected box of a frame.
+
+    Args:
+        embedder: Must be the model the index was built with.
+        index: The catalogue's reference embeddings.
+        min_similarity: Cosine similarity below which a crop counts as an unknown tool.
+        k: Reference images considered per crop; the tool with the highest summed similarity among them wins.
+        padding: Fraction of the box size added on every side of the crop, for a bit of context.
+    """
+
+    def __init__(self, embedder: ToolEmbedder, index: ToolIndex, min_similarity: float = 0.6, k: int = 5, padding: float = 0.1):
+        if index.embedder_name is not None and index.embedder_name != embedder.name:
+            raise ValueError(f"tool index was built with {index.embedder_name!r}, not {embedder.name!r}; re-run index_tools.py")
+        self.embedder = embedder
+        self.index = index
+        self.min_similarity = min_similarity
+        self.k = k
+        self.padding = padding
+
+    def identify(self, frame: np.ndarray, detections: sv.Detections) -> list[ToolMatch | None]:
+        """One match per detection (None for an unknown tool), from a single batched forward pass."""
+        if len(detections) == 0:
+            return []
+        crops = [crop_box(frame, box, self.padding) for box in detections.xyxy]
+        return self.match(self.embedder.embed_batch(crops))
+
+    def match(self, embeddings: np.ndarray) -> list[ToolMatch | None]:
+        matches = []
+        for candidates in self.index.search(embeddings, self.k):
+            scores: dict[str, float] = {}
+            for tool_id, similarity in candidates:
+                if similarity >= self.min_similarity:
+                    scores[tool_id] = scores.get(tool_id, 0.0) + similarity
+            if not scores:
+                matches.append(None)
+                continue
+            tool_id = max(scores, key=scores.__getitem__)
+            best = max(similarity for candidate, similarity in candidates if candidate == tool_id)
+            matches.append(ToolMatch(tool=self.index.tools[tool_id], similarity=best, candidates=candidates))
+        return matches
+
+
+@dataclass
+class _TrackIdentity:
+    match: ToolMatch | None
+    embedding: np.ndarray
+    # Box (width, height) and crop thumbnail at the time the track was embedded
+    size: tuple[float, float]
+    thumbnail: np.ndarray
+    # TrackIdentityCache.updates when the track was last seen
+    last_seen: int
+
+
+class TrackIdentityCache:
+    """
+    Remembers the identity of every ByteTrack track, so a tool is embedded when its track appears
+    instead of on every frame.
+
+    A track is embedded again when its box width or height changed by more than `size_drift` (a
+    fraction), or its crop looks different (mean absolute difference of a small grayscale thumbnail,
+    0-255, above `appearance_drift`), compared to when it was last embedded. An entry is evicted once
+    its track has been missing for `max_age_frames` tracker updates, which is when ByteTrack drops it.
+    """
+
+    def __init__(
+        self,
+        identifier: ToolIdentifier,
+        max_age_frames: int = 90,
+        size_drift: float = 0.1,
+        appearance_drift: float = 20.0,
+        thumbnail_size: tuple[int, int] = (16, 16),
+    ):
+        self.identifier = identifier
+        self.max_age_frames = max_age_frames
+        self.size_drift = size_drift
+        self.appearance_drift = appearance_drift
+        self.thumbnail_size = thumbnail_size
+
+        self.entries: dict[int, _TrackIdentity] = {}
+        self.updates = 0
+        self.hits = 0
+        self.embedded = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.embedded
+        return self.hits / lookups if lookups else 0.0
+
+    def identify(self, frame: np.ndarray, detections: sv.Detections) -> list[ToolMatch | None]:
+        """
+        One match per tracked detection. Only new and drifted tracks go through the embedding model, in one batch.
+        Call after every tracker update, also without detections, so track ages stay in step with ByteTrack.
+        """
+        self.updates += 1
+        matches: list[ToolMatch | None] = [None] * len(detections)
+        tracker_ids = detections.tracker_id if detections.tracker_id is not None else [None] * len(detections)
+        stale = []
+        for position, (box, tracker_id) in enumerate(zip(detections.xyxy, tracker_ids)):
+            crop = crop_box(frame, box, self.identifier.padding)
+            thumbnail = self._thumbnail(crop)
+            entry = self.entries.get(int(tracker_id)) if tracker_id is not None else None
+            if entry is not None and not self._drifted(entry, box, thumbnail):
+                entry.last_seen = self.updates
+                matches[position] = entry.match
+                self.hits += 1
+            else:
+                stale.append((position, crop, thumbnail))
+
+        if stale:
+            embeddings = self.identifier.embedder.embed_batch([crop for _, crop, _ in stale])
+            for (position, _, thumbnail), embedding, match in zip(stale, embeddings, self.identifier.match(embeddings)):
+                matches[position] = match
+                tracker_id = tracker_ids[position]
+                if tracker_id is not None:
+                    x1, y1, x2, y2 = detections.xyxy[position]
+                    self.entries[int(tracker_id)] = _TrackIdentity(
+                        match=match, embedding=embedding, size=(float(x2 - x1), float(y2 - y1)), thumbnail=thumbnail, last_seen=self.updates,
+                    )
+            self.embedded += len(stale)
+
+        # Tracks ByteTrack has given up on never come back under the same id
+        for tracker_id in [tracker_id for tracker_id, entry in self.entries.items() if self.updates - entry.last_seen > self.max_age_frames]:
+            del self.entries[tracker_id]
+        return matches
+
+    def _drifted(self, entry: _TrackIdentity, box: np.ndarray, thumbnail: np.ndarray) -> bool:
+        width, height = float(box[2] - box[0]), float(box[3] - box[1])
+        cached_width, cached_height = entry.size
+        if abs(width - cached_width) > self.size_drift * max(cached_width, 1.0) or abs(height - cached_height) > self.size_drift * max(cached_height, 1.0):
+            return True
+        return float(cv2.absdiff(thumbnail, entry.thumbnail).mean()) > self.appearance_drift
+
+    def _thumbnail(self, crop: np.ndarray) -> np.ndarray:
+        small = cv2.resize(crop, self.thumbnail_size, interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+
+def crop_box(frame: np.ndarray, box: np.ndarray, padding: float = 0.0) -> np.ndarray:
+    """The (x1, y1, x2, y2) box plus `padding` of its size on every side, clipped to the frame. Never empty."""
+    x1, y1, x2, y2 = (float(value) for value in box)
+    pad_x, pad_y = padding * (x2 - x1), padding * (y2 - y1)
+    height, width = frame.shape[:2]
+    left = int(np.clip(np.floor(x1 - pad_x), 0, width - 1))
+    top = int(np.clip(np.floor(y1 - pad_y), 0, height - 1))
+    right = int(np.clip(np.ceil(x2 + pad_x), left + 1, width))
+    bottom = int(np.clip(np.ceil(y2 + pad_y), top + 1, height))
+    return frame[top:bottom, left:right]
+
+
+def load_tool_identifier(index_dir: str, backend: EmbedderBackend = "torch", model: str | None = None, min_similarity: float = 0.6) -> ToolIdentifier:
+    return ToolIdentifier(load_embedder(backend, model), ToolIndex(index_dir).load(), min_similarity=min_similarity)
@@ -1,16 +1,25 @@
-from typing import Counter, Literal, TypedDict
+from typing import TYPE_CHECKING, Counter, Literal, TypedDict
 from uuid import uuid4
-from datetime import datetime, timedelta
-from dataclasses import dataclass, field
+from datetime import datetime
+from dataclasses import dataclass, field, replace
 from collections import defaultdict
 
+import numpy as np
+
+import clock
+from change_feed import ChangeFeed
+from snapshot_ring import SnapshotRing
+from event_index import EventLogIndex, EventPage, EventQuery, decode_cursor, query_scanned
+
+if TYPE_CHECKING:
+    from event_store import EventStore, RecoveredState
+    from image_store import ImageStore
+
 DRAWER_TO_TOOL_MAP = {
     "drivers and bits": "ifixit",
     "clamps": "clamp"
 }
 
-DRAWER_STATE = defaultdict(lambda: False)
-
 @dataclass
 class User:
     id: str
@@ -40,31 +49,75 @@ class InventoryUpdateLogEntry:
     tool: Tool
     eventImageUrl: str = field(repr=False)
 
+@dataclass
+class InventoryAggregates:
+    """
+    Running totals behind /api/audit-logs/overview, updated as inventory changes and events happen so the overview never rescans the event log.
+    """
+    total_tools: int = 0
+    # Per user id: checkouts minus checkins, floored at zero
+    outstanding_checkouts: Counter[str] = field(default_factory=Counter)
+    users_with_checked_out_tools: int = 0
+
+    def apply_inventory_delta(self, delta: int):
+        self.total_tools += delta
+
+    def apply_event(self, entry: InventoryUpdateLogEntry):
+        if entry.user is None:
+            return
+        user_id = entry.user.id
+        before = self.outstanding_checkouts[user_id]
+        if entry.type == "tool_checkout":
+            after = before + 1
+        else:
+            after = max(0, before - 1)
+        self.outstanding_checkouts[user_id] = after
+        self.users_with_checked_out_tools += (after > 0) - (before > 0)
+
+    def to_dict(self) -> dict:
+        return {
+            "total_tools": self.total_tools,
+            "outstanding_checkouts": dict(self.outstanding_checkouts),
+            "users_with_checked_out_tools": self.users_with_checked_out_tools,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "InventoryAggregates":
+        return cls(
+            total_tools=data["total_tools"],
+            outstanding_checkouts=Counter(data["outstanding_checkouts"]),
+            users_with_checked_out_tools=data["users_with_checked_out_tools"],
+        )
+
+
 @dataclass
 class NoDrawerOpenState:
     state: Literal["no_drawer_open"] = "no_drawer_open"
 
 MS_FROM_DRAWER_OPEN_TO_WATCHING_FOR_TOOL_CHECKIN_OR_CHECKOUT = 1000
+# How far back transition_to_no_drawer_open looks for the tool detection state (the hand is usually in frame at close time)
+TOOL_DETECTION_HISTORY_S = 2.0
 
 @dataclass
 class DrawerOpenState:
     drawer_identifier: str
     last_detected_user: User | None = None
-    time_of_drawer_open: datetime = field(default_factory=datetime.now)
+    time_of_drawer_open: datetime = field(default_factory=clock.now)
     
     initial_detection_count: int = 0
     initial_tool_detection_state: set[str] = field(default_factory=set)
     current_tool_detection_state: set[str] = field(default_factory=set)
     
-    # Buffer to store timestamped snapshots of current_tool_detection_state
-    # Each entry is (timestamp, tool_detection_state_copy, frame_base64)
-    tool_detection_state_history: list[tuple[datetime, set[str], str]] = field(default_factory=list)
+    # Ring buffer of timestamped snapshots of current_tool_detection_state from the last 2 seconds.
+    # Frames are kept as references to the raw camera frames; only the one that ends up in an event gets encoded
+    tool_detection_state_history: SnapshotRing[np.ndarray] = field(
+        default_factory=lambda: SnapshotRing(window_s=TOOL_DETECTION_HISTORY_S), repr=False)
 
     state: Literal["drawer_open"] = "drawer_open"
 
     @property
     def detailed_state(self) -> Literal["waiting_for_initial_tool_detection", "watching_for_tool_checkin_or_checkout"]:
-        drawer_open_delta = datetime.now() - self.time_of_drawer_open
+        drawer_open_delta = clock.now() - self.time_of_drawer_open
         is_ready_for_tool_count_changes = drawer_open_delta.total_seconds() < MS_FROM_DRAWER_OPEN_TO_WATCHING_FOR_TOOL_CHECKIN_OR_CHECKOUT / 1000
 
         if is_ready_for_tool_count_changes:
@@ -72,76 +125,118 @@ class DrawerOpenState:
         else:
             return "watching_for_tool_checkin_or_checkout"
     
-    def record_tool_detection_snapshot(self, frame_base64: str):
-        """Record a snapshot of current_tool_detection_state with timestamp and cleanup old snapshots."""
-        now = datetime.now()
-        # Store snapshot with current timestamp
-        self.tool_detection_state_history.append((now, self.current_tool_detection_state.copy(), frame_base64))
-        
-        # Clean up snapshots older than 2 seconds
-        cutoff_time = now - timedelta(seconds=2)
-        self.tool_detection_state_history = [
-            (timestamp, state, frame) for timestamp, state, frame in self.tool_detection_state_history
-            if timestamp > cutoff_time
-        ]
+    def record_tool_detection_snapshot(self, frame: np.ndarray | None):
+        """
+        Record a snapshot of current_tool_detection_state with timestamp; snapshots older than 2 seconds fall out of the ring.
+        The frame is stored by reference, so the caller must not write into it afterwards.
+        """
+        self.tool_detection_state_history.append(self.current_tool_detection_state, frame)
     
-    def _get_tool_detection_state_2_seconds_ago(self) -> tuple[set[str], str]:
+    def _get_tool_detection_state_2_seconds_ago(self) -> tuple[set[str] | frozenset[str], np.ndarray | None]:
         """
         Get the tool detection state from approximately 2 seconds ago.
-        Falls back to the most recent non-empty snapshot, or current state if no snapshots exist.
-        Returns a tuple of (state, frame_base64).
+        Prefers the most recent snapshot at or before 2 seconds ago, then the closest (oldest) one after it,
+        or the current state if no snapshots exist.
+        Returns a tuple of (state, frame).
         """
-        now = datetime.now()
-        target_time = now - timedelta(seconds=2)
-        
-        # First, try to find snapshots at or before 2 seconds ago (preferred)
-        candidates_at_or_before = []
-        candidates_after = []
-        
-        for timestamp, state, frame in self.tool_detection_state_history:
-            if timestamp <= target_time:
-                candidates_at_or_before.append((timestamp, state, frame))
-            else:
-                candidates_after.append((timestamp, state, frame))
-        
-        # Prefer the most recent snapshot at or before 2 seconds ago
-        if candidates_at_or_before:
-            # Sort by timestamp descending to get the most recent
-            candidates_at_or_before.sort(key=lambda x: x[0], reverse=True)
-            return (candidates_at_or_before[0][1], candidates_at_or_before[0][2])
+        target_time = clock.monotonic() - TOOL_DETECTION_HISTORY_S
+        snapshot = self.tool_detection_state_history.at_or_before(target_time)
+        if snapshot is not None:
+            return snapshot
         
-        # If no snapshot at or before 2 seconds, use the closest one overall
-        if candidates_after:
-            candidates_after.sort(key=lambda x: abs((x[0] - target_time).total_seconds()))
-            return (candidates_after[0][1], candidates_after[0][2])
-        
-        # Fallback: use the most recent non-empty snapshot
-        for timestamp, state, frame in reversed(self.tool_detection_state_history):
-            if state:  # Non-empty set
-                return (state, frame)
-        
-        # Final fallback: use current state (might be empty, but it's better than nothing)
-        return (self.current_tool_detection_state, "")
+        # Fallback: use current state (might be empty, but it's better than nothing)
+        return (self.current_tool_detection_state, None)
 
 
 class InventoryStateManager:
     """
     Current inventory stores the what tools are stored in what drawers. The key is the tool class (from the model). The value at that key is another dict, where the key is the drawer identifier, and the value is the count of that class in that drawer.
     """
-    current_inventory: dict[str, Counter[str]] = defaultdict(Counter)
+    current_inventory: dict[str, Counter[str]]
+
+    """
+    Whether the next close of each drawer counts as a check-out (True) or a check-in (False); flipped on every close.
+    """
+    drawer_state: defaultdict[str, bool]
 
     """
     Stores the user that is currently being detected by the facial detection task.
     """
-    currently_detected_user: User | None = None
+    currently_detected_user: User | None
 
     """
-    Event log stores the history of inventory updates.
+    Event log stores the history of inventory updates since startup, plus the most recent ones restored from the
+    event store; older events stay on disk and query_events reads them from there.
     """
-    event_log: list[InventoryUpdateLogEntry] = []
+    event_log: list[InventoryUpdateLogEntry]
 
+    """
+    Secondary indexes (by user, by tool, by type, by time) over event_log, kept in sync by _generate_event_log_entry.
+    """
+    event_index: EventLogIndex
+
+    """
+    Totals for the overview endpoint, maintained incrementally.
+    """
+    aggregates: InventoryAggregates
+
+    """
+    Optional persistence; when attached, every inventory change, event and drawer toggle is appended to it.
+    """
+    event_store: "EventStore | None"
+
+    """
+    Optional store for event snapshot images; without it events get a placeholder image URL.
+    """
+    image_store: "ImageStore | None"
 
-    tool_detection_state: NoDrawerOpenState | DrawerOpenState = NoDrawerOpenState(state="no_drawer_open")
+    """
+    Catalogue tools by id (tool_identification.ToolIndex.tools). When set, detections are expected to carry
+    identified tool ids and every drawer is updated with the tools that were actually seen, instead of
+    the one hard-coded tool per drawer in DRAWER_TO_TOOL_MAP.
+    """
+    tool_catalogue: dict[str, Tool] | None
+
+
+    tool_detection_state: NoDrawerOpenState | DrawerOpenState
+
+    """
+    Change feed publishes every new event log entry, inventory delta and tool_detection_state transition, so API clients don't have to poll the full lists.
+    """
+    change_feed: ChangeFeed
+
+    def __init__(self):
+        # Everything is per instance so several stations can run side by side in one process
+        self.current_inventory = defaultdict(Counter)
+        self.drawer_state = defaultdict(lambda: False)
+        self.currently_detected_user = None
+        self.event_log = []
+        self.event_index = EventLogIndex()
+        self.aggregates = InventoryAggregates()
+        self.event_store = None
+        self.image_store = None
+        self.tool_catalogue = None
+        self.tool_detection_state = NoDrawerOpenState(state="no_drawer_open")
+        self.change_feed = ChangeFeed()
+
+    def attach_event_store(self, event_store: "EventStore"):
+        """Restores the state persisted by a previous run and records every change from now on."""
+        self.restore(event_store.recover())
+        self.event_store = event_store
+
+    def restore(self, recovered: "RecoveredState"):
+        # Copy everything: the store's writer thread keeps applying records to its own instance
+        inventory = defaultdict(Counter)
+        for tool_class, drawer_counts in recovered.inventory.items():
+            inventory[tool_class] = Counter(drawer_counts)
+        self.current_inventory = inventory
+        self.drawer_state.clear()
+        self.drawer_state.update(recovered.drawer_state)
+        self.aggregates = InventoryAggregates.from_dict(recovered.aggregates.to_dict())
+        self.event_log = list(recovered.recent_events)
+        self.event_index = EventLogIndex()
+        # The log starts part way into the history; cursors name events by their place in the whole history
+        self.event_index.rebuild(self.event_log, first_sequence=recovered.events_total - len(self.event_log))
 
     @staticmethod
     def make_user_from_string(user_string: str) -> User:
@@ -178,6 +273,7 @@ class InventoryStateManager:
         print(f"prev state: {self.tool_detection_state}")
         print(f"new state: {new_state}")
         self.tool_detection_state = new_state
+        self._publish_state_change()
 
     def transition_to_no_drawer_open(self):
         assert isinstance(self.tool_detection_state, DrawerOpenState)
@@ -185,42 +281,90 @@ class InventoryStateManager:
 
 
         DO_UPDATE = True
-        if self.tool_detection_state.drawer_identifier not in DRAWER_TO_TOOL_MAP:
-            DO_UPDATE = False
-            print("skipping inventory update, drawer not in DRAWER_TO_TOOL_MAP")
-            hardcode_tool = None
-        else:
-            hardcode_tool = DRAWER_TO_TOOL_MAP[self.tool_detection_state.drawer_identifier]
+        hardcode_tool = None
+        # With a tool catalogue the detections already say which tool it is, in any drawer
+        if self.tool_catalogue is None:
+            if self.tool_detection_state.drawer_identifier not in DRAWER_TO_TOOL_MAP:
+                DO_UPDATE = False
+                print("skipping inventory update, drawer not in DRAWER_TO_TOOL_MAP")
+            else:
+                hardcode_tool = DRAWER_TO_TOOL_MAP[self.tool_detection_state.drawer_identifier]
 
         save_state: DrawerOpenState = self.tool_detection_state
         self.tool_detection_state = NoDrawerOpenState()
+        self._publish_state_change()
 
         # Use 2-second-old snapshot instead of current (potentially empty) state
-        tool_detection_state_to_use, frame_base64 = save_state._get_tool_detection_state_2_seconds_ago()
+        tool_detection_state_to_use, event_frame = save_state._get_tool_detection_state_2_seconds_ago()
 
         checked_out_tools = save_state.initial_tool_detection_state - tool_detection_state_to_use
         returned_tools = tool_detection_state_to_use - save_state.initial_tool_detection_state
-        should_do_check_out = DRAWER_STATE[save_state.drawer_identifier]
+        if self.tool_catalogue is not None:
+            # Tools the identifier didn't recognise are still named by the model's class; they don't touch the inventory
+            checked_out_tools = {tool for tool in checked_out_tools if self._tool_id_from_detection(tool) in self.tool_catalogue}
+            returned_tools = {tool for tool in returned_tools if self._tool_id_from_detection(tool) in self.tool_catalogue}
+        should_do_check_out = self.drawer_state[save_state.drawer_identifier]
         if DO_UPDATE:
             if should_do_check_out:
                 for tool in checked_out_tools:
-                    tool = hardcode_tool if hardcode_tool else tool
+                    tool = hardcode_tool if hardcode_tool else self._tool_id_from_detection(tool)
                     self.current_inventory[tool][save_state.drawer_identifier] -= 1
-                    self._generate_event_log_entry(event_type="tool_checkin", user=save_state.last_detected_user, tool=self._generate_tool_from_class(tool), event_image_base64=frame_base64)
+                    self._record_inventory_change(tool, save_state.drawer_identifier, -1)
+                    self._generate_event_log_entry(event_type="tool_checkin", user=save_state.last_detected_user, tool=self._generate_tool_from_class(tool), event_frame=event_frame)
                     break
             else:
                 for tool in returned_tools:
-                    tool = hardcode_tool if hardcode_tool else tool
+                    tool = hardcode_tool if hardcode_tool else self._tool_id_from_detection(tool)
                     self.current_inventory[tool][save_state.drawer_identifier] += 1
-                    self._generate_event_log_entry(event_type="tool_checkout", user=save_state.last_detected_user, tool=self._generate_tool_from_class(tool), event_image_base64=frame_base64)
+                    self._record_inventory_change(tool, save_state.drawer_identifier, 1)
+                    self._generate_event_log_entry(event_type="tool_checkout", user=save_state.last_detected_user, tool=self._generate_tool_from_class(tool), event_frame=event_frame)
                     break
-        DRAWER_STATE[save_state.drawer_identifier] = not DRAWER_STATE[save_state.drawer_identifier]
+        self.drawer_state[save_state.drawer_identifier] = not self.drawer_state[save_state.drawer_identifier]
+        if self.event_store is not None:
+            self.event_store.append_drawer_state(save_state.drawer_identifier, self.drawer_state[save_state.drawer_identifier])
 
         print(f"prev state: {save_state}")
         print(f"new state: {self.tool_detection_state}")
 
 
+    def query_events(self, query: EventQuery) -> EventPage:
+        """
+        Pages through the whole history. Events from before the in-memory log are only read from the event
+        store when a page reaches them: ascending pages start there, descending pages end there.
+        """
+        first_sequence = self.event_index.first_sequence
+        if self.event_store is None or first_sequence == 0:
+            return self.event_index.query(self.event_log, query)
+        cursor = decode_cursor(query.cursor) if query.cursor is not None else None
+
+        if query.order == "asc":
+            start = cursor if cursor is not None else 0
+            if start >= first_sequence:
+                return self.event_index.query(self.event_log, query)
+            older = query_scanned(self.event_store.scan_events(start, first_sequence), query, query.limit)
+            if older.next_cursor is not None:
+                return older
+            remaining = None if query.limit is None else query.limit - len(older.events)
+            newer = self.event_index.query(self.event_log, replace(query, cursor=None, limit=remaining))
+            return EventPage(events=older.events + newer.events, next_cursor=newer.next_cursor)
+
+        newer = self.event_index.query(self.event_log, query)
+        if newer.next_cursor is not None:
+            return newer
+        stop = first_sequence if cursor is None else min(cursor + 1, first_sequence)
+        remaining = None if query.limit is None else query.limit - len(newer.events)
+        older = query_scanned(self.event_store.scan_events(0, stop, "desc"), query, remaining)
+        return EventPage(events=newer.events + older.events, next_cursor=older.next_cursor)
+
+    def _tool_id_from_detection(self, tool_detection: str) -> str:
+        """Tool detections are "{tool} {tracker_id}"; with a catalogue the inventory is kept per tool, not per track."""
+        if self.tool_catalogue is None:
+            return tool_detection
+        return tool_detection.rsplit(" ", 1)[0]
+
     def _generate_tool_from_class(self, tool_class: str) -> Tool:
+        if self.tool_catalogue is not None and tool_class in self.tool_catalogue:
+            return self.tool_catalogue[tool_class]
         # this is kinda unideal, might be able to do some better heuristic here
         return Tool(
             id=tool_class,
@@ -231,14 +375,45 @@ class InventoryStateManager:
             type=tool_class,
         )
 
-    def _generate_event_log_entry(self, event_type: Literal["tool_checkout", "tool_checkin"], user: User, tool: Tool, event_image_base64: str):
-        now = datetime.now()
+    def _generate_event_log_entry(self, event_type: Literal["tool_checkout", "tool_checkin"], user: User, tool: Tool, event_frame: np.ndarray | None):
+        now = clock.now()
         timestamp = int(now.timestamp())
-        self.event_log.append(InventoryUpdateLogEntry(
+        event_image_url = None
+        if event_frame is not None and self.image_store is not None:
+            # The only JPEG encode in the snapshot pipeline: one per event, not one per frame
+            event_image_url = self.image_store.url_for(self.image_store.put_frame(event_frame))
+        entry = InventoryUpdateLogEntry(
             id=str(uuid4()),
             timestamp=timestamp,
             type=event_type,
             user=user,
             tool=tool,
-            eventImageUrl=event_image_base64 if event_image_base64 else f"https://picsum.photos/seed/{timestamp}/500"
-        ))
\ No newline at end of file
+            eventImageUrl=event_image_url if event_image_url else f"https://picsum.photos/seed/{timestamp}/500"
+        )
+        # The log first: API threads query the index against the log, so the index must never be ahead of it
+        self.event_log.append(entry)
+        self.event_index.add(len(self.event_log) - 1, entry)
+        self.aggregates.apply_event(entry)
+        if self.event_store is not None:
+            self.event_store.append_event(entry)
+        self.change_feed.publish("event", entry)
+
+    def _record_inventory_change(self, tool_class: str, drawer_identifier: str, delta: int):
+        self.aggregates.apply_inventory_delta(delta)
+        if self.event_store is not None:
+            self.event_store.append_inventory_change(tool_class, drawer_identifier, delta)
+        self.change_feed.publish("inventory", {
+            "tool": tool_class,
+            "drawer": drawer_identifier,
+            "delta": delta,
+            "count": self.current_inventory[tool_class][drawer_identifier],
+        })
+
+    def _publish_state_change(self):
+        # Only the identifying fields; the detection sets and snapshot history are internal bookkeeping
+        state = self.tool_detection_state
+        payload = {"state": state.state}
+        if isinstance(state, DrawerOpenState):
+            payload["drawer_identifier"] = state.drawer_identifier
+            payload["time_of_drawer_open"] = state.time_of_drawer_open.isoformat()
+        self.change_feed.publish("state", payload)
\ No newline at end of file